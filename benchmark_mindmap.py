@@ -0,0 +1,301 @@
+"""End-to-end benchmark of the mindmap pipeline on the MOCK (or REPLAY) provider.
+
+Each case (scenario x document) runs in a fresh subprocess, so caches, the emoji cache and peak
+RSS are not shared between cases. Results are written as JSON; pass a previous result file with
+--compare to fail on regressions.
+
+    python benchmark_mindmap.py --output bench.json
+    python benchmark_mindmap.py --sizes 10000,100000 --compare bench.json --threshold wall_time_s=0.3
+
+Scenarios:
+    generate   - MindMapGenerator.generate_mindmap
+    simple     - MindMapGenerator.generate_mindmap_simple
+    verify     - verify_mindmap_against_source on the mindmap of a (untimed) generate run
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import statistics
+import subprocess
+import tempfile
+from typing import Any, Dict, List, Optional
+
+# Peak RSS comes from getrusage, which is not available on Windows
+try:
+    import resource
+    RESOURCE_AVAILABLE = True
+except ImportError:
+    RESOURCE_AVAILABLE = False
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BUNDLED_DOCUMENTS = {
+    'small': os.path.join(BASE_DIR, 'sample_input_document_as_markdown__small.md'),
+    'memo': os.path.join(BASE_DIR, 'sample_input_document_as_markdown__durnovo_memo.md'),
+}
+SCENARIOS = ('generate', 'simple', 'verify')
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+# Relative increase over the baseline that counts as a regression, per metric
+DEFAULT_THRESHOLDS = {
+    'wall_time_s': 0.25,
+    'cpu_time_s': 0.25,
+    'peak_rss_mb': 0.20,
+    'llm_calls': 0.10,
+    'total_tokens': 0.10,
+}
+
+
+def synthetic_document(size_chars: int, seed: int = 0) -> str:
+    """Markdown document of about `size_chars` characters built from the bundled samples.
+
+    Sections with headings hold paragraphs of shuffled sample sentences, so chunking,
+    retrieval and deduplication see realistic structure at any scale.
+    """
+    sentences = []
+    for path in BUNDLED_DOCUMENTS.values():
+        with open(path, 'r', encoding='utf-8') as f:
+            text = re.sub(r'^#+.*$', '', f.read(), flags=re.MULTILINE)
+        sentences.extend(s.strip() for s in re.split(r'(?<=[.!?])\s+', text) if len(s.strip()) > 20)
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    section = 0
+    while length < size_chars:
+        section += 1
+        heading = f"## Section {section}: {' '.join(rng.choice(sentences).split()[:4])}"
+        paragraphs = [' '.join(rng.sample(sentences, 5)) for _ in range(rng.randint(2, 5))]
+        block = heading + '\n\n' + '\n\n'.join(paragraphs) + '\n'
+        parts.append(block)
+        length += len(block) + 1
+    return ('# Synthetic Benchmark Document\n\n' + '\n'.join(parts))[:size_chars]
+
+
+def load_document(name: str) -> str:
+    if name in BUNDLED_DOCUMENTS:
+        with open(BUNDLED_DOCUMENTS[name], 'r', encoding='utf-8') as f:
+            return f.read()
+    if name.startswith('synthetic_'):
+        return synthetic_document(int(name.split('_', 1)[1]))
+    raise ValueError(f"Unknown benchmark document: {name}")
+
+
+def peak_rss_mb() -> Optional[float]:
+    if not RESOURCE_AVAILABLE:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+async def run_case(scenario: str, document_name: str) -> Dict[str, Any]:
+    """Run one case in this process and return its metrics (called in the worker subprocess)."""
+    import logging
+    import mindmap_generator as mg
+    logging.getLogger("mindmap_generator").setLevel(logging.ERROR)
+
+    content = load_document(document_name)
+    generator = mg.MindMapGenerator()
+
+    mindmap_data = None
+    if scenario == 'verify':
+        # The mindmap to verify comes from an untimed generation; only verification is measured
+        run = mg.GenerationRun()
+        await generator.generate_mindmap(content, f"bench-{document_name}-setup", run=run)
+        mindmap_data = run.last_verified_concepts
+        if not mindmap_data:
+            raise RuntimeError("Setup generation produced no verified mindmap")
+
+    # Only the measured call is recorded in this ledger, not the setup generation
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    with mg.usage_ledger() as tracker:
+        if scenario == 'generate':
+            output = await generator.generate_mindmap(content, f"bench-{document_name}")
+            output_size = len(output.splitlines())
+        elif scenario == 'simple':
+            output = await generator.generate_mindmap_simple(content, f"bench-{document_name}")
+            output_size = len(output.splitlines())
+        else:
+            verified = await generator.verify_mindmap_against_source(copy_tree(mindmap_data), content)
+            output_size = len(verified.get('central_theme', {}).get('subtopics', []))
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = time.process_time() - cpu_start
+
+    return {
+        'scenario': scenario,
+        'document': document_name,
+        'document_chars': len(content),
+        'wall_time_s': round(wall_time, 3),
+        'cpu_time_s': round(cpu_time, 3),
+        'peak_rss_mb': peak_rss_mb(),
+        'llm_calls': sum(tracker.call_counts.values()),
+        'llm_calls_by_category': {k: v for k, v in tracker.call_counts_by_category.items() if v},
+        'coalesced_calls': sum(tracker.coalesced_calls_by_task.values()),
+        'input_tokens': tracker.total_input_tokens,
+        'output_tokens': tracker.total_output_tokens,
+        'total_tokens': tracker.total_input_tokens + tracker.total_output_tokens,
+        'cost_usd': round(tracker.total_cost, 6),
+        'output_size': output_size,
+    }
+
+
+def copy_tree(data: Dict[str, Any]) -> Dict[str, Any]:
+    return json.loads(json.dumps(data))
+
+
+def run_worker(scenario: str, document_name: str, result_path: str):
+    result = asyncio.run(run_case(scenario, document_name))
+    with open(result_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+
+
+def run_in_subprocess(scenario: str, document_name: str, env: Dict[str, str], timeout: float) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory() as tmp:
+        result_path = os.path.join(tmp, 'result.json')
+        # Fresh emoji cache per case so emoji calls do not depend on earlier runs
+        case_env = {**env, 'EMOJI_CACHE_FILE': os.path.join(tmp, 'emoji_cache.json')}
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', scenario, document_name, result_path],
+            env=case_env, cwd=tmp, capture_output=True, text=True, timeout=timeout
+        )
+        if completed.returncode != 0 or not os.path.exists(result_path):
+            tail = '\n'.join(completed.stderr.strip().splitlines()[-5:])
+            raise RuntimeError(f"{scenario}/{document_name} failed (exit {completed.returncode}):\n{tail}")
+        with open(result_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+
+def summarize(samples: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Median of the timing metrics over repeats; counts are deterministic on the mock provider."""
+    result = dict(samples[0])
+    for metric in ('wall_time_s', 'cpu_time_s', 'peak_rss_mb'):
+        values = [s[metric] for s in samples if s.get(metric) is not None]
+        result[metric] = round(statistics.median(values), 3) if values else None
+    result['repeats'] = len(samples)
+    return result
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any], thresholds: Dict[str, float]) -> List[str]:
+    """Human-readable regressions of `results` against a baseline result file."""
+    baseline_cases = {(r['scenario'], r['document']): r for r in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        base = baseline_cases.get((result['scenario'], result['document']))
+        if not base:
+            continue
+        for metric, threshold in thresholds.items():
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if change > threshold:
+                regressions.append(f"{result['scenario']}/{result['document']}: {metric} {old} -> {new} "
+                                   f"(+{change:.0%}, threshold {threshold:.0%})")
+    return regressions
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma separated subset of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--documents', default=','.join(BUNDLED_DOCUMENTS), help='Bundled documents to run')
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help='Synthetic document sizes in characters (empty for none)')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per case; timings report the median')
+    parser.add_argument('--provider', default='MOCK', choices=('MOCK', 'REPLAY'))
+    parser.add_argument('--latency', type=float, default=0.05, help='Mean MOCK latency in seconds')
+    parser.add_argument('--latency-distribution', default='lognormal')
+    parser.add_argument('--seed', type=int, default=0, help='MOCK seed')
+    parser.add_argument('--timeout', type=float, default=1800, help='Seconds allowed per run')
+    parser.add_argument('--output', help='Write the JSON results to this file (default: stdout)')
+    parser.add_argument('--compare', help='Baseline JSON results to check for regressions')
+    parser.add_argument('--threshold', action='append', default=[], metavar='METRIC=RATIO',
+                        help='Override a regression threshold, e.g. wall_time_s=0.3')
+    parser.add_argument('--worker', nargs=3, metavar=('SCENARIO', 'DOCUMENT', 'RESULT_PATH'), help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.worker:
+        sys.path.insert(0, BASE_DIR)
+        run_worker(*args.worker)
+        return 0
+
+    scenarios = [s for s in args.scenarios.split(',') if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    documents = [d for d in args.documents.split(',') if d]
+    documents += [f"synthetic_{int(size)}" for size in args.sizes.split(',') if size]
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    for item in args.threshold:
+        metric, _, ratio = item.partition('=')
+        thresholds[metric] = float(ratio)
+
+    env = {
+        **os.environ,
+        'PYTHONPATH': os.pathsep.join(filter(None, [BASE_DIR, os.environ.get('PYTHONPATH')])),
+        'API_PROVIDER': args.provider,
+        'API_FALLBACK_PROVIDERS': '',
+        'ENABLE_CHECKPOINTS': 'false',
+        'MOCK_SEED': str(args.seed),
+        'MOCK_LATENCY_MEAN_SECONDS': str(args.latency),
+        'MOCK_LATENCY_DISTRIBUTION': args.latency_distribution,
+    }
+
+    results = []
+    for document_name in documents:
+        for scenario in scenarios:
+            samples = []
+            for _ in range(max(1, args.repeat)):
+                samples.append(run_in_subprocess(scenario, document_name, env, args.timeout))
+            result = summarize(samples)
+            results.append(result)
+            print(f"{scenario:>9} {document_name:<18} {result['wall_time_s']:>8.2f}s wall "
+                  f"{result['cpu_time_s']:>7.2f}s cpu {result['llm_calls']:>5} calls "
+                  f"{result['total_tokens']:>9} tokens {result['peak_rss_mb'] or 0:>7.1f} MB", file=sys.stderr)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'provider': args.provider,
+            'mock_latency_mean_s': args.latency,
+            'mock_latency_distribution': args.latency_distribution,
+            'seed': args.seed,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    else:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), thresholds)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            return 1
+        print("No regressions against baseline", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,7 +4,9 @@
 """
 
 import re
-from typing import List, Dict, Any, Optional
+import os
+import mmap
+from typing import List, Dict, Any, Optional, Iterator
 from dataclasses import dataclass
 import json
 
@@ -19,6 +21,26 @@ class HeadingInfo:
     end_char: int
 
 
+@dataclass
+class SectionSpan:
+    """流式解析得到的章节位置信息（不含正文，正文按需从文件读取）"""
+    level: int
+    title: str
+    raw_heading: str
+    heading_start_byte: int
+    heading_end_byte: int
+    content_start_byte: int
+    content_end_byte: int
+    heading_start_char: int
+    heading_end_char: int
+    content_start_char: int
+    content_end_char: int
+
+
+# UTF-8 续字节（0x80-0xBF），统计字符数时删除这些字节即可
+_UTF8_CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
+
+
 class DocumentNode:
     """文档节点类 - 表示文档的层级结构"""
     
@@ -72,9 +94,14 @@ class DocumentNode:
 class DocumentParser:
     """文档解析器 - 按照用户提供的算法实现"""
     
+    # 流式模式下统计字符偏移时每次读取的最大字节数
+    STREAM_BLOCK_SIZE = 1 << 20
+
     def __init__(self):
         # 匹配Markdown标题的正则表达式
         self.heading_pattern = re.compile(r'^ *(#+)\s+(.*)\s*$', re.MULTILINE)
+        # 流式模式使用的字节版正则：按行匹配，不跨越换行
+        self.heading_pattern_bytes = re.compile(rb'^ *(#+)[ \t]+(.*?)[ \t\r]*$', re.MULTILINE)
     
     def parse_document(self, markdown_text: str, document_id: str = "doc") -> DocumentNode:
         """
@@ -296,6 +323,93 @@ class DocumentParser:
         
         return chunks
     
+    def iter_sections_from_file(self, file_path: str) -> Iterator[SectionSpan]:
+        """
+        流式解析UTF-8 Markdown文件，按文档顺序逐个产出章节位置
+
+        基于mmap直接在文件映射上匹配标题，不把整个文件读成str；
+        字符偏移按固定大小的块累计，峰值内存与文件大小无关。
+        标题按行匹配，章节内容范围为标题行之后到下一个标题之前，
+        与 parse_document 中 content_start/end 的含义一致（未strip）。
+
+        Args:
+            file_path: Markdown文件路径
+
+        Yields:
+            SectionSpan: 章节的标题与内容的字节/字符偏移
+        """
+        with open(file_path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            if file_size == 0:
+                return
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                byte_pos = 0
+                char_pos = 0
+                pending = None
+
+                # 前言（第一个标题前的内容）
+                first_match = self.heading_pattern_bytes.search(mm)
+                if first_match is None or first_match.start() > 0:
+                    pending = {
+                        'level': 1,
+                        'title': "引言",
+                        'raw_heading': "",
+                        'heading_start_byte': 0,
+                        'heading_end_byte': 0,
+                        'heading_start_char': 0,
+                        'heading_end_char': 0,
+                    }
+
+                for match in self.heading_pattern_bytes.finditer(mm):
+                    start_char = char_pos + self._count_chars(mm, byte_pos, match.start())
+                    if pending is not None:
+                        yield self._close_section(pending, match.start(), start_char)
+
+                    raw_heading = match.group(0).decode('utf-8', errors='replace').strip()
+                    end_char = start_char + len(match.group(0).decode('utf-8', errors='replace'))
+                    pending = {
+                        'level': len(match.group(1)),
+                        'title': match.group(2).decode('utf-8', errors='replace').strip(),
+                        'raw_heading': raw_heading,
+                        'heading_start_byte': match.start(),
+                        'heading_end_byte': match.end(),
+                        'heading_start_char': start_char,
+                        'heading_end_char': end_char,
+                    }
+                    byte_pos = match.end()
+                    char_pos = end_char
+
+                if pending is not None:
+                    end_char = char_pos + self._count_chars(mm, byte_pos, file_size)
+                    yield self._close_section(pending, file_size, end_char)
+
+    def read_section_content(self, file_path: str, section: SectionSpan) -> str:
+        """按字节范围读取单个章节的正文内容（已strip）"""
+        with open(file_path, 'rb') as f:
+            f.seek(section.content_start_byte)
+            data = f.read(section.content_end_byte - section.content_start_byte)
+        return data.decode('utf-8', errors='replace').strip()
+
+    def _count_chars(self, mm: mmap.mmap, start: int, end: int) -> int:
+        """分块统计 [start, end) 字节范围内的UTF-8字符数"""
+        count = 0
+        for block_start in range(start, end, self.STREAM_BLOCK_SIZE):
+            block = mm[block_start:min(block_start + self.STREAM_BLOCK_SIZE, end)]
+            count += len(block.translate(None, _UTF8_CONTINUATION_BYTES))
+        return count
+
+    @staticmethod
+    def _close_section(pending: Dict[str, Any], end_byte: int, end_char: int) -> SectionSpan:
+        """以下一个标题（或文件末尾）为边界，补全章节内容范围"""
+        return SectionSpan(
+            content_start_byte=pending['heading_end_byte'],
+            content_end_byte=end_byte,
+            content_start_char=pending['heading_end_char'],
+            content_end_char=end_char,
+            **pending
+        )
+
     def generate_toc(self, root: DocumentNode) -> List[Dict[str, Any]]:
         """
         生成目录结构，用于前端显示
@@ -0,0 +1,133 @@
+"""Record real LLM sessions and replay them offline.
+
+SessionRecorder appends one JSON line per provider call (prompt hash, response, usage, latency,
+provider) to a gzip file. ReplayLLMProvider serves those calls back for the REPLAY provider of
+DocumentOptimizer: identical prompts get the recorded responses in recorded order, optionally
+after the recorded latency, so call counts, concurrency and wall time of a pipeline change can be
+compared against realistic traffic without calling the API again.
+"""
+import gzip
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from typing import Any, Dict, List
+
+logger = logging.getLogger(__name__)
+
+RECORD_FORMAT_VERSION = 1
+
+
+class ReplayMissError(RuntimeError):
+    """The replayed session has no recorded response for this prompt."""
+
+
+def prompt_key(prompt: str, max_tokens: int) -> str:
+    """Identity of a call: the full prompt text sent to the provider and its token limit."""
+    return hashlib.sha256(f"{max_tokens}\x00{prompt}".encode()).hexdigest()
+
+
+class SessionRecorder:
+    """Append-only gzip JSONL log of provider calls.
+
+    The file stays open and is flushed after every record, so a crashed run keeps everything
+    recorded so far. Appending to an existing file adds a new gzip member, which readers
+    handle transparently.
+    """
+    def __init__(self, path: str, include_prompts: bool = False):
+        self.path = path
+        self.include_prompts = include_prompts
+        self.records = 0
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+
+    def record(self, prompt: str, max_tokens: int, task: str, provider: str, response: str,
+               input_tokens: int, output_tokens: int, cache_read_tokens: int = 0,
+               cache_write_tokens: int = 0, latency: float = 0.0):
+        if self._file is None:
+            return
+        entry = {
+            'v': RECORD_FORMAT_VERSION,
+            'key': prompt_key(prompt, max_tokens),
+            'task': task,
+            'provider': provider,
+            'response': response,
+            'usage': [input_tokens, output_tokens, cache_read_tokens, cache_write_tokens],
+            'latency': round(latency, 4),
+            'ts': round(time.time(), 3)
+        }
+        if self.include_prompts:
+            entry['prompt'] = prompt
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file.flush()
+        self.records += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def load_session(path: str) -> List[Dict[str, Any]]:
+    """Read every record of a session file, tolerating a truncated tail from an interrupted run."""
+    records = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+        except (EOFError, json.JSONDecodeError) as e:
+            logger.warning(f"Session file {path} is truncated, replaying {len(records)} records: {e}")
+    return records
+
+
+class ReplayLLMProvider:
+    """Serve recorded responses for prompts seen in a session file.
+
+    Args:
+        path: Session file written by SessionRecorder
+        latency_scale: Multiplier for the recorded latencies (0 replays without waiting). Some
+            prompts depend on the order in which concurrent calls finish (e.g. similarity checks
+            against already accepted items), so scales far from 1 can cause misses
+        fallback: Called as fallback(prompt, max_tokens, task) for prompts missing from the
+            session (e.g. MockLLMProvider.complete after a prompt changed); without one a miss
+            raises ReplayMissError
+    """
+    def __init__(self, path: str, latency_scale: float = 1.0, fallback=None):
+        self.path = path
+        self.latency_scale = latency_scale
+        self.fallback = fallback
+        self._responses: Dict[str, List[Dict[str, Any]]] = {}
+        self._served: Dict[str, int] = {}
+        for entry in load_session(path):
+            self._responses.setdefault(entry['key'], []).append(entry)
+        self.hits = 0
+        self.misses = 0
+        logger.info(f"Loaded {sum(len(v) for v in self._responses.values())} recorded calls "
+                    f"({len(self._responses)} distinct prompts) from {path}")
+
+    async def complete(self, prompt: str, max_tokens: int, task: str) -> Dict[str, Any]:
+        """Recorded call for this prompt: dict with response, usage, provider and latency.
+
+        Repeated prompts receive their recorded responses in order; once those run out the
+        last one is repeated.
+        """
+        key = prompt_key(prompt, max_tokens)
+        entries = self._responses.get(key)
+        if not entries:
+            self.misses += 1
+            if self.fallback is None:
+                raise ReplayMissError(f"No recorded response for {task} (key {key[:12]})")
+            response, input_tokens, output_tokens = await self.fallback(prompt, max_tokens, task)
+            return {'response': response, 'usage': [input_tokens, output_tokens, 0, 0],
+                    'provider': None, 'latency': 0.0}
+        index = self._served.get(key, 0)
+        self._served[key] = index + 1
+        entry = entries[min(index, len(entries) - 1)]
+        self.hits += 1
+        if self.latency_scale > 0 and entry.get('latency'):
+            await asyncio.sleep(entry['latency'] * self.latency_scale)
+        return entry
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'recorded_prompts': len(self._responses)}
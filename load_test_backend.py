@@ -0,0 +1,309 @@
+"""Load test for the FastAPI backend (web_backend.app) on the MOCK LLM provider.
+
+Simulates N concurrent users, each doing:
+    upload document -> generate argument structure -> poll document status -> add node
+
+By default the app runs in this process through httpx's ASGI transport, so the run needs no server
+and event-loop lag can be measured: a monitor task sleeps in short intervals and records how late it
+wakes up, which exposes blocking calls (PDF conversion, synchronous file writes, CPU-heavy parsing)
+that stall every other request. With --base-url the same scenario is sent to a running server
+(start it with API_PROVIDER=MOCK); event-loop lag is then not available.
+
+    python load_test_backend.py --users 20 --ramp-up 5 --output load.json
+    python load_test_backend.py --users 50 --base-url http://localhost:8000
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_DOCUMENT = os.path.join(BASE_DIR, 'sample_input_document_as_markdown__small.md')
+# Concrete paths are folded into their route so latencies are reported per endpoint
+ROUTE_PATTERNS = [
+    (re.compile(r'^/api/document-status/[^/]+$'), 'GET /api/document-status/{id}'),
+    (re.compile(r'^/api/generate-argument-structure/[^/]+$'), 'POST /api/generate-argument-structure/{id}'),
+    (re.compile(r'^/api/document/[^/]+/node/add$'), 'POST /api/document/{id}/node/add'),
+    (re.compile(r'^/api/upload-document$'), 'POST /api/upload-document'),
+]
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def latency_summary(values: List[float]) -> Dict[str, Optional[float]]:
+    """Percentiles in milliseconds."""
+    summary = {
+        f"p{p}_ms": round(percentile(values, p) * 1000, 1) if values else None
+        for p in (50, 90, 95, 99)
+    }
+    summary['max_ms'] = round(max(values) * 1000, 1) if values else None
+    return summary
+
+
+class LoadStats:
+    """Latencies and outcomes per endpoint, plus per-user flow outcomes."""
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.status_codes: Dict[str, Dict[str, int]] = {}
+        self.flows_completed = 0
+        self.flow_errors: Dict[str, int] = {}
+        self.flow_times: List[float] = []
+
+    def record(self, route: str, elapsed: float, status_code: Optional[int]):
+        self.latencies.setdefault(route, []).append(elapsed)
+        codes = self.status_codes.setdefault(route, {})
+        key = str(status_code) if status_code is not None else 'exception'
+        codes[key] = codes.get(key, 0) + 1
+        if status_code is None or status_code >= 400:
+            self.errors[route] = self.errors.get(route, 0) + 1
+
+    def flow_failed(self, stage: str):
+        self.flow_errors[stage] = self.flow_errors.get(stage, 0) + 1
+
+    def report(self) -> Dict[str, Any]:
+        endpoints = {}
+        for route, values in sorted(self.latencies.items()):
+            errors = self.errors.get(route, 0)
+            endpoints[route] = {
+                'requests': len(values),
+                'errors': errors,
+                'error_rate': round(errors / len(values), 4),
+                'status_codes': self.status_codes.get(route, {}),
+                **latency_summary(values),
+            }
+        return {
+            'endpoints': endpoints,
+            'flows': {
+                'completed': self.flows_completed,
+                'failed': sum(self.flow_errors.values()),
+                'failed_by_stage': self.flow_errors,
+                'duration': latency_summary(self.flow_times),
+            }
+        }
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes a task that sleeps `interval` seconds."""
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.lags: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - start - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            'interval_ms': self.interval * 1000,
+            'samples': len(self.lags),
+            'stalls_over_100ms': sum(1 for lag in self.lags if lag > 0.1),
+            **latency_summary(self.lags),
+        }
+
+
+def route_of(method: str, path: str) -> str:
+    for pattern, route in ROUTE_PATTERNS:
+        if pattern.match(path):
+            return route
+    return f"{method} {path}"
+
+
+async def timed_request(client: httpx.AsyncClient, stats: LoadStats, method: str, path: str,
+                        **kwargs) -> Optional[httpx.Response]:
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, path, **kwargs)
+    except httpx.HTTPError:
+        stats.record(route_of(method, path), time.perf_counter() - start, None)
+        return None
+    stats.record(route_of(method, path), time.perf_counter() - start, response.status_code)
+    return response
+
+
+async def user_flow(user_id: int, client: httpx.AsyncClient, stats: LoadStats, document: str,
+                    poll_interval: float, analysis_timeout: float):
+    """One simulated user: upload, start the analysis, poll until it finishes, add a node."""
+    flow_start = time.perf_counter()
+    # A per-user marker makes every upload a distinct document (distinct id and prompt)
+    content = f"{document}\n\nLoad test user {user_id}.\n".encode('utf-8')
+    response = await timed_request(client, stats, 'POST', '/api/upload-document',
+                                   files={'file': (f"load_user_{user_id}.md", content, 'text/markdown')})
+    if response is None or response.status_code != 200:
+        stats.flow_failed('upload')
+        return
+    document_id = response.json()['document_id']
+
+    response = await timed_request(client, stats, 'POST', f"/api/generate-argument-structure/{document_id}")
+    if response is None or response.status_code != 200:
+        stats.flow_failed('generate')
+        return
+
+    deadline = time.perf_counter() + analysis_timeout
+    status = {}
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(poll_interval)
+        response = await timed_request(client, stats, 'GET', f"/api/document-status/{document_id}")
+        if response is None or response.status_code != 200:
+            continue
+        status = response.json()
+        if status.get('status_demo') in ('completed', 'error'):
+            break
+    if status.get('status_demo') != 'completed':
+        stats.flow_failed('analysis_error' if status.get('status_demo') == 'error' else 'analysis_timeout')
+        return
+
+    node_ids = sorted(status.get('node_mappings_demo') or {})
+    if not node_ids:
+        stats.flow_failed('no_nodes')
+        return
+    response = await timed_request(client, stats, 'POST', f"/api/document/{document_id}/node/add",
+                                   json={'sourceNodeId': node_ids[0], 'direction': 'child', 'label': f"用户{user_id}"})
+    if response is None or response.status_code != 200 or not response.json().get('success'):
+        stats.flow_failed('add_node')
+        return
+    stats.flows_completed += 1
+    stats.flow_times.append(time.perf_counter() - flow_start)
+
+
+async def run_load_test(args: argparse.Namespace) -> Dict[str, Any]:
+    with open(args.document, 'r', encoding='utf-8') as f:
+        document = f.read()
+
+    monitor = None
+    if args.base_url:
+        transport = None
+        base_url = args.base_url.rstrip('/')
+    else:
+        # The app reads its provider settings at import time, and writes uploads relative to the cwd
+        os.environ['API_PROVIDER'] = 'MOCK'
+        os.environ['API_FALLBACK_PROVIDERS'] = ''
+        os.environ['MOCK_SEED'] = str(args.seed)
+        os.environ['MOCK_LATENCY_MEAN_SECONDS'] = str(args.latency)
+        os.environ.setdefault('EMOJI_CACHE_FILE', os.path.join(os.getcwd(), 'emoji_cache.json'))
+        sys.path.insert(0, BASE_DIR)
+        from web_backend import app
+        transport = httpx.ASGITransport(app=app)
+        base_url = 'http://load-test'
+        monitor = LoopLagMonitor(args.lag_interval)
+        monitor.start()
+
+    stats = LoadStats()
+    rng = random.Random(args.seed)
+    start_delays = sorted(rng.uniform(0, args.ramp_up) for _ in range(args.users))
+    limits = httpx.Limits(max_connections=args.users * 2, max_keepalive_connections=args.users)
+
+    async def delayed_user(user_id: int, delay: float):
+        await asyncio.sleep(delay)
+        await user_flow(user_id, client, stats, document, args.poll_interval, args.analysis_timeout)
+
+    started = time.perf_counter()
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, limits=limits,
+                                 timeout=args.request_timeout) as client:
+        await asyncio.gather(*(delayed_user(i, delay) for i, delay in enumerate(start_delays)))
+    duration = time.perf_counter() - started
+    if monitor:
+        await monitor.stop()
+
+    report = stats.report()
+    total_requests = sum(e['requests'] for e in report['endpoints'].values())
+    total_errors = sum(e['errors'] for e in report['endpoints'].values())
+    return {
+        'meta': {
+            'users': args.users,
+            'ramp_up_s': args.ramp_up,
+            'target': args.base_url or 'in-process',
+            'mock_latency_mean_s': None if args.base_url else args.latency,
+            'seed': args.seed,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'duration_s': round(duration, 2),
+        'requests': total_requests,
+        'requests_per_s': round(total_requests / duration, 2) if duration else None,
+        'error_rate': round(total_errors / total_requests, 4) if total_requests else None,
+        **report,
+        'event_loop_lag': monitor.report() if monitor else None,
+    }
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"\n{report['meta']['users']} users, {report['duration_s']}s, {report['requests']} requests "
+          f"({report['requests_per_s']}/s), error rate {report['error_rate']:.2%}", file=sys.stderr)
+    print(f"{'endpoint':<45} {'reqs':>6} {'err%':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}", file=sys.stderr)
+    for route, e in report['endpoints'].items():
+        print(f"{route:<45} {e['requests']:>6} {e['error_rate']:>6.1%} {e['p50_ms']:>8} {e['p95_ms']:>8} "
+              f"{e['p99_ms']:>8} {e['max_ms']:>8}", file=sys.stderr)
+    flows = report['flows']
+    print(f"flows: {flows['completed']} completed, {flows['failed']} failed {flows['failed_by_stage'] or ''}",
+          file=sys.stderr)
+    lag = report.get('event_loop_lag')
+    if lag:
+        print(f"event loop lag (ms): p50 {lag['p50_ms']} p99 {lag['p99_ms']} max {lag['max_ms']}, "
+              f"{lag['stalls_over_100ms']} stalls over 100ms", file=sys.stderr)
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10, help='Concurrent simulated users')
+    parser.add_argument('--ramp-up', type=float, default=2.0, help='Seconds over which users start')
+    parser.add_argument('--document', default=SAMPLE_DOCUMENT, help='Markdown document every user uploads')
+    parser.add_argument('--base-url', help='Test a running server instead of the in-process app')
+    parser.add_argument('--latency', type=float, default=0.5, help='Mean MOCK latency in seconds (in-process)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between status polls')
+    parser.add_argument('--analysis-timeout', type=float, default=300, help='Seconds a user waits for the analysis')
+    parser.add_argument('--request-timeout', type=float, default=60)
+    parser.add_argument('--lag-interval', type=float, default=0.05, help='Event-loop lag sampling interval')
+    parser.add_argument('--workdir', help='Working directory for uploads in-process (default: a temp dir)')
+    parser.add_argument('--output', help='Write the JSON report to this file')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    args.document = os.path.abspath(args.document)
+    output = os.path.abspath(args.output) if args.output else None
+    with tempfile.TemporaryDirectory() as tmp:
+        if not args.base_url:
+            os.chdir(args.workdir or tmp)
+        report = asyncio.run(run_load_test(args))
+    print_report(report)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    else:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    return 1 if report['flows']['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
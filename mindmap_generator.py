@@ -1,5 +1,6 @@
 import re
 import os
+import ast
 import random
 import json
 import time
@@ -9,27 +10,56 @@ import base64
 import zlib
 import logging
 import copy
+import atexit
+import math
+import functools
+import weakref
+import contextvars
+import contextlib
+import threading
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from dataclasses import dataclass, field
 from datetime import datetime
-from enum import Enum, auto
-from typing import Dict, Any, List, Union, Optional, Tuple, Set
+from enum import Enum, IntEnum, auto
+from typing import Dict, Any, List, Union, Optional, Tuple, Set, Callable, AsyncIterator, TYPE_CHECKING
 from termcolor import colored
 import aiofiles
-from openai import AsyncOpenAI
-from anthropic import AsyncAnthropic
+import httpx
 from fuzzywuzzy import fuzz
 import os
 from dotenv import load_dotenv
+from document_parser import DocumentParser
+from mock_llm_provider import MockLLMProvider
+from llm_replay import SessionRecorder, ReplayLLMProvider
+import metrics
+
+# Provider SDKs are imported when their first client is created (get_llm_client), so importing
+# this module stays fast and providers that are not configured are never loaded
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    from anthropic import AsyncAnthropic
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Import Google Generative AI with error handling
-try:
-    import google.generativeai as genai
-    GOOGLE_AI_AVAILABLE = True
-except ImportError:
-    GOOGLE_AI_AVAILABLE = False
-    genai = None
+def _module_available(name: str) -> bool:
+    """Whether a module can be imported, without importing it."""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+# Google Generative AI is only checked for here and imported on first use (see _get_gemini_model)
+GOOGLE_AI_AVAILABLE = _module_available("google.generativeai")
+genai = None
+
+# HTTP/2 for the shared LLM connection pool needs the optional h2 package, which httpx imports itself
+H2_AVAILABLE = _module_available("h2")
+
+# tiktoken gives exact OpenAI token counts; it is imported and its encoding loaded on first count
+TIKTOKEN_AVAILABLE = _module_available("tiktoken")
 
 def get_logger():
     """Mindmap-specific logger with colored output for generation stages."""
@@ -111,10 +141,12 @@ class Config:
     DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY')
     GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')  # Add Gemini API key
     OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')  # Add OpenRouter API key
-    API_PROVIDER = os.getenv('API_PROVIDER') # "OPENAI", "CLAUDE", "DEEPSEEK", "GEMINI", or "OPENROUTER"
+    API_PROVIDER = os.getenv('API_PROVIDER') # "OPENAI", "CLAUDE", "DEEPSEEK", "GEMINI", "OPENROUTER", "MOCK", or "REPLAY"
     
     # Model settings
     CLAUDE_MODEL_STRING = "claude-3-5-haiku-latest"
+    # Anthropic only caches prompt prefixes of at least this many tokens (2048 for Haiku models, 1024 otherwise)
+    ANTHROPIC_MIN_CACHE_TOKENS = 2048 if 'haiku' in CLAUDE_MODEL_STRING else 1024
     OPENAI_COMPLETION_MODEL = "gpt-4o-mini-2024-07-18"
     DEEPSEEK_COMPLETION_MODEL = "deepseek-chat"  # "deepseek-reasoner" or "deepseek-chat"
     DEEPSEEK_CHAT_MODEL = "deepseek-chat"
@@ -125,9 +157,58 @@ class Config:
     OPENAI_MAX_TOKENS = 8192
     DEEPSEEK_MAX_TOKENS = 8192
     GEMINI_MAX_TOKENS = 8192  # Add Gemini max tokens
+    GEMINI_MAX_WORKERS = int(os.getenv('GEMINI_MAX_WORKERS', 8))  # Threads for the blocking Gemini client fallback
     OPENROUTER_MAX_TOKENS = 8192  # Add OpenRouter max tokens
+    
+    # Offline MOCK provider (see mock_llm_provider.py): deterministic canned answers, priced like OPENAI
+    MOCK_SEED = int(os.getenv('MOCK_SEED', 0))
+    MOCK_LATENCY_DISTRIBUTION = os.getenv('MOCK_LATENCY_DISTRIBUTION', 'lognormal')  # constant, uniform, exponential, lognormal
+    MOCK_LATENCY_MEAN_SECONDS = float(os.getenv('MOCK_LATENCY_MEAN_SECONDS', 1.0))
+    MOCK_LATENCY_SPREAD = float(os.getenv('MOCK_LATENCY_SPREAD', 0.5))  # Uniform half-width ratio or lognormal sigma
+    MOCK_LATENCY_PER_OUTPUT_TOKEN_SECONDS = float(os.getenv('MOCK_LATENCY_PER_OUTPUT_TOKEN_SECONDS', 0.0))
+    MOCK_ERROR_RATE = float(os.getenv('MOCK_ERROR_RATE', 0.0))
+    MOCK_RATE_LIMIT_RATE = float(os.getenv('MOCK_RATE_LIMIT_RATE', 0.0))  # Share of calls rejected with a 429
+    MOCK_REDUNDANT_RATE = float(os.getenv('MOCK_REDUNDANT_RATE', 0.2))
+    MOCK_VERIFY_RATE = float(os.getenv('MOCK_VERIFY_RATE', 0.9))
+    
+    # Record/replay of real sessions (see llm_replay.py): LLM_RECORD_FILE logs every provider call,
+    # API_PROVIDER=REPLAY serves the calls recorded in LLM_REPLAY_FILE
+    LLM_RECORD_FILE = os.getenv('LLM_RECORD_FILE')  # e.g. sessions/memo.jsonl.gz
+    LLM_RECORD_PROMPTS = os.getenv('LLM_RECORD_PROMPTS', 'false').lower() == 'true'  # Store prompt text, not just its hash
+    LLM_REPLAY_FILE = os.getenv('LLM_REPLAY_FILE')
+    LLM_REPLAY_LATENCY_SCALE = float(os.getenv('LLM_REPLAY_LATENCY_SCALE', 1.0))  # 0 replays without the recorded waits
+    LLM_REPLAY_MOCK_ON_MISS = os.getenv('LLM_REPLAY_MOCK_ON_MISS', 'false').lower() == 'true'  # Else unrecorded prompts fail
+    
+    # Shared HTTP connection pool used by every LLM SDK client in the process
+    HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 100))
+    HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('HTTP_MAX_KEEPALIVE_CONNECTIONS', 50))
+    HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv('HTTP_KEEPALIVE_EXPIRY_SECONDS', 120))
+    HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv('HTTP_CONNECT_TIMEOUT_SECONDS', 10))
+    HTTP_READ_TIMEOUT_SECONDS = float(os.getenv('HTTP_READ_TIMEOUT_SECONDS', 300))
+    HTTP2_ENABLED = os.getenv('HTTP2_ENABLED', 'true').lower() == 'true'  # Used only if h2 is installed
     TOKEN_BUFFER = 500
     
+    # Chunking settings (in tokens of the active provider)
+    CHUNK_MAX_TOKENS = int(os.getenv('CHUNK_MAX_TOKENS', 2000))  # Upper bound per chunk (~8000 English chars)
+    CHUNK_SMALL_DOC_TOKENS = 1500  # Documents up to this size use CHUNK_SMALL_DOC_CHUNK_TOKENS
+    CHUNK_SMALL_DOC_CHUNK_TOKENS = 1000
+    
+    # Relevance filtering: number of BM25-ranked chunks sent per topic/subtopic
+    RETRIEVAL_TOP_K_SUBTOPICS = int(os.getenv('RETRIEVAL_TOP_K_SUBTOPICS', 4))
+    RETRIEVAL_TOP_K_DETAILS = int(os.getenv('RETRIEVAL_TOP_K_DETAILS', 2))
+    
+    # Stage-level checkpoints so an interrupted generate_mindmap can resume; logs of runs that
+    # never completed are removed once they are older than CHECKPOINT_MAX_AGE_HOURS
+    ENABLE_CHECKPOINTS = os.getenv('ENABLE_CHECKPOINTS', 'false').lower() == 'true'
+    CHECKPOINT_DIR = os.getenv('CHECKPOINT_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mindmap_checkpoints')
+    CHECKPOINT_MAX_AGE_HOURS = float(os.getenv('CHECKPOINT_MAX_AGE_HOURS', 24))
+    
+    # Incremental regeneration: last verified mindmap per document, and the share of
+    # changed sections above which a full regeneration is cheaper than patching
+    ENABLE_SNAPSHOTS = os.getenv('ENABLE_SNAPSHOTS', 'true').lower() == 'true'
+    SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mindmap_snapshots')
+    INCREMENTAL_MAX_CHANGED_RATIO = float(os.getenv('INCREMENTAL_MAX_CHANGED_RATIO', 0.5))
+    
     # Cost tracking (prices in USD per token)
     OPENAI_INPUT_TOKEN_PRICE = 0.15/1000000  # GPT-4o-mini input price
     OPENAI_OUTPUT_TOKEN_PRICE = 0.60/1000000  # GPT-4o-mini output price
@@ -141,15 +222,92 @@ class Config:
     GEMINI_OUTPUT_TOKEN_PRICE = 0.30/1000000  # Gemini 2.0 Flash Lite output price estimate
     OPENROUTER_INPUT_TOKEN_PRICE = 1.25/1000000  # Gemini 2.5 Pro input price via OpenRouter
     OPENROUTER_OUTPUT_TOKEN_PRICE = 5.00/1000000  # Gemini 2.5 Pro output price via OpenRouter
+    # Prompt-cache prices (cached prefix reads, and Anthropic cache writes)
+    OPENAI_CACHED_INPUT_TOKEN_PRICE = 0.075/1000000  # GPT-4o-mini cached input price
+    ANTHROPIC_CACHE_READ_PRICE = 0.08/1000000  # Claude 3.5 Haiku cache hit price
+    ANTHROPIC_CACHE_WRITE_PRICE = 1.00/1000000  # Claude 3.5 Haiku 5-minute cache write price
+    DEEPSEEK_CHAT_CACHE_HIT_PRICE = 0.07/1000000  # Chat input price (cache hit)
+    DEEPSEEK_REASONER_CACHE_HIT_PRICE = 0.14/1000000  # Reasoner input price (cache hit)
+    GEMINI_CACHED_INPUT_TOKEN_PRICE = 0.01875/1000000  # Gemini 2.0 Flash Lite cached input estimate
+    OPENROUTER_CACHED_INPUT_TOKEN_PRICE = 0.31/1000000  # Gemini 2.5 Pro cached input via OpenRouter
+    
+    # Provider routing: providers tried after API_PROVIDER, in order (comma separated),
+    # and hedging a slow request to the next provider once it exceeds its p95 latency
+    API_FALLBACK_PROVIDERS = [p.strip().upper() for p in os.getenv('API_FALLBACK_PROVIDERS', '').split(',') if p.strip()]
+    ENABLE_HEDGED_REQUESTS = os.getenv('ENABLE_HEDGED_REQUESTS', 'true').lower() == 'true'
+    HEDGE_LATENCY_PERCENTILE = 95
+    HEDGE_MIN_SAMPLES = 20  # Latency samples needed before the percentile is trusted
+    HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv('HEDGE_DEFAULT_DELAY_SECONDS', 30))
+    
+    # Log each request's timing tree (stages and LLM calls) when generation finishes
+    LOG_TIMING_REPORT = os.getenv('LOG_TIMING_REPORT', 'true').lower() == 'true'
+    
+    # Per-request budget of one mindmap generation (0 = unlimited). Past each fraction of the
+    # budget the pipeline degrades one more step; at 100% further LLM calls are rejected
+    BUDGET_MAX_COST_USD = float(os.getenv('BUDGET_MAX_COST_USD', 0))
+    BUDGET_MAX_SECONDS = float(os.getenv('BUDGET_MAX_SECONDS', 0))
+    BUDGET_MAX_TOKENS = int(os.getenv('BUDGET_MAX_TOKENS', 0))
+    BUDGET_SKIP_EMOJI_AT = float(os.getenv('BUDGET_SKIP_EMOJI_AT', 0.5))
+    BUDGET_LEXICAL_DEDUP_AT = float(os.getenv('BUDGET_LEXICAL_DEDUP_AT', 0.6))
+    BUDGET_SKIP_VERIFICATION_AT = float(os.getenv('BUDGET_SKIP_VERIFICATION_AT', 0.75))
+    BUDGET_SIMPLE_FALLBACK_AT = float(os.getenv('BUDGET_SIMPLE_FALLBACK_AT', 0.9))
+    
+    # Strategy planner of generate_mindmap_auto: short documents get the one-call simple mode,
+    # large or heavily sectioned ones the full pipeline, the rest the hybrid mode.
+    # A busy or slow provider moves the choice one step towards simple
+    PLANNER_SIMPLE_MAX_TOKENS = int(os.getenv('PLANNER_SIMPLE_MAX_TOKENS', 1000))
+    PLANNER_FULL_MIN_TOKENS = int(os.getenv('PLANNER_FULL_MIN_TOKENS', 4000))
+    PLANNER_FULL_MIN_SECTIONS = int(os.getenv('PLANNER_FULL_MIN_SECTIONS', 12))
+    PLANNER_BUSY_INFLIGHT_CALLS = int(os.getenv('PLANNER_BUSY_INFLIGHT_CALLS', 40))
+    PLANNER_SLOW_LATENCY_SECONDS = float(os.getenv('PLANNER_SLOW_LATENCY_SECONDS', 20))
+    
+    # Per-provider circuit breaker: opens when the error rate over the window is too high
+    CIRCUIT_WINDOW_SECONDS = float(os.getenv('CIRCUIT_WINDOW_SECONDS', 60))
+    CIRCUIT_MIN_REQUESTS = int(os.getenv('CIRCUIT_MIN_REQUESTS', 5))  # Calls in the window before the rate counts
+    CIRCUIT_ERROR_RATE_THRESHOLD = float(os.getenv('CIRCUIT_ERROR_RATE_THRESHOLD', 0.5))
+    CIRCUIT_OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', 30))  # Cool-down before a half-open probe
+
+# Process-wide metrics served by the backend's /metrics endpoint (Prometheus text format).
+# Gauges with callbacks read state that already lives elsewhere when they are scraped.
+LLM_CALLS = metrics.counter('mindmap_llm_calls_total', 'Provider calls by outcome', ('provider', 'category', 'outcome'))
+LLM_CALL_SECONDS = metrics.histogram('mindmap_llm_call_duration_seconds', 'Provider call latency', ('provider', 'category'))
+LLM_TOKENS = metrics.counter('mindmap_llm_tokens_total', 'Tokens billed by providers', ('provider', 'category', 'type'))
+LLM_COST = metrics.counter('mindmap_llm_cost_usd_total', 'Estimated cost of provider calls in USD', ('provider', 'category'))
+LLM_COALESCED = metrics.counter('mindmap_llm_coalesced_calls_total', 'Calls served by an identical in-flight request', ('category',))
+CACHE_LOOKUPS = metrics.counter('mindmap_cache_lookups_total', 'Cache lookups by cache and result', ('cache', 'result'))
+ACTIVE_RUNS = metrics.gauge('mindmap_active_runs', 'Generation runs in progress')
+
+
+def _cache_hit_ratios() -> Dict[Tuple[str], float]:
+    lookups = dict(CACHE_LOOKUPS.items())
+    ratios = {}
+    for cache in {cache for cache, _ in lookups}:
+        hits = lookups.get((cache, 'hit'), 0)
+        ratios[(cache,)] = hits / (hits + lookups.get((cache, 'miss'), 0))
+    return ratios
+
+metrics.gauge('mindmap_cache_hit_ratio', 'Hit ratio of each cache since start', ('cache',), callback=_cache_hit_ratios)
+metrics.gauge('mindmap_llm_inflight_calls', 'Distinct provider requests in flight (after coalescing)',
+              callback=lambda: len(_inflight_completions))
+GEMINI_QUEUE_DEPTH = metrics.gauge('mindmap_gemini_executor_queue_depth', 'Gemini calls waiting for a worker thread')
+metrics.gauge('mindmap_circuit_open', 'Whether a provider circuit is open (1) or half-open (0.5)', ('provider',),
+              callback=lambda: {(provider, ): {CircuitState.CLOSED: 0, CircuitState.HALF_OPEN: 0.5, CircuitState.OPEN: 1}[breaker.state]
+                                for provider, breaker in list(_circuit_breakers.items())})
 
 class TokenUsageTracker:
     def __init__(self):
         self.total_input_tokens = 0
         self.total_output_tokens = 0
+        self.total_cache_read_tokens = 0
+        self.total_cache_write_tokens = 0
+        self.total_cache_savings = 0
         self.total_cost = 0
         self.call_counts = {}
         self.token_counts_by_task = {}
         self.cost_by_task = {}
+        self.call_counts_by_provider = {}
+        self.cost_by_provider = {}
+        self.coalesced_calls_by_task = {}  # Duplicate in-flight prompts served by another caller's request
         
         # Categorize tasks for better reporting
         self.task_categories = {
@@ -159,6 +317,7 @@ class TokenUsageTracker:
             'similarity': ['checking_content_similarity'],
             'verification': ['verifying_against_source'],
             'emoji': ['selecting_emoji'],
+            'argument': ['分析论证结构'],
             'other': []  # Catch-all for uncategorized tasks
         }
         
@@ -167,48 +326,66 @@ class TokenUsageTracker:
         self.token_counts_by_category = {category: {'input': 0, 'output': 0} for category in self.task_categories}
         self.cost_by_category = {category: 0 for category in self.task_categories}
         
-    def update(self, input_tokens: int, output_tokens: int, task: str):
-        """Update token usage with enhanced task categorization."""
+    @staticmethod
+    def token_prices(provider: str) -> Tuple[float, float, float, float]:
+        """(input, output, cache read, cache write) price per token for a provider."""
+        if provider == "CLAUDE":
+            return (Config.ANTHROPIC_INPUT_TOKEN_PRICE, Config.ANTHROPIC_OUTPUT_TOKEN_PRICE,
+                    Config.ANTHROPIC_CACHE_READ_PRICE, Config.ANTHROPIC_CACHE_WRITE_PRICE)
+        elif provider == "DEEPSEEK":
+            # Different pricing for chat vs reasoner model; DeepSeek does not charge cache writes
+            if Config.DEEPSEEK_COMPLETION_MODEL == Config.DEEPSEEK_CHAT_MODEL:
+                return (Config.DEEPSEEK_CHAT_INPUT_PRICE, Config.DEEPSEEK_CHAT_OUTPUT_PRICE,
+                        Config.DEEPSEEK_CHAT_CACHE_HIT_PRICE, Config.DEEPSEEK_CHAT_INPUT_PRICE)
+            else:  # reasoner model
+                return (Config.DEEPSEEK_REASONER_INPUT_PRICE, Config.DEEPSEEK_REASONER_OUTPUT_PRICE,
+                        Config.DEEPSEEK_REASONER_CACHE_HIT_PRICE, Config.DEEPSEEK_REASONER_INPUT_PRICE)
+        elif provider == "GEMINI":
+            return (Config.GEMINI_INPUT_TOKEN_PRICE, Config.GEMINI_OUTPUT_TOKEN_PRICE,
+                    Config.GEMINI_CACHED_INPUT_TOKEN_PRICE, Config.GEMINI_INPUT_TOKEN_PRICE)
+        elif provider == "OPENROUTER":
+            return (Config.OPENROUTER_INPUT_TOKEN_PRICE, Config.OPENROUTER_OUTPUT_TOKEN_PRICE,
+                    Config.OPENROUTER_CACHED_INPUT_TOKEN_PRICE, Config.OPENROUTER_INPUT_TOKEN_PRICE)
+        else:  # OPENAI
+            return (Config.OPENAI_INPUT_TOKEN_PRICE, Config.OPENAI_OUTPUT_TOKEN_PRICE,
+                    Config.OPENAI_CACHED_INPUT_TOKEN_PRICE, Config.OPENAI_INPUT_TOKEN_PRICE)
+    
+    @classmethod
+    def calculate_cost(cls, provider: str, input_tokens: int, output_tokens: int,
+                       cache_read_tokens: int = 0, cache_write_tokens: int = 0) -> float:
+        """Cost in USD of one call to the given provider; input_tokens excludes cached tokens."""
+        input_price, output_price, cache_read_price, cache_write_price = cls.token_prices(provider)
+        return (
+            input_tokens * input_price +
+            output_tokens * output_price +
+            cache_read_tokens * cache_read_price +
+            cache_write_tokens * cache_write_price
+        )
+        
+    def update(self, input_tokens: int, output_tokens: int, task: str, provider: Optional[str] = None,
+               cache_read_tokens: int = 0, cache_write_tokens: int = 0):
+        """Update token usage with enhanced task categorization.
+        
+        `provider` is the provider that actually served the call (it may differ from
+        Config.API_PROVIDER after failover or hedging) and determines the price.
+        `input_tokens` counts only uncached prompt tokens; prompt-cache reads and writes
+        are passed separately and priced at the provider's cache rates.
+        """
+        provider = provider or Config.API_PROVIDER
+        
         # Update base metrics
         self.total_input_tokens += input_tokens
         self.total_output_tokens += output_tokens
+        self.total_cache_read_tokens += cache_read_tokens
+        self.total_cache_write_tokens += cache_write_tokens
         
         # Calculate cost based on provider
-        task_cost = 0
-        if Config.API_PROVIDER == "CLAUDE":
-            task_cost = (
-                input_tokens * Config.ANTHROPIC_INPUT_TOKEN_PRICE + 
-                output_tokens * Config.ANTHROPIC_OUTPUT_TOKEN_PRICE
-            )
-        elif Config.API_PROVIDER == "DEEPSEEK":
-            # Different pricing for chat vs reasoner model
-            if Config.DEEPSEEK_COMPLETION_MODEL == Config.DEEPSEEK_CHAT_MODEL:
-                task_cost = (
-                    input_tokens * Config.DEEPSEEK_CHAT_INPUT_PRICE + 
-                    output_tokens * Config.DEEPSEEK_CHAT_OUTPUT_PRICE
-                )
-            else:  # reasoner model
-                task_cost = (
-                    input_tokens * Config.DEEPSEEK_REASONER_INPUT_PRICE + 
-                    output_tokens * Config.DEEPSEEK_REASONER_OUTPUT_PRICE
-                )
-        elif Config.API_PROVIDER == "GEMINI":
-            task_cost = (
-                input_tokens * Config.GEMINI_INPUT_TOKEN_PRICE + 
-                output_tokens * Config.GEMINI_OUTPUT_TOKEN_PRICE
-            )
-        elif Config.API_PROVIDER == "OPENROUTER":
-            task_cost = (
-                input_tokens * Config.OPENROUTER_INPUT_TOKEN_PRICE + 
-                output_tokens * Config.OPENROUTER_OUTPUT_TOKEN_PRICE
-            )
-        else:  # OPENAI
-            task_cost = (
-                input_tokens * Config.OPENAI_INPUT_TOKEN_PRICE + 
-                output_tokens * Config.OPENAI_OUTPUT_TOKEN_PRICE
-            )
-            
+        task_cost = self.calculate_cost(provider, input_tokens, output_tokens, cache_read_tokens, cache_write_tokens)
+        input_price, _, cache_read_price, _ = self.token_prices(provider)
+        self.total_cache_savings += cache_read_tokens * (input_price - cache_read_price)
         self.total_cost += task_cost
+        self.call_counts_by_provider[provider] = self.call_counts_by_provider.get(provider, 0) + 1
+        self.cost_by_provider[provider] = self.cost_by_provider.get(provider, 0) + task_cost
         
         # Update task-specific metrics
         if task not in self.token_counts_by_task:
@@ -217,19 +394,29 @@ class TokenUsageTracker:
             
         self.token_counts_by_task[task]['input'] += input_tokens
         self.token_counts_by_task[task]['output'] += output_tokens
+        if cache_read_tokens or cache_write_tokens:
+            self.token_counts_by_task[task]['cache_read'] = self.token_counts_by_task[task].get('cache_read', 0) + cache_read_tokens
+            self.token_counts_by_task[task]['cache_write'] = self.token_counts_by_task[task].get('cache_write', 0) + cache_write_tokens
         self.call_counts[task] = self.call_counts.get(task, 0) + 1
         self.cost_by_task[task] = self.cost_by_task.get(task, 0) + task_cost
         
         # Update category metrics
-        category_found = False
+        category = self.category_for(task)
+        self.call_counts_by_category[category] += 1
+        self.token_counts_by_category[category]['input'] += input_tokens
+        self.token_counts_by_category[category]['output'] += output_tokens
+        self.cost_by_category[category] += task_cost
+    
+    def category_for(self, task: str) -> str:
+        """Reporting category of a task name ('other' when no category matches)."""
         for category, tasks in self.task_categories.items():
-            if any(task.startswith(t) for t in tasks) or (category == 'other' and not category_found):
-                self.call_counts_by_category[category] += 1
-                self.token_counts_by_category[category]['input'] += input_tokens
-                self.token_counts_by_category[category]['output'] += output_tokens
-                self.cost_by_category[category] += task_cost
-                category_found = True
-                break
+            if any(task.startswith(t) for t in tasks):
+                return category
+        return 'other'
+    
+    def record_coalesced(self, task: str):
+        """Count a call that shared an identical in-flight request instead of reaching a provider."""
+        self.coalesced_calls_by_task[task] = self.coalesced_calls_by_task.get(task, 0) + 1
     
     def get_enhanced_summary(self) -> Dict[str, Any]:
         """Get enhanced usage summary with category breakdowns and percentages."""
@@ -257,10 +444,17 @@ class TokenUsageTracker:
             "total_output_tokens": self.total_output_tokens,
             "total_tokens": self.total_input_tokens + self.total_output_tokens,
             "total_cost_usd": round(self.total_cost, 6),
+            "total_cache_read_tokens": self.total_cache_read_tokens,
+            "total_cache_write_tokens": self.total_cache_write_tokens,
+            "cache_savings_usd": round(self.total_cache_savings, 6),
             "total_calls": total_calls,
             "calls_by_task": dict(self.call_counts),
             "token_counts_by_task": self.token_counts_by_task,
             "cost_by_task": {task: round(cost, 6) for task, cost in self.cost_by_task.items()},
+            "calls_by_provider": dict(self.call_counts_by_provider),
+            "cost_by_provider": {provider: round(cost, 6) for provider, cost in self.cost_by_provider.items()},
+            "coalesced_calls": sum(self.coalesced_calls_by_task.values()),
+            "coalesced_calls_by_task": dict(self.coalesced_calls_by_task),
             "categories": {
                 category: {
                     "calls": count,
@@ -301,7 +495,13 @@ class TokenUsageTracker:
             "",
             f"Total Tokens: {fmt_num(summary['total_tokens'])} (Input: {fmt_num(summary['total_input_tokens'])}, Output: {fmt_num(summary['total_output_tokens'])})",
             f"Total Cost: {fmt_usd(summary['total_cost_usd'])}",
-            f"Total API Calls: {fmt_num(summary['total_calls'])}",
+            f"Prompt Cache: {fmt_num(summary['total_cache_read_tokens'])} tokens read, "
+            f"{fmt_num(summary['total_cache_write_tokens'])} written, saved {fmt_usd(summary['cache_savings_usd'])}",
+            f"Total API Calls: {fmt_num(summary['total_calls'])} (plus {fmt_num(summary['coalesced_calls'])} coalesced duplicates)",
+            "Providers: " + ", ".join(
+                f"{provider} ({fmt_num(calls)} calls, {fmt_usd(summary['cost_by_provider'][provider])})"
+                for provider, calls in summary['calls_by_provider'].items()
+            ),
             "",
             colored("BREAKDOWN BY CATEGORY", "yellow", attrs=["bold"]),
             "-"*80,
@@ -356,208 +556,902 @@ class TokenUsageTracker:
         ])
         
         logger.info("\n".join(report))
+
+# Usage ledgers. Every provider call is recorded in the process-wide ledger and in each ledger bound
+# by usage_ledger() around it (a pipeline run, a backend request), so usage can be reported per
+# request while the process keeps its running totals.
+_process_usage = TokenUsageTracker()
+_active_ledgers: contextvars.ContextVar[Tuple[TokenUsageTracker, ...]] = contextvars.ContextVar('mindmap_usage_ledgers', default=())
+
+def get_process_usage() -> TokenUsageTracker:
+    """Usage of every provider call made by this process since it started."""
+    return _process_usage
+
+def current_usage() -> TokenUsageTracker:
+    """The innermost ledger bound to the current task, or the process-wide one outside any scope."""
+    ledgers = _active_ledgers.get()
+    return ledgers[-1] if ledgers else _process_usage
+
+@contextlib.contextmanager
+def usage_ledger(ledger: Optional[TokenUsageTracker] = None):
+    """Record the usage of every LLM call made inside the block (including tasks it spawns) in `ledger`.
+    
+    Scopes nest: an outer request ledger also sees the calls of a run started inside it.
+    """
+    ledger = ledger or TokenUsageTracker()
+    ledgers = _active_ledgers.get()
+    token = _active_ledgers.set(ledgers if ledger in ledgers else ledgers + (ledger,))
+    try:
+        yield ledger
+    finally:
+        _active_ledgers.reset(token)
+
+def record_usage(input_tokens: int, output_tokens: int, task: str, provider: str,
+                 cache_read_tokens: int = 0, cache_write_tokens: int = 0):
+    """Record one provider call in the process-wide ledger, every active ledger and the metrics."""
+    for ledger in (_process_usage,) + _active_ledgers.get():
+        ledger.update(input_tokens, output_tokens, task, provider=provider,
+                      cache_read_tokens=cache_read_tokens, cache_write_tokens=cache_write_tokens)
+    category = _process_usage.category_for(task)
+    for token_type, count in (('input', input_tokens), ('output', output_tokens),
+                              ('cache_read', cache_read_tokens), ('cache_write', cache_write_tokens)):
+        if count:
+            LLM_TOKENS.inc(count, provider=provider, category=category, type=token_type)
+    LLM_COST.inc(TokenUsageTracker.calculate_cost(provider, input_tokens, output_tokens, cache_read_tokens,
+                                                  cache_write_tokens), provider=provider, category=category)
+
+def record_coalesced_usage(task: str):
+    """Record a call served by an identical in-flight request in every ledger."""
+    for ledger in (_process_usage,) + _active_ledgers.get():
+        ledger.record_coalesced(task)
+    LLM_COALESCED.inc(category=_process_usage.category_for(task))
+
+class BudgetExceededError(RuntimeError):
+    """The request's cost, token or time budget is used up; the LLM call was not made."""
+
+class Degradation(IntEnum):
+    """Pipeline degradation steps, each implying the ones before it."""
+    FULL = 0
+    NO_EMOJI = 1            # Default emojis instead of an LLM pick
+    LEXICAL_DEDUP = 2       # Fuzzy matching only, no LLM similarity checks
+    NO_VERIFICATION = 3     # Skip the fact check against the source
+    SIMPLE = 4              # Single-prompt generate_mindmap_simple
+
+class RequestBudget:
+    """Cost, token and wall-time budget of one request, measured against its usage ledger.
+    
+    The used fraction is the largest of the three ratios; level() maps it to a Degradation step
+    using the BUDGET_*_AT thresholds. DocumentOptimizer rejects calls once the budget is used up
+    and bounds each call by the remaining time, so a request cannot overrun by more than its
+    in-flight calls' cost.
+    """
+    def __init__(self, max_cost_usd: float = 0.0, max_seconds: float = 0.0, max_tokens: int = 0):
+        self.max_cost_usd = max_cost_usd
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+        self.usage: Optional[TokenUsageTracker] = None
+        self.started_at: Optional[float] = None
+        self.degradations: List[str] = []  # Steps taken, in order, for reporting
         
-class DocumentOptimizer:
-    """Minimal document optimizer that only implements what's needed for mindmap generation."""
-    def __init__(self):
-        self.openai_client = AsyncOpenAI(
-            api_key=Config.OPENAI_API_KEY,
-            base_url=Config.OPENAI_BASE_URL
-        )
-        self.anthropic_client = AsyncAnthropic(api_key=Config.ANTHROPIC_API_KEY)
-        self.deepseek_client = AsyncOpenAI(
-            api_key=Config.DEEPSEEK_API_KEY,
-            base_url="https://api.deepseek.com"
+    @classmethod
+    def from_config(cls) -> "RequestBudget":
+        return cls(Config.BUDGET_MAX_COST_USD, Config.BUDGET_MAX_SECONDS, Config.BUDGET_MAX_TOKENS)
+        
+    @property
+    def limited(self) -> bool:
+        return bool(self.max_cost_usd or self.max_seconds or self.max_tokens)
+        
+    def start(self, usage: TokenUsageTracker):
+        """Start the clock and measure against `usage`; later calls keep the first start."""
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+            self.usage = usage
+            
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at if self.started_at is not None else 0.0
+        
+    def remaining_seconds(self) -> Optional[float]:
+        if not self.max_seconds:
+            return None
+        return max(0.0, self.max_seconds - self.elapsed())
+        
+    def used_fraction(self) -> float:
+        fractions = [0.0]
+        if self.max_seconds:
+            fractions.append(self.elapsed() / self.max_seconds)
+        if self.usage is not None:
+            if self.max_cost_usd:
+                fractions.append(self.usage.total_cost / self.max_cost_usd)
+            if self.max_tokens:
+                used_tokens = self.usage.total_input_tokens + self.usage.total_output_tokens
+                fractions.append(used_tokens / self.max_tokens)
+        return max(fractions)
+        
+    def level(self) -> Degradation:
+        if not self.limited:
+            return Degradation.FULL
+        used = self.used_fraction()
+        for level, threshold in ((Degradation.SIMPLE, Config.BUDGET_SIMPLE_FALLBACK_AT),
+                                 (Degradation.NO_VERIFICATION, Config.BUDGET_SKIP_VERIFICATION_AT),
+                                 (Degradation.LEXICAL_DEDUP, Config.BUDGET_LEXICAL_DEDUP_AT),
+                                 (Degradation.NO_EMOJI, Config.BUDGET_SKIP_EMOJI_AT)):
+            if used >= threshold:
+                return level
+        return Degradation.FULL
+        
+    def degraded(self, step: Degradation) -> bool:
+        """Whether the pipeline should take `step` now; the first time it does is logged and recorded."""
+        if self.level() < step:
+            return False
+        if step.name not in self.degradations:
+            self.degradations.append(step.name)
+            logger.warning(f"Budget {self.used_fraction():.0%} used, degrading: {step.name}")
+        return True
+        
+    def check(self, task: str):
+        """Raise BudgetExceededError if no further LLM call may be made."""
+        if self.limited and self.used_fraction() >= 1.0:
+            raise BudgetExceededError(f"Budget exhausted before {task}: {self.snapshot()}")
+            
+    def snapshot(self) -> Dict[str, Any]:
+        usage = self.usage or TokenUsageTracker()
+        return {
+            'max_cost_usd': self.max_cost_usd,
+            'max_seconds': self.max_seconds,
+            'max_tokens': self.max_tokens,
+            'cost_usd': round(usage.total_cost, 6),
+            'elapsed_seconds': round(self.elapsed(), 2),
+            'tokens': usage.total_input_tokens + usage.total_output_tokens,
+            'used_fraction': round(self.used_fraction(), 3),
+            'degradations': list(self.degradations)
+        }
+
+# Budget of the request bound to the current task (set by MindMapGenerator entry points)
+_active_budget: contextvars.ContextVar[Optional[RequestBudget]] = contextvars.ContextVar('mindmap_request_budget', default=None)
+
+class Span:
+    """One timed operation in a request's timing tree.
+    
+    Spans nest through a ContextVar: a span opened while another is active becomes its child,
+    including in asyncio tasks created inside it, so concurrent LLM calls of a stage all appear
+    under that stage.
+    """
+    __slots__ = ('name', 'attrs', 'start', 'end', 'children')
+    
+    def __init__(self, name: str, attrs: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.attrs = attrs or {}
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.children: List['Span'] = []
+        
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+        
+    def to_dict(self, origin: Optional[float] = None) -> Dict[str, Any]:
+        """JSON-serializable tree; offsets are relative to the root span's start."""
+        origin = self.start if origin is None else origin
+        return {
+            'name': self.name,
+            'start_ms': round((self.start - origin) * 1000, 1),
+            'duration_ms': round(self.duration * 1000, 1),
+            **({'attrs': self.attrs} if self.attrs else {}),
+            **({'children': [child.to_dict(origin) for child in self.children]} if self.children else {})
+        }
+        
+    def render(self, depth: int = 0) -> str:
+        """Indented text tree; repeated sibling spans (e.g. hundreds of LLM calls) are aggregated."""
+        lines = [f"{'  ' * depth}{self.name}: {self.duration:.2f}s"]
+        groups: Dict[str, List['Span']] = {}
+        for child in self.children:
+            groups.setdefault(child.name, []).append(child)
+        for name, spans in groups.items():
+            if len(spans) == 1:
+                lines.append(spans[0].render(depth + 1))
+                continue
+            durations = [span.duration for span in spans]
+            wall = max(span.start + span.duration for span in spans) - min(span.start for span in spans)
+            line = (f"{'  ' * (depth + 1)}{name} x{len(spans)}: total {sum(durations):.2f}s, "
+                    f"max {max(durations):.2f}s, wall {wall:.2f}s")
+            queue = [span.attrs['queue_ms'] for span in spans if 'queue_ms' in span.attrs]
+            if queue:
+                line += f", queue wait {sum(queue) / 1000:.2f}s"
+            lines.append(line)
+        return "\n".join(lines)
+
+_active_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar('mindmap_active_span', default=None)
+
+@contextlib.contextmanager
+def trace_span(name: str, **attrs):
+    """Time the enclosed block as a child of the active span."""
+    span = Span(name, attrs)
+    parent = _active_span.get()
+    if parent is not None:
+        parent.children.append(span)
+    token = _active_span.set(span)
+    try:
+        yield span
+    finally:
+        span.end = time.perf_counter()
+        _active_span.reset(token)
+
+def traced(name: str):
+    """Decorator recording each call of a (sync or async) pipeline stage as a span."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with trace_span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+        
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+class CircuitBreaker:
+    """Closed/open/half-open circuit breaker for one provider, driven by the error rate over a time window.
+    
+    CLOSED lets every call through and opens once at least CIRCUIT_MIN_REQUESTS calls in the last
+    CIRCUIT_WINDOW_SECONDS failed at CIRCUIT_ERROR_RATE_THRESHOLD or more. OPEN rejects calls for
+    CIRCUIT_OPEN_SECONDS, then HALF_OPEN lets a single probe through: success closes the circuit,
+    failure opens it again.
+    """
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.state = CircuitState.CLOSED
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.outcomes: deque = deque()  # (timestamp, succeeded)
+        self.total_successes = 0
+        self.total_failures = 0
+        self.times_opened = 0
+        self.last_error = None
+        
+    def _prune(self, now: float):
+        while self.outcomes and now - self.outcomes[0][0] > Config.CIRCUIT_WINDOW_SECONDS:
+            self.outcomes.popleft()
+            
+    def error_rate(self) -> float:
+        self._prune(time.monotonic())
+        if not self.outcomes:
+            return 0.0
+        return sum(1 for _, ok in self.outcomes if not ok) / len(self.outcomes)
+        
+    def available(self) -> bool:
+        """Whether a call would currently be let through (does not reserve the half-open probe)."""
+        if self.state == CircuitState.CLOSED:
+            return True
+        if self.state == CircuitState.OPEN:
+            return time.monotonic() - self.opened_at >= Config.CIRCUIT_OPEN_SECONDS
+        return not self.probe_in_flight
+        
+    def acquire(self) -> bool:
+        """Reserve permission for one call; moves OPEN to HALF_OPEN after the cool-down."""
+        if self.state == CircuitState.OPEN and time.monotonic() - self.opened_at >= Config.CIRCUIT_OPEN_SECONDS:
+            self.state = CircuitState.HALF_OPEN
+            self.probe_in_flight = False
+            logger.info(f"Circuit for {self.provider} half-open, sending probe request")
+        if self.state == CircuitState.CLOSED:
+            return True
+        if self.state == CircuitState.HALF_OPEN and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        return False
+        
+    def record_success(self):
+        now = time.monotonic()
+        self.total_successes += 1
+        self.outcomes.append((now, True))
+        self._prune(now)
+        if self.state != CircuitState.CLOSED:
+            logger.info(f"Circuit for {self.provider} closed after successful probe")
+            self.outcomes.clear()
+        self.state = CircuitState.CLOSED
+        self.probe_in_flight = False
+        
+    def record_failure(self, error: Optional[BaseException] = None):
+        now = time.monotonic()
+        self.total_failures += 1
+        self.last_error = str(error) if error else None
+        self.outcomes.append((now, False))
+        self._prune(now)
+        if self.state == CircuitState.HALF_OPEN:
+            self._open(now)
+        elif (self.state == CircuitState.CLOSED and len(self.outcomes) >= Config.CIRCUIT_MIN_REQUESTS
+              and self.error_rate() >= Config.CIRCUIT_ERROR_RATE_THRESHOLD):
+            self._open(now)
+            
+    def _open(self, now: float):
+        self.state = CircuitState.OPEN
+        self.opened_at = now
+        self.probe_in_flight = False
+        self.times_opened += 1
+        logger.warning(f"Circuit for {self.provider} opened (error rate {self.error_rate():.0%}, "
+                       f"last error: {self.last_error})")
+        
+    def snapshot(self) -> Dict[str, Any]:
+        """Current state for monitoring."""
+        retry_in = 0.0
+        if self.state == CircuitState.OPEN:
+            retry_in = max(0.0, Config.CIRCUIT_OPEN_SECONDS - (time.monotonic() - self.opened_at))
+        return {
+            'state': self.state.value,
+            'error_rate': round(self.error_rate(), 3),
+            'window_requests': len(self.outcomes),
+            'total_successes': self.total_successes,
+            'total_failures': self.total_failures,
+            'times_opened': self.times_opened,
+            'retry_in_seconds': round(retry_in, 1),
+            'last_error': self.last_error
+        }
+
+# Provider outages affect every DocumentOptimizer in the process, so breakers are shared
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+def get_circuit_breaker(provider: str) -> CircuitBreaker:
+    if provider not in _circuit_breakers:
+        _circuit_breakers[provider] = CircuitBreaker(provider)
+    return _circuit_breakers[provider]
+
+# Dedicated pool for the blocking Gemini client when its async API is unavailable,
+# so Gemini calls never occupy the default executor other code relies on
+_gemini_executor: Optional[ThreadPoolExecutor] = None
+
+def _get_gemini_executor() -> ThreadPoolExecutor:
+    global _gemini_executor
+    if _gemini_executor is None:
+        _gemini_executor = ThreadPoolExecutor(max_workers=Config.GEMINI_MAX_WORKERS, thread_name_prefix="gemini")
+    return _gemini_executor
+
+def _run_in_gemini_executor(func: Callable[[], Any]) -> asyncio.Future:
+    """Run a blocking Gemini call on the dedicated pool, counted in GEMINI_QUEUE_DEPTH until a worker starts it."""
+    GEMINI_QUEUE_DEPTH.inc()
+    
+    def run():
+        GEMINI_QUEUE_DEPTH.dec()
+        return func()
+        
+    future = _get_gemini_executor().submit(run)
+    # Only a call that never started can be cancelled, so exactly one of the two decrements happens
+    future.add_done_callback(lambda f: f.cancelled() and GEMINI_QUEUE_DEPTH.dec())
+    return asyncio.wrap_future(future)
+
+@dataclass
+class SharedCompletion:
+    """One provider call shared by every caller with an identical prompt, and how many still wait on it."""
+    call: asyncio.Future
+    waiters: int = 0
+
+# Identical prompts in flight anywhere in the process share one provider call (singleflight).
+# Keyed by event loop too, since a future can only be awaited on its own loop.
+_inflight_completions: Dict[Tuple[int, str], SharedCompletion] = {}
+
+def get_provider_health() -> Dict[str, Dict[str, Any]]:
+    """Circuit breaker state of every provider in the routing order, for health/monitoring endpoints."""
+    return {provider: get_circuit_breaker(provider).snapshot() for provider in DocumentOptimizer.provider_order()}
+
+# Process-wide LLM clients. SDK clients and their httpx pool are created on first use and kept
+# per event loop (pooled connections cannot move between loops), so every DocumentOptimizer,
+# MindMapGenerator and backend analyzer on a loop reuses the same warm connections.
+_llm_clients_by_loop: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, Any]]" = weakref.WeakKeyDictionary()
+_gemini_model = None
+_gemini_init_attempted = False
+_mock_provider: Optional[MockLLMProvider] = None
+_replay_provider: Optional[ReplayLLMProvider] = None
+_session_recorder: Optional[SessionRecorder] = None
+
+def _build_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=Config.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=Config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=Config.HTTP_KEEPALIVE_EXPIRY_SECONDS
+        ),
+        # No pool timeout: bursts wait for a free connection instead of failing
+        timeout=httpx.Timeout(Config.HTTP_READ_TIMEOUT_SECONDS, connect=Config.HTTP_CONNECT_TIMEOUT_SECONDS, pool=None),
+        http2=Config.HTTP2_ENABLED and H2_AVAILABLE
+    )
+
+def get_llm_client(provider: str) -> Union["AsyncOpenAI", "AsyncAnthropic"]:
+    """Shared SDK client for OPENAI, CLAUDE, DEEPSEEK or OPENROUTER on the running event loop."""
+    loop = asyncio.get_running_loop()
+    clients = _llm_clients_by_loop.get(loop)
+    if clients is None:
+        clients = _llm_clients_by_loop[loop] = {'http': _build_http_client()}
+    if provider not in clients:
+        http_client = clients['http']
+        if provider == "CLAUDE":
+            from anthropic import AsyncAnthropic
+        else:
+            from openai import AsyncOpenAI
+        if provider == "OPENAI":
+            clients[provider] = AsyncOpenAI(api_key=Config.OPENAI_API_KEY, base_url=Config.OPENAI_BASE_URL,
+                                            http_client=http_client)
+        elif provider == "CLAUDE":
+            clients[provider] = AsyncAnthropic(api_key=Config.ANTHROPIC_API_KEY, http_client=http_client)
+        elif provider == "DEEPSEEK":
+            clients[provider] = AsyncOpenAI(api_key=Config.DEEPSEEK_API_KEY, base_url="https://api.deepseek.com",
+                                            http_client=http_client)
+        elif provider == "OPENROUTER":
+            clients[provider] = AsyncOpenAI(api_key=Config.OPENROUTER_API_KEY, base_url="https://openrouter.ai/api/v1",
+                                            http_client=http_client)
+        else:
+            raise ValueError(f"No HTTP client for provider: {provider}")
+    return clients[provider]
+
+async def close_llm_clients():
+    """Close the running loop's shared connection pool; call on application shutdown."""
+    clients = _llm_clients_by_loop.pop(asyncio.get_running_loop(), None)
+    if clients:
+        await clients['http'].aclose()
+
+def _get_gemini_model():
+    """Process-wide Gemini model (configured once), or None if Gemini cannot be used."""
+    global _gemini_model, _gemini_init_attempted, genai
+    if _gemini_model is None and not _gemini_init_attempted and Config.GEMINI_API_KEY and GOOGLE_AI_AVAILABLE:
+        # Tried once per process, so a broken installation is not re-imported on every call
+        _gemini_init_attempted = True
+        try:
+            import google.generativeai as genai
+            # Configure Google Generative AI
+            genai.configure(api_key=Config.GEMINI_API_KEY)
+            # Create a GenerativeModel instance
+            _gemini_model = genai.GenerativeModel(Config.GEMINI_MODEL_STRING)
+            logger.info("Gemini API client initialized successfully")
+        except Exception as e:
+            logger.warning(f"Failed to initialize Gemini client: {e}")
+    return _gemini_model
+
+def get_mock_provider() -> MockLLMProvider:
+    """Process-wide MOCK provider built from Config; replace its attributes to change the simulation."""
+    global _mock_provider
+    if _mock_provider is None:
+        _mock_provider = MockLLMProvider(
+            seed=Config.MOCK_SEED,
+            latency_distribution=Config.MOCK_LATENCY_DISTRIBUTION,
+            latency_mean=Config.MOCK_LATENCY_MEAN_SECONDS,
+            latency_spread=Config.MOCK_LATENCY_SPREAD,
+            latency_per_output_token=Config.MOCK_LATENCY_PER_OUTPUT_TOKEN_SECONDS,
+            error_rate=Config.MOCK_ERROR_RATE,
+            rate_limit_rate=Config.MOCK_RATE_LIMIT_RATE,
+            redundant_rate=Config.MOCK_REDUNDANT_RATE,
+            verify_rate=Config.MOCK_VERIFY_RATE
         )
-        # Initialize OpenRouter client
-        self.openrouter_client = AsyncOpenAI(
-            api_key=Config.OPENROUTER_API_KEY,
-            base_url="https://openrouter.ai/api/v1"
+    return _mock_provider
+
+def get_replay_provider() -> ReplayLLMProvider:
+    """Process-wide REPLAY provider serving Config.LLM_REPLAY_FILE."""
+    global _replay_provider
+    if _replay_provider is None:
+        if not Config.LLM_REPLAY_FILE:
+            raise RuntimeError("REPLAY provider selected but LLM_REPLAY_FILE is not set")
+        _replay_provider = ReplayLLMProvider(
+            Config.LLM_REPLAY_FILE,
+            latency_scale=Config.LLM_REPLAY_LATENCY_SCALE,
+            fallback=get_mock_provider().complete if Config.LLM_REPLAY_MOCK_ON_MISS else None
         )
-        # Initialize Google GenAI client only if needed
-        self.gemini_client = None
-        if Config.API_PROVIDER == "GEMINI" and Config.GEMINI_API_KEY and GOOGLE_AI_AVAILABLE:
-            try:
-                # Configure Google Generative AI
-                genai.configure(api_key=Config.GEMINI_API_KEY)
-                # Create a GenerativeModel instance
-                self.gemini_client = genai.GenerativeModel(Config.GEMINI_MODEL_STRING)
-                logger.info("Gemini API client initialized successfully")
-            except Exception as e:
-                logger.warning(f"Failed to initialize Gemini client: {e}")
-        elif Config.API_PROVIDER == "GEMINI" and not GOOGLE_AI_AVAILABLE:
+    return _replay_provider
+
+def get_session_recorder() -> Optional[SessionRecorder]:
+    """Process-wide recorder for Config.LLM_RECORD_FILE, or None when recording is off."""
+    global _session_recorder
+    if _session_recorder is None and Config.LLM_RECORD_FILE:
+        directory = os.path.dirname(Config.LLM_RECORD_FILE)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        _session_recorder = SessionRecorder(Config.LLM_RECORD_FILE, include_prompts=Config.LLM_RECORD_PROMPTS)
+        atexit.register(_session_recorder.close)
+        logger.info(f"Recording LLM calls to {Config.LLM_RECORD_FILE}")
+    return _session_recorder
+
+class DocumentOptimizer:
+    """Minimal document optimizer that only implements what's needed for mindmap generation.
+    
+    SDK clients are not owned by the instance: they come from the process-wide registry
+    (get_llm_client), so creating several optimizers does not create extra connection pools.
+    """
+    def __init__(self):
+        # The Gemini model itself is created on first use (see gemini_client)
+        gemini_needed = "GEMINI" in self.provider_order()
+        if gemini_needed and not GOOGLE_AI_AVAILABLE:
             logger.error("Gemini API provider selected but google-generativeai package not installed")
-        elif Config.API_PROVIDER == "GEMINI" and not Config.GEMINI_API_KEY:
+        elif gemini_needed and not Config.GEMINI_API_KEY:
             logger.error("Gemini API provider selected but no API key provided")
-        self.token_tracker = TokenUsageTracker()
+        # Recent successful call latencies per (provider, task), used for the hedge delay
+        self._latencies: Dict[Tuple[str, str], deque] = {}
+        
+    @property
+    def token_tracker(self) -> TokenUsageTracker:
+        """Usage ledger of the current request (see usage_ledger), or the process-wide totals."""
+        return current_usage()
+        
+    @property
+    def gemini_client(self):
+        return _get_gemini_model()
+    
+    @property
+    def openai_client(self) -> "AsyncOpenAI":
+        return get_llm_client("OPENAI")
+    
+    @property
+    def anthropic_client(self) -> "AsyncAnthropic":
+        return get_llm_client("CLAUDE")
+    
+    @property
+    def deepseek_client(self) -> "AsyncOpenAI":
+        return get_llm_client("DEEPSEEK")
+    
+    @property
+    def openrouter_client(self) -> "AsyncOpenAI":
+        return get_llm_client("OPENROUTER")
+        
+    @staticmethod
+    def provider_order() -> List[str]:
+        """API_PROVIDER followed by API_FALLBACK_PROVIDERS, without duplicates."""
+        order = []
+        for provider in [Config.API_PROVIDER] + Config.API_FALLBACK_PROVIDERS:
+            if provider and provider not in order:
+                order.append(provider)
+        return order
+        
+    def is_provider_configured(self, provider: str) -> bool:
+        if provider == "GEMINI":
+            return self.gemini_client is not None
+        if provider == "MOCK":
+            return True
+        if provider == "REPLAY":
+            return bool(Config.LLM_REPLAY_FILE)
+        api_keys = {
+            "OPENAI": Config.OPENAI_API_KEY,
+            "CLAUDE": Config.ANTHROPIC_API_KEY,
+            "DEEPSEEK": Config.DEEPSEEK_API_KEY,
+            "OPENROUTER": Config.OPENROUTER_API_KEY,
+        }
+        return bool(api_keys.get(provider))
+        
+    def available_providers(self) -> List[str]:
+        """Configured providers whose circuit is not open, in fallback order."""
+        return [
+            provider for provider in self.provider_order()
+            if self.is_provider_configured(provider) and get_circuit_breaker(provider).available()
+        ]
+        
+    def hedge_delay(self, provider: str, task: str) -> float:
+        """Seconds to wait on a provider before hedging: its p95 latency for this task, once known."""
+        samples = self._latencies.get((provider, task))
+        if not samples or len(samples) < Config.HEDGE_MIN_SAMPLES:
+            return Config.HEDGE_DEFAULT_DELAY_SECONDS
+        ordered = sorted(samples)
+        idx = min(len(ordered) - 1, math.ceil(len(ordered) * Config.HEDGE_LATENCY_PERCENTILE / 100) - 1)
+        return ordered[idx]
         
-    async def generate_completion(self, prompt: str, max_tokens: int = 5000, request_id: str = None, task: Optional[str] = None) -> Optional[str]:
+    def median_latency(self, provider: str) -> Optional[float]:
+        """Median latency of the recent successful calls to a provider across all tasks, or None before any."""
+        samples = sorted(
+            latency for (name, _), latencies in self._latencies.items() if name == provider
+            for latency in latencies
+        )
+        return samples[len(samples) // 2] if samples else None
+        
+    async def _timed_call(self, provider: str, prompt: str, max_tokens: int, task: str,
+                          cache_prefix: Optional[str] = None) -> str:
+        breaker = get_circuit_breaker(provider)
+        if not breaker.acquire():
+            raise RuntimeError(f"Circuit for {provider} is open")
+        category = _process_usage.category_for(task)
+        start = time.perf_counter()
         try:
-            # Log the start of the request with truncated prompt
-            prompt_preview = " ".join(prompt.split()[:40])  # Get first 40 words
-            logger.info(
-                f"\n{colored('🔄 API Request', 'cyan', attrs=['bold'])}\n"
-                f"Task: {colored(task or 'unknown', 'yellow')}\n"
-                f"Provider: {colored(Config.API_PROVIDER, 'blue')}\n"
-                f"Prompt preview: {colored(prompt_preview + '...', 'white')}"
-            )
-            if Config.API_PROVIDER == "CLAUDE":
-                async with self.anthropic_client.messages.stream(
-                    model=Config.CLAUDE_MODEL_STRING,
-                    max_tokens=max_tokens,
-                    temperature=0.7,
-                    messages=[{"role": "user", "content": prompt}]
-                ) as stream:
-                    message = await stream.get_final_message()
-                    response_preview = " ".join(message.content[0].text.split()[:30])
-                    self.token_tracker.update(
-                        message.usage.input_tokens,
-                        message.usage.output_tokens,
-                        task or "unknown"
-                    )
-                    logger.info(
-                        f"\n{colored('✅ API Response', 'green', attrs=['bold'])}\n"
-                        f"Response preview: {colored(response_preview + '...', 'white')}\n"
-                        f"Tokens: {colored(f'Input={message.usage.input_tokens}, Output={message.usage.output_tokens}', 'yellow')}"
-                    )
-                    return message.content[0].text
-            elif Config.API_PROVIDER == "DEEPSEEK":
-                kwargs = {
-                    "model": Config.DEEPSEEK_COMPLETION_MODEL,
-                    "messages": [{"role": "user", "content": prompt}],
-                    "max_tokens": max_tokens,
-                    "stream": False
-                }
-                if Config.DEEPSEEK_COMPLETION_MODEL == Config.DEEPSEEK_CHAT_MODEL:
-                    kwargs["temperature"] = 0.7
-                response = await self.deepseek_client.chat.completions.create(**kwargs)
-                response_preview = " ".join(response.choices[0].message.content.split()[:30])
-                self.token_tracker.update(
-                    response.usage.prompt_tokens,
-                    response.usage.completion_tokens,
-                    task or "unknown"
-                )
-                logger.info(
-                    f"\n{colored('✅ API Response', 'green', attrs=['bold'])}\n"
-                    f"Response preview: {colored(response_preview + '...', 'white')}\n"
-                    f"Tokens: {colored(f'Input={response.usage.prompt_tokens}, Output={response.usage.completion_tokens}', 'yellow')}"
-                )
-                return response.choices[0].message.content
-            elif Config.API_PROVIDER == "GEMINI":
-                if not self.gemini_client:
-                    logger.error("Gemini client not initialized")
-                    return None
-                
-                try:
-                    # Generate content using Gemini model
-                    response = await asyncio.to_thread(
-                        self.gemini_client.generate_content,
-                        prompt,
-                        generation_config=genai.GenerationConfig(
-                            max_output_tokens=min(max_tokens, Config.GEMINI_MAX_TOKENS),
-                            temperature=0.7,
-                        )
-                    )
-                    
-                    response_text = response.text
-                    response_preview = " ".join(response_text.split()[:30])
-                    
-                    # Extract token usage from response metadata
-                    input_tokens = getattr(response.usage_metadata, 'prompt_token_count', 0) if hasattr(response, 'usage_metadata') else 0
-                    output_tokens = getattr(response.usage_metadata, 'candidates_token_count', 0) if hasattr(response, 'usage_metadata') else 0
-                    
-                    self.token_tracker.update(
-                        input_tokens,
-                        output_tokens,
-                        task or "unknown"
-                    )
-                    
-                    logger.info(
-                        f"\n{colored('✅ API Response', 'green', attrs=['bold'])}\n"
-                        f"Response preview: {colored(response_preview + '...', 'white')}\n"
-                        f"Tokens: {colored(f'Input={input_tokens}, Output={output_tokens}', 'yellow')}"
-                    )
-                    
-                    return response_text
-                    
-                except Exception as e:
-                    logger.error(f"Gemini API error: {str(e)}")
-                    return None
-            elif Config.API_PROVIDER == "OPENROUTER":
+            with trace_span('provider_call', provider=provider) as span:
+                result = await self._call_provider(provider, prompt, max_tokens, task, cache_prefix)
+                span.attrs['ok'] = True
+        except asyncio.CancelledError:
+            breaker.probe_in_flight = False
+            LLM_CALLS.inc(provider=provider, category=category, outcome='cancelled')
+            raise
+        except Exception as e:
+            breaker.record_failure(e)
+            LLM_CALLS.inc(provider=provider, category=category, outcome='error')
+            raise
+        breaker.record_success()
+        elapsed = time.perf_counter() - start
+        self._latencies.setdefault((provider, task), deque(maxlen=200)).append(elapsed)
+        LLM_CALLS.inc(provider=provider, category=category, outcome='ok')
+        LLM_CALL_SECONDS.observe(elapsed, provider=provider, category=category)
+        return result
+        
+    async def generate_completion(self, prompt: str, max_tokens: int = 5000, request_id: str = None, task: Optional[str] = None,
+                                  cache_prefix: Optional[str] = None) -> Optional[str]:
+        """Complete a prompt, coalescing it with an identical request already in flight.
+        
+        Only one provider call is made for byte-identical (prompt, max_tokens) pairs that overlap
+        in time; every waiter receives its result. Nothing is cached once the call finishes.
+        A cancelled caller only stops waiting: the shared call is cancelled once nobody waits on it.
+        
+        `cache_prefix` is the stable leading part of the prompt (instructions, document chunk) that
+        many calls share; the model sees `cache_prefix + prompt`. It is marked with Anthropic
+        cache_control when it is long enough to be cached (ANTHROPIC_MIN_CACHE_TOKENS), and
+        OpenAI/DeepSeek/Gemini cache such shared prefixes automatically.
+        
+        Each call is an `llm_call` span whose attrs split its time into network_ms (the provider
+        call that answered) and queue_ms (everything else).
+        
+        Raises BudgetExceededError when the current request's RequestBudget is used up, or its
+        time budget runs out while waiting for the answer.
+        """
+        budget = _active_budget.get()
+        if budget is not None:
+            budget.check(task or "unknown")
+        with trace_span('llm_call', task=task or "unknown") as span:
+            try:
+                completion = self._coalesced_completion(prompt, max_tokens, task, cache_prefix, span)
+                remaining = budget.remaining_seconds() if budget is not None else None
+                if remaining is None:
+                    return await completion
                 try:
-                    response = await self.openrouter_client.chat.completions.create(
-                        model=Config.OPENROUTER_MODEL_STRING,
-                        messages=[{"role": "user", "content": prompt}],
-                        max_tokens=max_tokens,
-                        temperature=0.7,
-                        extra_headers={
-                            "HTTP-Referer": "https://mindmap-generator.local",
-                            "X-Title": "Mindmap Generator"
-                        }
-                    )
-                    
-                    # 检查响应是否有效
-                    if not response or not response.choices or len(response.choices) == 0:
-                        logger.error("OpenRouter API返回了空响应或无choices")
-                        return None
-                    
-                    response_text = response.choices[0].message.content
-                    
-                    # 检查响应内容是否为空
-                    if not response_text or response_text.strip() == "":
-                        logger.error(f"OpenRouter API返回了空内容: {response_text}")
-                        return None
-                    
-                    response_preview = " ".join(response_text.split()[:30])
-                    
-                    # Extract token usage
-                    input_tokens = getattr(response.usage, 'prompt_tokens', 0)
-                    output_tokens = getattr(response.usage, 'completion_tokens', 0)
-                    
-                    self.token_tracker.update(
-                        input_tokens,
-                        output_tokens,
-                        task or "unknown"
-                    )
-                    
-                    logger.info(
-                        f"\n{colored('✅ API Response', 'green', attrs=['bold'])}\n"
-                        f"Response preview: {colored(response_preview + '...', 'white')}\n"
-                        f"Tokens: {colored(f'Input={input_tokens}, Output={output_tokens}', 'yellow')}"
-                    )
+                    return await asyncio.wait_for(completion, timeout=remaining)
+                except asyncio.TimeoutError:
+                    raise BudgetExceededError(f"Time budget ran out during {task or 'unknown'}")
+            finally:
+                # Time not spent in the provider call that produced the answer: coalescing waits,
+                # circuit checks, hedge delays and failed attempts
+                network = max((child.duration for child in span.children if child.attrs.get('ok')), default=0.0)
+                span.attrs['network_ms'] = round(network * 1000, 1)
+                span.attrs['queue_ms'] = round((span.duration - network) * 1000, 1)
+        
+    async def _coalesced_completion(self, prompt: str, max_tokens: int, task: Optional[str],
+                                    cache_prefix: Optional[str], span: Span) -> Optional[str]:
+        loop = asyncio.get_running_loop()
+        key = (id(loop), hashlib.md5(f"{max_tokens}\x00{cache_prefix or ''}\x00{prompt}".encode()).hexdigest())
+        shared = _inflight_completions.get(key)
+        if shared is not None:
+            record_coalesced_usage(task or "unknown")
+            span.attrs['coalesced'] = True
+            logger.debug(f"Coalesced duplicate in-flight request for {task or 'unknown'}")
+        else:
+            # The call runs as its own task, so it outlives whichever caller happened to start it
+            shared = _inflight_completions[key] = SharedCompletion(
+                asyncio.ensure_future(self._route_completion(prompt, max_tokens, task, cache_prefix)))
+            shared.call.add_done_callback(lambda _: self._release_completion(key, shared))
+        
+        shared.waiters += 1
+        try:
+            # Shield so a cancelled caller (timed-out budget, disconnected client) does not cancel
+            # the call the other callers are waiting on
+            return await asyncio.shield(shared.call)
+        finally:
+            shared.waiters -= 1
+            if shared.waiters == 0 and not shared.call.done():
+                # Nobody is left to use the answer
+                self._release_completion(key, shared)
+                shared.call.cancel()
+                
+    @staticmethod
+    def _release_completion(key: Tuple[int, str], shared: SharedCompletion):
+        """Stop routing new callers to `shared`; a newer call for the same prompt is left alone."""
+        if _inflight_completions.get(key) is shared:
+            del _inflight_completions[key]
+        
+    async def _route_completion(self, prompt: str, max_tokens: int, task: Optional[str],
+                                cache_prefix: Optional[str] = None) -> Optional[str]:
+        """Complete a prompt, failing over and hedging across the configured providers.
+        
+        Providers are tried in provider_order(). If the current provider is still running after
+        its p95 latency, a hedge request goes to the next provider and the first successful
+        answer wins; the other call is left to finish so its tokens are still recorded.
+        A failed provider fails over to the next one. Returns None when every provider fails.
+        """
+        task = task or "unknown"
+        providers = self.available_providers()
+        if not providers:
+            # Fail fast instead of waiting on a provider whose circuit is open
+            logger.error(f"No available API provider among {self.provider_order()}: "
+                         f"{ {p: get_circuit_breaker(p).state.value for p in self.provider_order()} }")
+            return None
+            
+        # Log the start of the request with truncated prompt
+        prompt_preview = " ".join(((cache_prefix or '') + prompt).split()[:40])  # Get first 40 words
+        logger.info(
+            f"\n{colored('🔄 API Request', 'cyan', attrs=['bold'])}\n"
+            f"Task: {colored(task, 'yellow')}\n"
+            f"Provider: {colored(' -> '.join(providers), 'blue')}\n"
+            f"Prompt preview: {colored(prompt_preview + '...', 'white')}"
+        )
+        
+        remaining = list(providers)
+        pending: Dict[asyncio.Task, str] = {}
+        hedged = False
+        
+        def launch():
+            provider = remaining.pop(0)
+            pending[asyncio.ensure_future(self._timed_call(provider, prompt, max_tokens, task, cache_prefix))] = provider
+            
+        launch()
+        try:
+            while pending:
+                timeout = None
+                if Config.ENABLE_HEDGED_REQUESTS and not hedged and remaining and len(pending) == 1:
+                    timeout = self.hedge_delay(next(iter(pending.values())), task)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                
+                if not done:
+                    hedged = True
+                    logger.warning(f"{next(iter(pending.values()))} slower than {timeout:.1f}s for {task}, "
+                                   f"hedging to {remaining[0]}")
+                    launch()
+                    continue
                     
-                    return response_text
+                for finished in done:
+                    provider = pending.pop(finished)
+                    try:
+                        result = finished.result()
+                    except Exception as e:
+                        logger.error(
+                            f"\n{colored('❌ API Error', 'red', attrs=['bold'])}\n"
+                            f"Provider: {provider}\n"
+                            f"Error: {colored(str(e), 'red')}"
+                        )
+                        continue
+                    # Let the losing hedge finish in the background so its usage is still tracked
+                    for other in pending:
+                        other.add_done_callback(lambda t: t.cancelled() or t.exception())
+                    pending.clear()
+                    return result
                     
-                except Exception as e:
-                    logger.error(f"OpenRouter API error: {str(e)}")
-                    return None
-            elif Config.API_PROVIDER == "OPENAI":
-                response = await self.openai_client.chat.completions.create(
-                    model=Config.OPENAI_COMPLETION_MODEL,
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=max_tokens,
-                    temperature=0.7
-                )
-                response_preview = " ".join(response.choices[0].message.content.split()[:30])
-                self.token_tracker.update(
-                    response.usage.prompt_tokens,
-                    response.usage.completion_tokens,
-                    task or "unknown"
-                )
-                logger.info(
-                    f"\n{colored('✅ API Response', 'green', attrs=['bold'])}\n"
-                    f"Response preview: {colored(response_preview + '...', 'white')}\n"
-                    f"Tokens: {colored(f'Input={response.usage.prompt_tokens}, Output={response.usage.completion_tokens}', 'yellow')}"
+                if not pending and remaining:
+                    logger.warning(f"Failing over to {remaining[0]} for {task}")
+                    launch()
+        except asyncio.CancelledError:
+            for other in pending:
+                other.cancel()
+            raise
+        return None
+        
+    @staticmethod
+    def _cached_prompt_tokens(usage: Any) -> int:
+        """Prompt tokens served from the provider's prefix cache (DeepSeek or OpenAI-style usage)."""
+        cached = getattr(usage, 'prompt_cache_hit_tokens', None)
+        if cached is None:
+            cached = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None)
+        return cached or 0
+        
+    async def _call_provider(self, provider: str, prompt: str, max_tokens: int, task: str,
+                             cache_prefix: Optional[str] = None) -> str:
+        """Send one completion request to a specific provider; raises on any failure or empty answer."""
+        full_prompt = (cache_prefix or '') + prompt
+        cache_read_tokens = 0
+        cache_write_tokens = 0
+        billed_provider = provider
+        start = time.perf_counter()
+        if provider == "CLAUDE":
+            content = full_prompt
+            # Shorter prefixes are never cached; marking them would only add a cache breakpoint
+            if cache_prefix and TokenCounter('CLAUDE').count(cache_prefix) >= Config.ANTHROPIC_MIN_CACHE_TOKENS:
+                content = [
+                    {"type": "text", "text": cache_prefix, "cache_control": {"type": "ephemeral"}},
+                    {"type": "text", "text": prompt}
+                ]
+            async with self.anthropic_client.messages.stream(
+                model=Config.CLAUDE_MODEL_STRING,
+                max_tokens=max_tokens,
+                temperature=0.7,
+                messages=[{"role": "user", "content": content}]
+            ) as stream:
+                message = await stream.get_final_message()
+            response_text = message.content[0].text
+            input_tokens = message.usage.input_tokens
+            output_tokens = message.usage.output_tokens
+            cache_read_tokens = getattr(message.usage, 'cache_read_input_tokens', 0) or 0
+            cache_write_tokens = getattr(message.usage, 'cache_creation_input_tokens', 0) or 0
+        elif provider == "DEEPSEEK":
+            kwargs = {
+                "model": Config.DEEPSEEK_COMPLETION_MODEL,
+                "messages": [{"role": "user", "content": full_prompt}],
+                "max_tokens": max_tokens,
+                "stream": False
+            }
+            if Config.DEEPSEEK_COMPLETION_MODEL == Config.DEEPSEEK_CHAT_MODEL:
+                kwargs["temperature"] = 0.7
+            response = await self.deepseek_client.chat.completions.create(**kwargs)
+            response_text = response.choices[0].message.content
+            cache_read_tokens = self._cached_prompt_tokens(response.usage)
+            input_tokens = response.usage.prompt_tokens - cache_read_tokens
+            output_tokens = response.usage.completion_tokens
+        elif provider == "GEMINI":
+            if not self.gemini_client:
+                raise RuntimeError("Gemini client not initialized")
+            generation_config = genai.GenerationConfig(
+                max_output_tokens=min(max_tokens, Config.GEMINI_MAX_TOKENS),
+                temperature=0.7,
+            )
+            # Generate content using Gemini model, natively async when the SDK supports it
+            if hasattr(self.gemini_client, 'generate_content_async'):
+                response = await self.gemini_client.generate_content_async(
+                    full_prompt,
+                    generation_config=generation_config
                 )
-                return response.choices[0].message.content
             else:
-                raise ValueError(f"Invalid API_PROVIDER: {Config.API_PROVIDER}")
-        except Exception as e:
-            logger.error(
-                f"\n{colored('❌ API Error', 'red', attrs=['bold'])}\n"
-                f"Error: {colored(str(e), 'red')}"
+                response = await _run_in_gemini_executor(
+                    functools.partial(self.gemini_client.generate_content, full_prompt,
+                                      generation_config=generation_config)
+                )
+            response_text = response.text
+            # Extract token usage from response metadata
+            input_tokens = getattr(response.usage_metadata, 'prompt_token_count', 0) if hasattr(response, 'usage_metadata') else 0
+            output_tokens = getattr(response.usage_metadata, 'candidates_token_count', 0) if hasattr(response, 'usage_metadata') else 0
+            cache_read_tokens = (getattr(response.usage_metadata, 'cached_content_token_count', 0) or 0) if hasattr(response, 'usage_metadata') else 0
+            input_tokens -= cache_read_tokens
+        elif provider == "OPENROUTER":
+            response = await self.openrouter_client.chat.completions.create(
+                model=Config.OPENROUTER_MODEL_STRING,
+                messages=[{"role": "user", "content": full_prompt}],
+                max_tokens=max_tokens,
+                temperature=0.7,
+                extra_headers={
+                    "HTTP-Referer": "https://mindmap-generator.local",
+                    "X-Title": "Mindmap Generator"
+                }
             )
-            return None
+            # 检查响应是否有效
+            if not response or not response.choices or len(response.choices) == 0:
+                raise RuntimeError("OpenRouter API返回了空响应或无choices")
+            response_text = response.choices[0].message.content
+            # Extract token usage
+            cache_read_tokens = self._cached_prompt_tokens(response.usage)
+            input_tokens = getattr(response.usage, 'prompt_tokens', 0) - cache_read_tokens
+            output_tokens = getattr(response.usage, 'completion_tokens', 0)
+        elif provider == "MOCK":
+            response_text, input_tokens, output_tokens = await get_mock_provider().complete(full_prompt, max_tokens, task)
+        elif provider == "REPLAY":
+            recorded = await get_replay_provider().complete(full_prompt, max_tokens, task)
+            response_text = recorded['response']
+            input_tokens, output_tokens, cache_read_tokens, cache_write_tokens = recorded['usage']
+            # Price the replayed call like the provider that originally served it
+            billed_provider = recorded.get('provider') or provider
+        elif provider == "OPENAI":
+            response = await self.openai_client.chat.completions.create(
+                model=Config.OPENAI_COMPLETION_MODEL,
+                messages=[{"role": "user", "content": full_prompt}],
+                max_tokens=max_tokens,
+                temperature=0.7
+            )
+            response_text = response.choices[0].message.content
+            cache_read_tokens = self._cached_prompt_tokens(response.usage)
+            input_tokens = response.usage.prompt_tokens - cache_read_tokens
+            output_tokens = response.usage.completion_tokens
+        else:
+            raise ValueError(f"Invalid API provider: {provider}")
+        
+        # Usage is recorded even for an empty answer, since the provider still bills it
+        record_usage(input_tokens, output_tokens, task, billed_provider,
+                     cache_read_tokens=cache_read_tokens, cache_write_tokens=cache_write_tokens)
+        
+        recorder = get_session_recorder()
+        if recorder is not None and provider != "REPLAY":
+            recorder.record(full_prompt, max_tokens, task, provider, response_text, input_tokens, output_tokens,
+                            cache_read_tokens, cache_write_tokens, latency=time.perf_counter() - start)
+        
+        # 检查响应内容是否为空
+        if not response_text or response_text.strip() == "":
+            raise RuntimeError(f"{provider} API返回了空内容: {response_text}")
+        
+        response_preview = " ".join(response_text.split()[:30])
+        logger.info(
+            f"\n{colored('✅ API Response', 'green', attrs=['bold'])}\n"
+            f"Provider: {colored(provider, 'blue')}\n"
+            f"Response preview: {colored(response_preview + '...', 'white')}\n"
+            f"Tokens: {colored(f'Input={input_tokens}, Output={output_tokens}, CacheRead={cache_read_tokens}, CacheWrite={cache_write_tokens}', 'yellow')}"
+        )
+        return response_text
     
 class MinimalDatabaseStub:
     """Minimal database stub that provides just enough for the mindmap generator."""
@@ -653,9 +1547,600 @@ class ContentItem:
     def __str__(self):
         return f"{self.text} ({self.node_type} at {self.path_str})"
 
+class TokenCounter:
+    """Count tokens for the active provider, exactly where a local tokenizer is available."""
+    CJK_REGEX = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af\uff00-\uffef]')
+    
+    # (tokens per CJK character, characters per token for other text)
+    HEURISTICS = {
+        'CLAUDE': (1.2, 3.5),
+        'DEEPSEEK': (0.6, 3.3),
+        'GEMINI': (1.0, 4.0),
+        'OPENROUTER': (1.0, 4.0),
+        'OPENAI': (1.0, 4.0),
+    }
+    
+    def __init__(self, provider: Optional[str] = None):
+        self.provider = (provider or Config.API_PROVIDER or 'OPENAI').upper()
+        self._encoding = None
+        self._encoding_loaded = False
+        
+    def _get_encoding(self):
+        """tiktoken encoding for OpenAI, loaded on the first count (it can take a while to load)."""
+        if not self._encoding_loaded:
+            self._encoding_loaded = True
+            if self.provider == 'OPENAI' and TIKTOKEN_AVAILABLE:
+                try:
+                    import tiktoken
+                    self._encoding = tiktoken.get_encoding('o200k_base')
+                except Exception as e:
+                    logger.warning(f"Failed to load tiktoken encoding, using estimates: {e}")
+        return self._encoding
+                
+    def count(self, text: str) -> int:
+        """Return the number of tokens the provider will see for this text."""
+        if not text:
+            return 0
+        encoding = self._get_encoding()
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        cjk_chars = len(self.CJK_REGEX.findall(text))
+        tokens_per_cjk, chars_per_token = self.HEURISTICS.get(self.provider, self.HEURISTICS['OPENAI'])
+        return math.ceil(cjk_chars * tokens_per_cjk + (len(text) - cjk_chars) / chars_per_token)
+
+@dataclass
+class DocumentChunk:
+    """A token-bounded slice of the document aligned to section and paragraph boundaries."""
+    index: int
+    text: str
+    start_char: int
+    end_char: int
+    token_count: int
+    section_title: Optional[str] = None
+
+class DocumentChunker:
+    """Single chunking engine shared by topic, subtopic, detail extraction and verification.
+    
+    Sections come from DocumentParser headings; sections are packed paragraph by paragraph
+    into chunks of at most `max_tokens` tokens. A new section starts a new chunk once the
+    current chunk is half full, and oversized paragraphs fall back to sentence splits.
+    """
+    paragraph_regex = re.compile(r'\n[ \t]*\n\s*')
+    sentence_regex = re.compile(r'.+?(?:[.!?。！？；]+["\'”’)）]*\s*|\n+|$)', re.DOTALL)
+    
+    def __init__(self, token_counter: Optional[TokenCounter] = None):
+        self.token_counter = token_counter or TokenCounter()
+        self.parser = DocumentParser()
+        
+    def target_chunk_tokens(self, total_tokens: int) -> int:
+        """Pick a chunk size: small documents get 1-2 chunks, larger ones at least 3."""
+        if total_tokens <= Config.CHUNK_SMALL_DOC_TOKENS:
+            return Config.CHUNK_SMALL_DOC_CHUNK_TOKENS
+        return max(1, min(Config.CHUNK_MAX_TOKENS, total_tokens // 3))
+        
+    def chunk_document(self, content: str, max_tokens: Optional[int] = None) -> List[DocumentChunk]:
+        """Split content into token-bounded chunks."""
+        if not content:
+            return []
+            
+        if max_tokens is None:
+            max_tokens = self.target_chunk_tokens(self.token_counter.count(content))
+        units = self._split_units(content, max_tokens)
+        chunks = self._pack_units(content, units, max_tokens)
+        logger.debug(f"Chunked document into {len(chunks)} chunks (max {max_tokens} tokens each)")
+        return chunks
+        
+    def _split_units(self, content: str, max_tokens: int) -> List[Tuple[int, int, int, Optional[str], bool]]:
+        """Split content into (start, end, tokens, section_title, starts_section) units of at most max_tokens."""
+        headings = self.parser._extract_headings(content)
+        boundaries = [(0, None)] if not headings or headings[0].start_char > 0 else []
+        boundaries.extend((heading.start_char, heading.title) for heading in headings)
+        
+        units = []
+        for idx, (section_start, title) in enumerate(boundaries):
+            section_end = boundaries[idx + 1][0] if idx + 1 < len(boundaries) else len(content)
+            starts_section = True
+            para_start = section_start
+            for match in self.paragraph_regex.finditer(content, section_start, section_end):
+                units.extend(self._paragraph_units(content, para_start, match.end(), title, starts_section, max_tokens))
+                starts_section = False
+                para_start = match.end()
+            if para_start < section_end:
+                units.extend(self._paragraph_units(content, para_start, section_end, title, starts_section, max_tokens))
+        return units
+    
+    def _paragraph_units(self, content: str, start: int, end: int, title: Optional[str],
+                         starts_section: bool, max_tokens: int) -> List[Tuple[int, int, int, Optional[str], bool]]:
+        """Return one unit for a paragraph, or sentence-sized units if it exceeds max_tokens."""
+        tokens = self.token_counter.count(content[start:end])
+        if tokens <= max_tokens:
+            return [(start, end, tokens, title, starts_section)]
+            
+        units = []
+        for match in self.sentence_regex.finditer(content, start, end):
+            if match.end() <= match.start():
+                continue
+            sentence_tokens = self.token_counter.count(match.group(0))
+            if sentence_tokens <= max_tokens:
+                units.append((match.start(), match.end(), sentence_tokens, title, starts_section and not units))
+                continue
+            # Hard split for pathological sentences (no punctuation at all)
+            piece_chars = max(1, (match.end() - match.start()) * max_tokens // sentence_tokens)
+            piece_start = match.start()
+            while piece_start < match.end():
+                piece_end = min(piece_start + piece_chars, match.end())
+                piece_tokens = self.token_counter.count(content[piece_start:piece_end])
+                # Tokens are not spread evenly over characters; shrink pieces that still overflow
+                while piece_tokens > max_tokens and piece_end - piece_start > 1:
+                    piece_end = piece_start + (piece_end - piece_start) // 2
+                    piece_tokens = self.token_counter.count(content[piece_start:piece_end])
+                units.append((piece_start, piece_end, piece_tokens, title, starts_section and not units))
+                piece_start = piece_end
+        return units
+        
+    def _pack_units(self, content: str, units: List[Tuple[int, int, int, Optional[str], bool]],
+                    max_tokens: int) -> List[DocumentChunk]:
+        """Greedily pack consecutive units into chunks, preferring to break at section starts."""
+        chunks = []
+        current = []
+        current_tokens = 0
+        
+        def flush():
+            start, end = current[0][0], current[-1][1]
+            chunks.append(DocumentChunk(
+                index=len(chunks),
+                text=content[start:end].strip(),
+                start_char=start,
+                end_char=end,
+                token_count=current_tokens,
+                section_title=current[0][3]
+            ))
+            
+        for unit in units:
+            tokens, starts_section = unit[2], unit[4]
+            if current and (current_tokens + tokens > max_tokens or
+                            (starts_section and current_tokens >= max_tokens // 2)):
+                flush()
+                current, current_tokens = [], 0
+            current.append(unit)
+            current_tokens += tokens
+        if current:
+            flush()
+        return [chunk for chunk in chunks if chunk.text]
+
+class BM25Index:
+    """Okapi BM25 ranking over document chunks, used to pick the chunks relevant to a topic locally."""
+    token_regex = re.compile(r'[a-z0-9]+|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+    stopwords = {
+        'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'in', 'is', 'it', 'its',
+        'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was', 'were', 'will', 'with'
+    }
+    
+    def __init__(self, texts: List[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = []
+        self.doc_lengths = []
+        doc_freqs = {}
+        for text in texts:
+            freqs = {}
+            for term in self.tokenize(text):
+                freqs[term] = freqs.get(term, 0) + 1
+            self.term_freqs.append(freqs)
+            self.doc_lengths.append(sum(freqs.values()))
+            for term in freqs:
+                doc_freqs[term] = doc_freqs.get(term, 0) + 1
+        self.avg_length = (sum(self.doc_lengths) / len(self.doc_lengths)) if self.doc_lengths else 0
+        n_docs = len(texts)
+        self.idf = {
+            term: math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            for term, df in doc_freqs.items()
+        }
+        
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        """Lowercased words for alphabetic text, character bigrams for CJK runs."""
+        terms = []
+        for match in cls.token_regex.finditer(text.lower()):
+            token = match.group(0)
+            if token[0].isascii():
+                if len(token) > 1 and token not in cls.stopwords:
+                    terms.append(token)
+            elif len(token) == 1:
+                terms.append(token)
+            else:
+                terms.extend(token[i:i + 2] for i in range(len(token) - 1))
+        return terms
+        
+    def scores(self, query: str) -> List[float]:
+        """BM25 score of every chunk for the query."""
+        query_terms = set(self.tokenize(query))
+        results = []
+        for freqs, length in zip(self.term_freqs, self.doc_lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / self.avg_length) if self.avg_length else self.k1
+            for term in query_terms:
+                tf = freqs.get(term)
+                if tf:
+                    score += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            results.append(score)
+        return results
+        
+    def top_k(self, query: str, k: int) -> List[int]:
+        """Indices of the k best matching chunks (score > 0), in document order."""
+        scored = [(score, idx) for idx, score in enumerate(self.scores(query)) if score > 0]
+        best = sorted(scored, key=lambda x: (-x[0], x[1]))[:k]
+        return sorted(idx for _, idx in best)
+
+class DocumentContext:
+    """Per-document data computed once per generation and shared by every pipeline stage."""
+    def __init__(self, content: str, chunks: List[DocumentChunk]):
+        self.content = content
+        self.content_hash = hashlib.md5(content.encode()).hexdigest()
+        self.doc_type_key = hashlib.md5(content[:1000].encode()).hexdigest()
+        self.chunks = chunks
+        self.chunk_texts = [chunk.text for chunk in chunks]
+        self.chunk_hashes = [hashlib.md5(chunk.text.encode()).hexdigest() for chunk in chunks]
+        self.chunk_token_counts = [chunk.token_count for chunk in chunks]
+        self.total_tokens = sum(self.chunk_token_counts)
+        self._bm25 = None
+        self._sections = None
+        self._section_terms = None
+        
+    @property
+    def sections(self) -> List[Tuple[int, int, str]]:
+        """(start_char, end_char, md5) of every DocumentParser section, including a preface before the first heading."""
+        if self._sections is None:
+            headings = DocumentParser()._extract_headings(self.content)
+            starts = [0] if not headings or headings[0].start_char > 0 else []
+            starts.extend(heading.start_char for heading in headings)
+            ends = starts[1:] + [len(self.content)]
+            self._sections = [
+                (start, end, hashlib.md5(self.content[start:end].encode()).hexdigest())
+                for start, end in zip(starts, ends)
+            ]
+        return self._sections
+        
+    @property
+    def section_hashes(self) -> List[str]:
+        return [section_hash for _, _, section_hash in self.sections]
+        
+    def supporting_sections(self, query: str, top_k: int) -> List[str]:
+        """Hashes of the sections that match the query, within the (at most top_k) chunks that match it.
+        
+        Unlike relevant_chunk_indices there is no fall back to every chunk, and a section inside a
+        matching chunk only counts if it shares a term with the query: a topic depends on the sections
+        it actually matches, so an edit elsewhere does not invalidate it.
+        """
+        query_terms = set(BM25Index.tokenize(query))
+        if self._section_terms is None:
+            self._section_terms = [set(BM25Index.tokenize(self.content[start:end])) for start, end, _ in self.sections]
+        covered = set()
+        for idx in self.scored_chunk_indices(query, top_k):
+            chunk = self.chunks[idx]
+            covered.update(
+                section_hash for (start, end, section_hash), terms in zip(self.sections, self._section_terms)
+                if start < chunk.end_char and end > chunk.start_char and terms & query_terms
+            )
+        return sorted(covered)
+        
+    def relevant_chunk_indices(self, query: str, top_k: int) -> List[int]:
+        """Chunks most relevant to the query; all chunks when the document is small or nothing matches."""
+        if top_k <= 0 or len(self.chunks) <= top_k:
+            return list(range(len(self.chunks)))
+        return self.scored_chunk_indices(query, top_k) or list(range(len(self.chunks)))
+        
+    def scored_chunk_indices(self, query: str, top_k: int) -> List[int]:
+        """The top_k chunks with a nonzero BM25 score for the query (every matching chunk if top_k <= 0)."""
+        if self._bm25 is None:
+            self._bm25 = BM25Index(self.chunk_texts)
+        return self._bm25.top_k(query, top_k if top_k > 0 else len(self.chunks))
+        
+    @classmethod
+    def from_content(cls, content: str, chunker: DocumentChunker) -> 'DocumentContext':
+        """Chunk and hash the document once."""
+        return cls(content, chunker.chunk_document(content))
+        
+    def __repr__(self):
+        return f"DocumentContext(chunks={len(self.chunks)}, tokens={self.total_tokens}, hash={self.content_hash[:8]})"
+
+class CheckpointStore:
+    """Persists generate_mindmap stage results per request id.
+    
+    Stage results are appended to a JSON Lines log (`<id>.jsonl`): a header with the content hash,
+    then one record per completed stage or per subtopic/detail item, so each save costs one small
+    append however long the run gets. A log is only used when it was written for the same document
+    content, so a request id reused for an edited document starts from scratch. Logs are removed
+    when their run completes, and logs left behind by failed or abandoned runs once they are older
+    than CHECKPOINT_MAX_AGE_HOURS.
+    
+    read/save store a whole payload as one JSON file (`<id>.json`), for data written once per run.
+    """
+    PRUNE_INTERVAL_SECONDS = 3600
+    
+    def __init__(self, directory: Optional[str] = None, enabled: Optional[bool] = None,
+                 max_age_hours: Optional[float] = None):
+        self.directory = directory or Config.CHECKPOINT_DIR
+        self.enabled = Config.ENABLE_CHECKPOINTS if enabled is None else enabled
+        self.max_age_hours = Config.CHECKPOINT_MAX_AGE_HOURS if max_age_hours is None else max_age_hours
+        self._append_lock: Optional[asyncio.Lock] = None
+        self._last_prune = 0.0
+        
+    def path_for(self, request_id: str, suffix: str = '.json') -> str:
+        safe_id = re.sub(r'[^\w.-]', '_', request_id)[:100] or 'default'
+        return os.path.join(self.directory, f"{safe_id}{suffix}")
+        
+    def log_path_for(self, request_id: str) -> str:
+        return self.path_for(request_id, '.jsonl')
+        
+    async def read(self, request_id: str) -> Optional[Dict[str, Any]]:
+        """Return the raw saved payload (request_id, content_hash, updated_at, stages), if any."""
+        if not self.enabled:
+            return None
+        path = self.path_for(request_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            async with aiofiles.open(path, 'r', encoding='utf-8') as f:
+                return json.loads(await f.read())
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Ignoring unreadable checkpoint {path}: {str(e)}")
+            return None
+        
+    async def save(self, request_id: str, content_hash: str, stages: Dict[str, Any]):
+        """Write a whole payload atomically (temp file + rename)."""
+        if not self.enabled:
+            return
+        path = self.path_for(request_id)
+        tmp_path = f"{path}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            payload = json.dumps({
+                'request_id': request_id,
+                'content_hash': content_hash,
+                'updated_at': datetime.now().isoformat(),
+                'stages': stages
+            }, ensure_ascii=False)
+            async with aiofiles.open(tmp_path, 'w', encoding='utf-8') as f:
+                await f.write(payload)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Failed to write checkpoint {path}: {str(e)}")
+        
+    async def load(self, request_id: str, content_hash: str) -> Dict[str, Any]:
+        """Replay this request's stage log into {stage: value} / {stage: {key: value}}, or an empty dict."""
+        if not self.enabled:
+            return {}
+        self.prune()
+        path = self.log_path_for(request_id)
+        if not os.path.exists(path):
+            return {}
+        try:
+            async with aiofiles.open(path, 'r', encoding='utf-8') as f:
+                lines = (await f.read()).splitlines()
+        except OSError as e:
+            logger.warning(f"Ignoring unreadable checkpoint {path}: {str(e)}")
+            return {}
+            
+        stages: Dict[str, Any] = {}
+        intact = []
+        for line_number, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-append leaves a torn last line; everything before it is intact
+                logger.warning(f"Ignoring truncated record {line_number + 1} in checkpoint {path}")
+                continue
+            intact.append(line)
+            if line_number == 0:
+                if record.get('content_hash') != content_hash:
+                    logger.info(f"Checkpoint for {request_id} was written for different content, starting fresh")
+                    self.clear(request_id)
+                    return {}
+                continue
+            if record.get('key') is None:
+                stages[record['stage']] = record['value']
+            else:
+                stages.setdefault(record['stage'], {})[record['key']] = record['value']
+        if len(intact) < len(lines):
+            # Drop torn records so the next append does not continue a broken line
+            try:
+                tmp_path = f"{path}.tmp"
+                async with aiofiles.open(tmp_path, 'w', encoding='utf-8') as f:
+                    await f.write(''.join(line + '\n' for line in intact))
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"Failed to rewrite checkpoint {path}: {str(e)}")
+        return stages
+        
+    async def append(self, request_id: str, content_hash: str, stage: str, value: Any, key: Optional[str] = None):
+        """Append one completed stage (or one keyed item of a stage) to the request's log."""
+        if not self.enabled:
+            return
+        path = self.log_path_for(request_id)
+        try:
+            # Serialize before the first await, so later mutations of value do not leak into the record
+            record = json.dumps({'stage': stage, 'key': key, 'value': value}, ensure_ascii=False) + '\n'
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Failed to write checkpoint {path}: {str(e)}")
+            return
+        if self._append_lock is None:
+            self._append_lock = asyncio.Lock()
+        async with self._append_lock:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                if not os.path.exists(path):
+                    record = json.dumps({
+                        'request_id': request_id,
+                        'content_hash': content_hash,
+                        'created_at': datetime.now().isoformat()
+                    }) + '\n' + record
+                async with aiofiles.open(path, 'a', encoding='utf-8') as f:
+                    await f.write(record)
+            except OSError as e:
+                logger.warning(f"Failed to write checkpoint {path}: {str(e)}")
+            
+    def clear(self, request_id: str):
+        if not self.enabled:
+            return
+        for path in (self.path_for(request_id), self.log_path_for(request_id)):
+            if os.path.exists(path):
+                os.remove(path)
+                
+    def prune(self):
+        """Remove stage logs older than max_age_hours (runs that failed or were abandoned); at most hourly."""
+        now = time.time()
+        if not self.enabled or self.max_age_hours <= 0 or now - self._last_prune < self.PRUNE_INTERVAL_SECONDS:
+            return
+        self._last_prune = now
+        cutoff = now - self.max_age_hours * 3600
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return
+        removed = 0
+        for entry in entries:
+            try:
+                if entry.name.endswith('.jsonl') and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                continue
+        if removed:
+            logger.info(f"Removed {removed} stale checkpoint logs from {self.directory}")
+
+_EMOJI_CACHE_FILE = os.getenv("EMOJI_CACHE_FILE") or os.path.join(os.path.dirname(__file__), "emoji_cache.json")
+_emoji_cache: Optional[Dict[Tuple[str, str], str]] = None
+
+def _load_emoji_cache() -> Dict[Tuple[str, str], str]:
+    """Return the process-wide emoji cache, loading it from disk on first use."""
+    global _emoji_cache
+    if _emoji_cache is not None:
+        return _emoji_cache
+    _emoji_cache = {}
+    try:
+        if os.path.exists(_EMOJI_CACHE_FILE):
+            with open(_EMOJI_CACHE_FILE, 'r', encoding='utf-8') as f:
+                loaded_cache = json.load(f)
+            # Keys are stored as tuple reprs; literal_eval parses them without executing code
+            _emoji_cache.update({tuple(ast.literal_eval(k)): v for k, v in loaded_cache.items()})
+            logger.info(f"Loaded {len(_emoji_cache)} emoji mappings from cache")
+    except Exception as e:
+        logger.warning(f"Failed to load emoji cache: {str(e)}")
+    return _emoji_cache
+
+def _save_emoji_cache():
+    """Save the shared emoji cache to disk; the file is replaced atomically so concurrent saves never interleave."""
+    if _emoji_cache is None:
+        return
+    try:
+        # Snapshot first: the event loop may add entries while this runs in an executor thread
+        snapshot = dict(_emoji_cache)
+        serializable_cache = {str(k): v for k, v in snapshot.items()}
+        tmp_path = f"{_EMOJI_CACHE_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(serializable_cache, f)
+        os.replace(tmp_path, _EMOJI_CACHE_FILE)
+        logger.info(f"Saved {len(snapshot)} emoji mappings to cache")
+    except Exception as e:
+        logger.warning(f"Failed to save emoji cache: {str(e)}")
+
+@dataclass
+class GenerationPlan:
+    """Strategy chosen by MindMapGenerator.plan_generation and the signals behind it."""
+    mode: str  # 'simple', 'hybrid' or 'full'
+    document_tokens: int
+    section_count: int
+    inflight_calls: int
+    provider_latency: Optional[float]  # Median recent call latency of the primary provider, in seconds
+    reasons: List[str] = field(default_factory=list)
+
+@dataclass
+class GenerationRun:
+    """Request-scoped state of one pipeline run.
+    
+    Every entry point of MindMapGenerator binds a run for its duration, so one generator can
+    serve several documents concurrently: caches that are safe to share across runs (prompts,
+    regexes, the emoji cache, in-flight LLM calls) live on the class or module, everything
+    that belongs to a single document lives here. Pass a run explicitly to inspect it afterwards.
+    """
+    content_cache: Dict[str, Any] = field(default_factory=dict)
+    llm_calls: Dict[str, int] = field(default_factory=lambda: {'topics': 0, 'subtopics': 0, 'details': 0})
+    unique_concepts: Dict[str, Set[str]] = field(
+        default_factory=lambda: {'topics': set(), 'subtopics': set(), 'details': set()}
+    )
+    subtopics_cache: Dict[str, List[Dict[str, Any]]] = field(default_factory=dict)
+    details_cache: Dict[str, List[Dict[str, Any]]] = field(default_factory=dict)
+    processed_chunks_by_topic: Dict[str, Set[str]] = field(default_factory=dict)
+    processed_chunks_by_subtopic: Dict[Tuple[str, str], Set[str]] = field(default_factory=dict)  # (topic, subtopic)
+    all_content: List[ContentItem] = field(default_factory=list)
+    content_by_path: Dict[Tuple[str, ...], ContentItem] = field(default_factory=dict)
+    last_verified_concepts: Optional[Dict[str, Any]] = None
+    trace: Optional[Span] = None  # Timing tree of the entry point that bound this run
+    usage: TokenUsageTracker = field(default_factory=TokenUsageTracker)  # Tokens and cost of this run's LLM calls
+    budget: RequestBudget = field(default_factory=RequestBudget.from_config)  # Limits that degrade the pipeline
+    plan: Optional[GenerationPlan] = None  # Strategy picked by generate_mindmap_auto
+
+# The run bound to the current task; asyncio tasks inherit it, so concurrent runs never see each other's state
+_active_run: contextvars.ContextVar[Optional[GenerationRun]] = contextvars.ContextVar('mindmap_generation_run', default=None)
+
+def _binds_run(method):
+    """Bind a GenerationRun (the `run` keyword, or a fresh one) while a pipeline entry point executes,
+    and record the call as the root span of the run's timing tree."""
+    @functools.wraps(method)
+    async def wrapper(self, *args, run: Optional[GenerationRun] = None, **kwargs):
+        run = run or GenerationRun()
+        # Entry points calling each other with the same run count as one active run
+        nested = _active_run.get() is run
+        token = _active_run.set(run)
+        run.budget.start(run.usage)
+        budget_token = _active_budget.set(run.budget)
+        if not nested:
+            ACTIVE_RUNS.inc()
+        try:
+            with usage_ledger(run.usage), trace_span(method.__name__) as span:
+                if run.trace is None:
+                    run.trace = span
+                return await method(self, *args, **kwargs)
+        finally:
+            _active_budget.reset(budget_token)
+            _active_run.reset(token)
+            if not nested:
+                ACTIVE_RUNS.dec()
+            if run.trace is span and Config.LOG_TIMING_REPORT:
+                logger.info(f"Timing report:\n{span.render()}")
+    return wrapper
+
 class MindMapGenerator:
+    # Process-wide immutable resources: compiled once and shared by every generator instance,
+    # so constructing a generator per job only allocates request-scoped state.
+    _shared_prompts: Optional[Tuple[str, str, Dict[DocumentType, Dict[str, str]]]] = None
+    numbered_pattern = re.compile(r'^\s*\d+\.\s*(.+)$')
+    parentheses_regex = re.compile(r'(\((?!\()|(?<!\))\))')
+    control_chars_regex = re.compile(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F-\x9F]')
+    unescaped_quotes_regex = re.compile(r'(?<!\\)"(?!,|\s*[}\]])')
+    percentage_regex1 = re.compile(r'(\d+(?:\.\d+)?)\s+(?=percent|of\s|share|margin|CAGR)', re.IGNORECASE)
+    percentage_regex2 = re.compile(r'\s+percent\b', re.IGNORECASE)
+    backslash_regex = re.compile(r'\\{2,}')
+    special_chars_regex = re.compile(r'[^a-zA-Z0-9\s\[\]\(\)\{\}\'_\-.,`*%\\]')
+    paren_replacements = {
+        '(': '❨',  # U+2768 MEDIUM LEFT PARENTHESIS ORNAMENT
+        ')': '❩',  # U+2769 MEDIUM RIGHT PARENTHESIS ORNAMENT
+        # Backup alternatives if needed:
+        # '(': '⟮',  # U+27EE MATHEMATICAL LEFT FLATTENED PARENTHESIS
+        # ')': '⟯',  # U+27EF MATHEMATICAL RIGHT FLATTENED PARENTHESIS
+        # Or:
+        # '(': '﹙',  # U+FE59 SMALL LEFT PARENTHESIS
+        # ')': '﹚',  # U+FE5A SMALL RIGHT PARENTHESIS
+    }
+
     def __init__(self):
         self.optimizer = DocumentOptimizer()
+        self.chunker = DocumentChunker()
+        self.checkpoints = CheckpointStore()
+        self.snapshots = CheckpointStore(Config.SNAPSHOT_DIR, enabled=Config.ENABLE_SNAPSHOTS)
+        # State for helper calls made outside a pipeline entry point (see `run`)
+        self._default_run = GenerationRun()
         self.config = {
             'max_summary_length': 2500,
             'max_tokens': 3000,
@@ -678,14 +2163,6 @@ class MindMapGenerator:
                 'min_verified_ratio': 0.6  # Minimum ratio of verified content
             }
         }
-        self.verification_stats = {
-            'total_nodes': 0,
-            'verified_nodes': 0,
-            'topics': {'total': 0, 'verified': 0},
-            'subtopics': {'total': 0, 'verified': 0},
-            'details': {'total': 0, 'verified': 0}
-        }
-        self._emoji_cache = {}
         self.retry_config = {
             'max_retries': 3,
             'base_delay': 1,
@@ -694,55 +2171,23 @@ class MindMapGenerator:
             'timeout': 30
         }
         self._initialize_prompts()
-        self.numbered_pattern = re.compile(r'^\s*\d+\.\s*(.+)$')
-        self.parentheses_regex = re.compile(r'(\((?!\()|(?<!\))\))')
-        self.control_chars_regex = re.compile(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F-\x9F]')
-        self.unescaped_quotes_regex = re.compile(r'(?<!\\)"(?!,|\s*[}\]])')
-        self.percentage_regex1 = re.compile(r'(\d+(?:\.\d+)?)\s+(?=percent|of\s|share|margin|CAGR)', re.IGNORECASE)
-        self.percentage_regex2 = re.compile(r'\s+percent\b', re.IGNORECASE)
-        self.backslash_regex = re.compile(r'\\{2,}')
-        self.special_chars_regex = re.compile(r'[^a-zA-Z0-9\s\[\]\(\)\{\}\'_\-.,`*%\\]')
-        self.paren_replacements = {
-            '(': '❨',  # U+2768 MEDIUM LEFT PARENTHESIS ORNAMENT
-            ')': '❩',  # U+2769 MEDIUM RIGHT PARENTHESIS ORNAMENT
-            # Backup alternatives if needed:
-            # '(': '⟮',  # U+27EE MATHEMATICAL LEFT FLATTENED PARENTHESIS
-            # ')': '⟯',  # U+27EF MATHEMATICAL RIGHT FLATTENED PARENTHESIS
-            # Or:
-            # '(': '﹙',  # U+FE59 SMALL LEFT PARENTHESIS
-            # ')': '﹚',  # U+FE5A SMALL RIGHT PARENTHESIS
-        }
-        self._emoji_file = os.path.join(os.path.dirname(__file__), "emoji_cache.json")
-        self._load_emoji_cache()
         
-    def _load_emoji_cache(self):
-        """Load emoji cache from disk if available."""
-        try:
-            if os.path.exists(self._emoji_file):
-                with open(self._emoji_file, 'r', encoding='utf-8') as f:
-                    loaded_cache = json.load(f)
-                    # Convert tuple string keys back to actual tuples
-                    self._emoji_cache = {tuple(eval(k)): v for k, v in loaded_cache.items()}
-                    logger.info(f"Loaded {len(self._emoji_cache)} emoji mappings from cache")
-            else:
-                self._emoji_cache = {}
-        except Exception as e:
-            logger.warning(f"Failed to load emoji cache: {str(e)}")
-            self._emoji_cache = {}
+    @property
+    def _emoji_cache(self) -> Dict[Tuple[str, str], str]:
+        """The process-wide emoji cache, read from disk when the first emoji is selected."""
+        return _load_emoji_cache()
+        
+    @property
+    def run(self) -> GenerationRun:
+        """State of the run executing in the current task (see GenerationRun)."""
+        return _active_run.get() or self._default_run
 
     def _save_emoji_cache(self):
         """Save emoji cache to disk for reuse across runs."""
-        try:
-            # Convert tuple keys to strings for JSON serialization
-            serializable_cache = {str(k): v for k, v in self._emoji_cache.items()}
-            with open(self._emoji_file, 'w', encoding='utf-8') as f:
-                json.dump(serializable_cache, f)
-            logger.info(f"Saved {len(self._emoji_cache)} emoji mappings to cache")
-        except Exception as e:
-            logger.warning(f"Failed to save emoji cache: {str(e)}")
+        _save_emoji_cache()
                 
     async def _retry_with_exponential_backoff(self, func, *args, **kwargs):
-        """Enhanced retry mechanism with jitter and circuit breaker."""
+        """Enhanced retry mechanism with jitter; stops retrying when every provider circuit is open."""
         retries = 0
         max_retries = self.retry_config['max_retries']
         base_delay = self.retry_config['base_delay']
@@ -753,7 +2198,7 @@ class MindMapGenerator:
                 return await func(*args, **kwargs)
             except Exception as e:
                 retries += 1
-                if retries >= max_retries:
+                if retries >= max_retries or not self.optimizer.available_providers():
                     raise
                     
                 delay = min(base_delay * (2 ** (retries - 1)), max_delay)
@@ -1028,7 +2473,12 @@ class MindMapGenerator:
         
         # First check in-memory cache
         if cache_key in self._emoji_cache:
+            CACHE_LOOKUPS.inc(cache='emoji', result='hit')
             return self._emoji_cache[cache_key]
+        CACHE_LOOKUPS.inc(cache='emoji', result='miss')
+        
+        if self.run.budget.degraded(Degradation.NO_EMOJI):
+            return '📄' if node_type == 'topic' else '📌' if node_type == 'subtopic' else '🔹'
             
         # If not in cache, generate emoji
         try:
@@ -1090,8 +2540,67 @@ class MindMapGenerator:
             logger.warning(f"Error selecting emoji: {str(e)}")
             return '📄' if node_type == 'topic' else '📌' if node_type == 'subtopic' else '🔹'
 
-    def _initialize_prompts(self) -> None:
-        """Initialize type-specific prompts from a configuration file or define them inline."""
+    def _initialize_prompts(self) -> None:
+        """Initialize type-specific prompts from a configuration file or define them inline.
+
+        The prompts are immutable, so they are built once per process and shared by every generator.
+        """
+        shared = MindMapGenerator._shared_prompts
+        if shared is not None:
+            self.similarity_prompt_prefix, self.verification_prompt_prefix, self.type_specific_prompts = shared
+            return
+        # Stable instruction prefixes, sent as the provider-cacheable part of the prompt
+        self.similarity_prompt_prefix = """Compare two text elements and determine if they express similar core information, making one redundant in the mindmap.
+
+        A text is REDUNDANT if ANY of these apply:
+        1. It conveys the same primary information or main point as the other text
+        2. It covers the same concept from a similar angle or perspective
+        3. The semantic meaning overlaps significantly with the other text
+        4. A reader would find having both entries repetitive or confusing
+        5. One could be safely removed without losing important information
+
+        A text is DISTINCT ONLY if ALL of these apply:
+        1. It focuses on a clearly different aspect or perspective
+        2. It provides substantial unique information not present in the other
+        3. It serves a fundamentally different purpose in context
+        4. Both entries together provide significantly more value than either alone
+        5. The conceptual overlap is minimal
+
+        When in doubt, mark as REDUNDANT to create a cleaner, more focused mindmap.
+
+        Respond with EXACTLY one of these:
+        REDUNDANT (overlapping information about X)
+        DISTINCT (different aspect: X)
+
+        where X is a very brief explanation.
+        """
+        self.verification_prompt_prefix = """You are an expert fact-checker verifying if information in a mindmap can be reasonably derived from the original document.
+
+            Task: Determine if the mindmap item given after the document chunk is supported by the document text or could be reasonably inferred from it.
+
+            VERIFICATION GUIDELINES:
+            1. The item can be EXPLICITLY mentioned OR reasonably inferred from the document, even through logical deduction
+            2. Logical synthesis, interpretation, and summarization of concepts in the document are STRONGLY encouraged
+            3. Content that represents a reasonable conclusion or implication from the document should be VERIFIED
+            4. Content that groups, categorizes, or abstracts ideas from the document should be VERIFIED
+            5. High-level insights that connect multiple concepts from the document should be VERIFIED
+            6. Only mark as unsupported if it contains specific claims that DIRECTLY CONTRADICT the document
+            7. GIVE THE BENEFIT OF THE DOUBT - if the content could plausibly be derived from the document, verify it
+            8. When uncertain, LEAN TOWARDS VERIFICATION rather than rejection - mindmaps are meant to be interpretive, not literal
+            9. For details specifically, allow for more interpretive latitude - they represent insights derived from the document
+            10. Consider historical and domain context that would be natural to include in an analysis
+
+            Answer ONLY with one of these formats:
+            - "YES: [brief explanation of how it's supported or can be derived]" 
+            - "NO: [brief explanation of why it contains information that directly contradicts the document]"
+
+            IMPORTANT: Remember to be GENEROUS in your interpretation. If there's any reasonable way the content could be derived from the document, even through multiple logical steps, mark it as verified. Only reject content that introduces completely new facts not derivable from the document or directly contradicts it.
+
+            Document chunk:
+            ```
+            {chunk}
+            ```
+            """
         self.type_specific_prompts = {
             DocumentType.TECHNICAL: {
                 'topics': """Analyze this technical document focusing on core system components and relationships.
@@ -1764,7 +3273,13 @@ class MindMapGenerator:
         for doc_type in DocumentType:
             if doc_type not in self.type_specific_prompts:
                 self.type_specific_prompts[doc_type] = self.type_specific_prompts[DocumentType.GENERAL]
+        MindMapGenerator._shared_prompts = (
+            self.similarity_prompt_prefix,
+            self.verification_prompt_prefix,
+            self.type_specific_prompts
+        )
 
+    @traced('detect_document_type')
     async def detect_document_type(self, content: str, request_id: str) -> DocumentType:
         """Use LLM to detect document type with sophisticated analysis."""
         summary_content = content[:self.config['max_summary_length']]
@@ -1973,6 +3488,7 @@ class MindMapGenerator:
                 }, indent_level + 2)
                 mindmap_lines.append(detail_line)
 
+    @traced('batch_redundancy_check')
     async def _batch_redundancy_check(self, items, content_type='topic', context_prefix='', batch_size=10):
         """Perform early batch redundancy checks to avoid wasting LLM calls.
         
@@ -2004,7 +3520,8 @@ class MindMapGenerator:
                 seen_names[item_name] = item
         
         # If we still have lots of items, use more aggressive LLM-based similarity
-        if len(unique_items) > 3 and len(unique_items) > len(items) * 0.8:  # Only if enough items and not much reduction yet
+        if (len(unique_items) > 3 and len(unique_items) > len(items) * 0.8  # Only if enough items and not much reduction yet
+                and not self.run.budget.degraded(Degradation.LEXICAL_DEDUP)):
             try:
                 # Create pairs for comparison
                 pairs_to_check = []
@@ -2030,7 +3547,8 @@ class MindMapGenerator:
                                 unique_items[i]['name'],
                                 unique_items[j]['name'],
                                 context1,
-                                context2
+                                context2,
+                                content_type
                             )
                             
                             if is_redundant:
@@ -2169,44 +3687,32 @@ class MindMapGenerator:
         
         return False
 
-    async def check_similarity_llm(self, text1: str, text2: str, context1: str, context2: str) -> bool:
-        """LLM-based similarity check between two text elements with stricter criteria."""
-        prompt = f"""Compare these two text elements and determine if they express similar core information, making one redundant in the mindmap.
-
+    async def check_similarity_llm(self, text1: str, text2: str, context1: str, context2: str,
+                                   content_type: str = 'topic') -> bool:
+        """LLM-based similarity check between two text elements with stricter criteria.
+        
+        Falls back to fuzzy matching (is_similar_to_existing) with the thresholds of `content_type`
+        ('topic', 'subtopic' or 'detail') once the budget calls for lexical dedup.
+        """
+        if self.run.budget.degraded(Degradation.LEXICAL_DEDUP):
+            return await self.is_similar_to_existing(text1, {text2}, content_type)
+        
+        # The criteria go first as a stable, cacheable prefix; only the compared texts vary
+        prompt = f"""
         Text 1 (from {context1}):
         "{text1}"
 
         Text 2 (from {context2}):
         "{text2}"
-
-        A text is REDUNDANT if ANY of these apply:
-        1. It conveys the same primary information or main point as the other text
-        2. It covers the same concept from a similar angle or perspective
-        3. The semantic meaning overlaps significantly with the other text
-        4. A reader would find having both entries repetitive or confusing
-        5. One could be safely removed without losing important information
-
-        A text is DISTINCT ONLY if ALL of these apply:
-        1. It focuses on a clearly different aspect or perspective
-        2. It provides substantial unique information not present in the other
-        3. It serves a fundamentally different purpose in context
-        4. Both entries together provide significantly more value than either alone
-        5. The conceptual overlap is minimal
-
-        When in doubt, mark as REDUNDANT to create a cleaner, more focused mindmap.
-
-        Respond with EXACTLY one of these:
-        REDUNDANT (overlapping information about X)
-        DISTINCT (different aspect: X)
-
-        where X is a very brief explanation."""
+        """
 
         try:
             response = await self._retry_generate_completion(
                 prompt,
                 max_tokens=50,
                 request_id='similarity_check',
-                task="checking_content_similarity"
+                task="checking_content_similarity",
+                cache_prefix=self.similarity_prompt_prefix
             )
             
             # Consider anything not explicitly marked as DISTINCT to be REDUNDANT
@@ -2321,7 +3827,8 @@ class MindMapGenerator:
                                 content_items[idx1].text, 
                                 content_items[idx2].text,
                                 content_items[idx1].path_str, 
-                                content_items[idx2].path_str
+                                content_items[idx2].path_str,
+                                'topic' if content_items[idx1].node_type == 'root' else content_items[idx1].node_type
                             )
                             
                             # Calculate confidence if redundant
@@ -2442,8 +3949,8 @@ class MindMapGenerator:
                 # Only add if path is non-empty
                 if current_node_path:
                     path_tuple = tuple(current_node_path)
-                    self.all_content.append(content_item)
-                    self.content_by_path[path_tuple] = content_item
+                    self.run.all_content.append(content_item)
+                    self.run.content_by_path[path_tuple] = content_item
 
             # Process details at current level
             for detail in node.get('details', []):
@@ -2458,8 +3965,8 @@ class MindMapGenerator:
                             importance=detail.get('importance', 'medium')
                         )
                         detail_path_tuple = tuple(detail_path)
-                        self.all_content.append(detail_item)
-                        self.content_by_path[detail_path_tuple] = detail_item
+                        self.run.all_content.append(detail_item)
+                        self.run.content_by_path[detail_path_tuple] = detail_item
 
             # Process subtopics
             for subtopic in node.get('subtopics', []):
@@ -2469,6 +3976,7 @@ class MindMapGenerator:
             for subtopic in node.get('subtopics', []):
                 self._extract_content_for_filtering(subtopic, current_path)
 
+    @traced('final_filter')
     async def final_pass_filter_for_duplicative_content(self, mindmap_data: Dict[str, Any], batch_size: int = 50) -> Dict[str, Any]:
         """Enhanced filter for duplicative content with more aggressive detection and safer rebuilding."""
         USE_VERBOSE = True  # Toggle for verbose logging
@@ -2500,8 +4008,8 @@ class MindMapGenerator:
         
         # Initialize instance variables for content tracking
         vlog("\n🔄 Initializing content tracking...", 'yellow')
-        self.all_content = []
-        self.content_by_path = {}
+        self.run.all_content = []
+        self.run.content_by_path = {}
         
         # Extract all content items for filtering
         vlog("\n📋 Starting content extraction from central theme...", 'blue', True)
@@ -2510,9 +4018,9 @@ class MindMapGenerator:
             self._extract_content_for_filtering(mindmap_data.get('central_theme', {}), [])
             
             # Verify extraction worked
-            vlog(f"✅ Successfully extracted {len(self.all_content)} total content items:", 'green')
+            vlog(f"✅ Successfully extracted {len(self.run.all_content)} total content items:", 'green')
             content_types = {}
-            for item in self.all_content:
+            for item in self.run.all_content:
                 content_types[item.node_type] = content_types.get(item.node_type, 0) + 1
             for node_type, count in content_types.items():
                 vlog(f"  - {node_type}: {count} items", 'green')
@@ -2521,7 +4029,7 @@ class MindMapGenerator:
             return mindmap_data  # Return original data on error
         
         # Check if we have any content to filter
-        initial_count = len(self.all_content)
+        initial_count = len(self.run.all_content)
         if initial_count == 0:
             vlog("❌ No content extracted - mindmap appears empty", 'red', True)
             return mindmap_data  # Return original data
@@ -2529,8 +4037,8 @@ class MindMapGenerator:
         # Process content in batches for memory efficiency
         vlog("\n🔄 Processing content in batches...", 'yellow', True)
         content_batches = [
-            self.all_content[i:i+batch_size] 
-            for i in range(0, len(self.all_content), batch_size)
+            self.run.all_content[i:i+batch_size] 
+            for i in range(0, len(self.run.all_content), batch_size)
         ]
         
         all_to_remove = set()
@@ -2546,17 +4054,17 @@ class MindMapGenerator:
             vlog(f"Batch {batch_idx+1} complete: identified {len(batch_to_remove)} redundant items", 'green')
         
         # Get indices of items to keep
-        keep_indices = set(range(len(self.all_content))) - all_to_remove
+        keep_indices = set(range(len(self.run.all_content))) - all_to_remove
         
         # Convert to set of paths to keep
         vlog("\n🔄 Converting to paths for rebuild...", 'blue')
-        keep_paths = {tuple(self.all_content[i].path) for i in keep_indices}
+        keep_paths = {tuple(self.run.all_content[i].path) for i in keep_indices}
         vlog(f"Keeping {len(keep_paths)} unique paths", 'blue')
         
         # Safety check - add at least one path if none remain
-        if not keep_paths and len(self.all_content) > 0:
+        if not keep_paths and len(self.run.all_content) > 0:
             vlog("⚠️ No paths remained after filtering! Adding at least one path", 'yellow', True)
-            first_item = self.all_content[0]
+            first_item = self.run.all_content[0]
             keep_paths.add(tuple(first_item.path))
         
         # Rebuild the mindmap with only the paths to keep
@@ -2645,12 +4153,19 @@ class MindMapGenerator:
         
         return result_mindmap
 
-    async def generate_mindmap(self, document_content: str, request_id: str) -> str:
+    @_binds_run
+    async def generate_mindmap(self, document_content: str, request_id: str,
+                               on_progress: Optional[Callable[[Dict[str, Any]], Any]] = None) -> str:
         """Generate a complete mindmap from document content with balanced coverage of all topics.
         
         Args:
             document_content (str): The document content to analyze
             request_id (str): Unique identifier for request tracking
+            on_progress (Callable, optional): Called (and awaited if it returns an awaitable) with
+                a progress event dict as each stage produces output; see generate_mindmap_stream
+            run (GenerationRun, optional): State for this run; a fresh one is created if omitted.
+                As run.budget is used up the pipeline skips emoji selection, then LLM similarity
+                checks, then verification, and finally falls back to generate_mindmap_simple
             
         Returns:
             str: Complete Mermaid mindmap syntax
@@ -2661,20 +4176,7 @@ class MindMapGenerator:
         try:
             logger.info("Starting mindmap generation process...", extra={"request_id": request_id})
             
-            # Initialize content caching and LLM call tracking
-            self._content_cache = {}
-            self._llm_calls = {
-                'topics': 0,
-                'subtopics': 0,
-                'details': 0
-            }
-            
-            # Initialize tracking of unique concepts
-            self._unique_concepts = {
-                'topics': set(),
-                'subtopics': set(),
-                'details': set()
-            }
+            # Content caching, LLM call and unique concept tracking live on the run (GenerationRun)
             
             # Enhanced completion tracking
             completion_status = {
@@ -2722,48 +4224,98 @@ class MindMapGenerator:
                         return False
                 return True
                                         
+            async def emit(event_type: str, **data):
+                await self._emit_progress(on_progress, request_id, event_type, **data)
+            
+            async def fall_back_to_simple() -> str:
+                # Too little budget left for the staged pipeline: one prompt for the whole mindmap
+                mermaid_syntax = await self.generate_mindmap_simple(document_content, request_id, run=self.run)
+                await emit('complete', mermaid=mermaid_syntax, verified=False)
+                return mermaid_syntax
+            
+            # Chunk and hash the document once; every stage below shares this context
+            doc_context = DocumentContext.from_content(document_content, self.chunker)
+            logger.info(f"Prepared {len(doc_context.chunks)} chunks ({doc_context.total_tokens:,} tokens)",
+                        extra={"request_id": request_id})
+            
+            # Resume from the stages completed by an earlier run with this request id
+            checkpoint = await self.checkpoints.load(request_id, doc_context.content_hash)
+            if checkpoint:
+                logger.info(f"Resuming from checkpoint with stages: {', '.join(checkpoint)}",
+                            extra={"request_id": request_id})
+            
+            async def save_checkpoint(stage: str, value: Any, key: Optional[str] = None):
+                await self.checkpoints.append(request_id, doc_context.content_hash, stage, value, key)
+            
+            # Checkpointed subtopics/details use the same keys as the content cache below
+            for stage in ('subtopics', 'details'):
+                for key, items in checkpoint.get(stage, {}).items():
+                    self.run.content_cache[key] = copy.deepcopy(items)
+            
             # Check cache first for document type with strict caching
-            doc_type_key = hashlib.md5(document_content[:1000].encode()).hexdigest()
-            if doc_type_key in self._content_cache:
-                doc_type = self._content_cache[doc_type_key]
+            doc_type_key = doc_context.doc_type_key
+            if 'doc_type' in checkpoint:
+                doc_type = DocumentType[checkpoint['doc_type']]
+                self.run.content_cache[doc_type_key] = doc_type
+            elif doc_type_key in self.run.content_cache:
+                doc_type = self.run.content_cache[doc_type_key]
             else:
                 doc_type = await self.detect_document_type(document_content, request_id)
-                self._content_cache[doc_type_key] = doc_type
-                self._llm_calls['topics'] += 1
+                self.run.content_cache[doc_type_key] = doc_type
+                self.run.llm_calls['topics'] += 1
+                await save_checkpoint('doc_type', doc_type.name)
                 
             logger.info(f"Detected document type: {doc_type.name}", extra={"request_id": request_id})
+            await emit('document_type', doc_type=doc_type.name)
             
             type_prompts = self.type_specific_prompts[doc_type]
             
             # Extract main topics with enhanced LLM call limit and uniqueness check
-            if self._llm_calls['topics'] < max_llm_calls['topics']:
+            if not checkpoint.get('main_topics') and self.run.budget.degraded(Degradation.SIMPLE):
+                return await fall_back_to_simple()
+            if checkpoint.get('main_topics'):
+                main_topics = copy.deepcopy(checkpoint['main_topics'])
+                completion_status['total_topics'] = len(main_topics)
+            elif self.run.llm_calls['topics'] < max_llm_calls['topics']:
                 logger.info("Extracting main topics...", extra={"request_id": request_id})
-                main_topics = await self._extract_main_topics(document_content, type_prompts['topics'], request_id)
-                self._llm_calls['topics'] += 1
+                main_topics = await self._extract_main_topics(doc_context, type_prompts['topics'], request_id)
+                self.run.llm_calls['topics'] += 1
                 
                 # NEW: Perform early redundancy check on main topics
                 main_topics = await self._batch_redundancy_check(main_topics, 'topic')
                 
                 completion_status['total_topics'] = len(main_topics)
+                if main_topics:
+                    await save_checkpoint('main_topics', main_topics)
             else:
                 logger.info("Using cached main topics to avoid excessive LLM calls")
-                main_topics = self._content_cache.get('main_topics', [])
+                main_topics = self.run.content_cache.get('main_topics', [])
                 completion_status['total_topics'] = len(main_topics)
             
             if not main_topics:
                 raise MindMapGenerationError("No main topics could be extracted from the document")
                 
             # Cache main topics with timestamp
-            self._content_cache['main_topics'] = {
+            self.run.content_cache['main_topics'] = {
                 'data': main_topics,
                 'timestamp': time.time()
             }
 
+            await emit('topics', topics=[topic['name'] for topic in main_topics])
+            
             # Process topics with completion tracking
             processed_topics = {}
             # NEW: Track already processed topics for redundancy checking
             processed_topic_names = {}
             
+            def partial_mermaid(current_topic: Optional[Dict[str, Any]] = None,
+                                current_subtopics: Optional[Dict[str, Any]] = None) -> str:
+                """Mermaid for what has been extracted so far, including the topic in progress."""
+                topics = list(processed_topics.values())
+                if current_topic is not None:
+                    topics.append({**current_topic, 'subtopics': list((current_subtopics or {}).values())})
+                return self._generate_mermaid_mindmap({'central_theme': {'subtopics': topics}})
+            
             for topic_idx, topic in enumerate(main_topics, 1):
                 # Don't stop early if we haven't processed minimum topics
                 should_continue = (topic_idx <= min_requirements['topics'] or 
@@ -2773,6 +4325,12 @@ class MindMapGenerator:
                 if not should_continue:
                     logger.info(f"Stopping after processing {topic_idx} topics - sufficient content gathered")
                     break
+                
+                if self.run.budget.degraded(Degradation.SIMPLE):
+                    if not processed_topics:
+                        return await fall_back_to_simple()
+                    logger.info(f"Budget nearly used up, stopping after {len(processed_topics)} topics")
+                    break
         
                 topic_name = topic['name']
                 
@@ -2800,20 +4358,22 @@ class MindMapGenerator:
                         extra={"request_id": request_id})
                 
                 # Track unique concepts with validation
-                if topic_name not in self._unique_concepts['topics']:
-                    self._unique_concepts['topics'].add(topic_name)
+                if topic_name not in self.run.unique_concepts['topics']:
+                    self.run.unique_concepts['topics'].add(topic_name)
                     completion_status['processed_topics'] += 1
 
                 try:
                     # Enhanced subtopic processing with caching
                     topic_key = hashlib.md5(f"{topic_name}:{doc_type_key}".encode()).hexdigest()
-                    if topic_key in self._content_cache:
-                        subtopics = self._content_cache[topic_key]
+                    if topic_key in self.run.content_cache:
+                        subtopics = self.run.content_cache[topic_key]
+                        CACHE_LOOKUPS.inc(cache='content', result='hit')
                         logger.info(f"Using cached subtopics for topic: {topic_name}")
                     else:
-                        if self._llm_calls['subtopics'] < max_llm_calls['subtopics']:
+                        CACHE_LOOKUPS.inc(cache='content', result='miss')
+                        if self.run.llm_calls['subtopics'] < max_llm_calls['subtopics']:
                             subtopics = await self._extract_subtopics(
-                                topic, document_content, type_prompts['subtopics'], request_id
+                                topic, doc_context, type_prompts['subtopics'], request_id
                             )
                             
                             # NEW: Perform early redundancy check on subtopics
@@ -2821,13 +4381,17 @@ class MindMapGenerator:
                                 subtopics, 'subtopic', context_prefix=topic_name
                             )
                             
-                            self._content_cache[topic_key] = subtopics
-                            self._llm_calls['subtopics'] += 1
+                            self.run.content_cache[topic_key] = subtopics
+                            self.run.llm_calls['subtopics'] += 1
+                            await save_checkpoint('subtopics', subtopics, key=topic_key)
                         else:
                             logger.info("Reached subtopic LLM call limit")
                             break
                             
                     topic['subtopics'] = []
+                    await emit('subtopics', topic=topic_name,
+                               subtopics=[subtopic['name'] for subtopic in subtopics or []],
+                               mermaid=partial_mermaid(topic))
                     
                     if subtopics:
                         completion_status['total_subtopics'] += len(subtopics)
@@ -2838,7 +4402,7 @@ class MindMapGenerator:
                         
                         # Process each subtopic with completion tracking
                         for subtopic_idx, subtopic in enumerate(subtopics, 1):
-                            if self._llm_calls['details'] >= max_llm_calls['details']:
+                            if self.run.llm_calls['details'] >= max_llm_calls['details']:
                                 logger.info("Reached maximum LLM calls for detail extraction")
                                 break
                                 
@@ -2867,22 +4431,26 @@ class MindMapGenerator:
                             current_word_count += subtopic_words
                             
                             # Track unique subtopics
-                            self._unique_concepts['subtopics'].add(subtopic_name)
+                            self.run.unique_concepts['subtopics'].add(subtopic_name)
                             completion_status['processed_subtopics'] += 1
 
                             try:
                                 # Enhanced detail processing with caching
                                 subtopic_key = hashlib.md5(f"{subtopic_name}:{topic_key}".encode()).hexdigest()
-                                if subtopic_key in self._content_cache:
-                                    details = self._content_cache[subtopic_key]
+                                if subtopic_key in self.run.content_cache:
+                                    details = self.run.content_cache[subtopic_key]
+                                    CACHE_LOOKUPS.inc(cache='content', result='hit')
                                     logger.info(f"Using cached details for subtopic: {subtopic_name}")
                                 else:
-                                    if self._llm_calls['details'] < max_llm_calls['details']:
+                                    CACHE_LOOKUPS.inc(cache='content', result='miss')
+                                    if self.run.llm_calls['details'] < max_llm_calls['details']:
                                         details = await self._extract_details(
-                                            subtopic, document_content, type_prompts['details'], request_id
+                                            subtopic, doc_context, type_prompts['details'], request_id,
+                                            topic_name=topic_name
                                         )
-                                        self._content_cache[subtopic_key] = details
-                                        self._llm_calls['details'] += 1
+                                        self.run.content_cache[subtopic_key] = details
+                                        self.run.llm_calls['details'] += 1
+                                        await save_checkpoint('details', details, key=subtopic_key)
                                     else:
                                         details = []
                                 
@@ -2906,11 +4474,14 @@ class MindMapGenerator:
                                             current_word_count += detail_words
                                             seen_details[detail['text']] = True
                                             unique_details.append(detail)
-                                            self._unique_concepts['details'].add(detail['text'])
+                                            self.run.unique_concepts['details'].add(detail['text'])
                                     
                                     subtopic['details'] = unique_details
                                 
                                 processed_subtopics[subtopic_name] = subtopic
+                                await emit('details', topic=topic_name, subtopic=subtopic_name,
+                                           details=[detail['text'] for detail in subtopic['details']],
+                                           mermaid=partial_mermaid(topic, processed_subtopics))
                                 
                             except Exception as e:
                                 logger.error(f"Error processing details for subtopic '{subtopic_name}': {str(e)}")
@@ -2944,10 +4515,10 @@ class MindMapGenerator:
                 'completion_percentage': (current_word_count/word_limit)*100,
                 'topics_processed': completion_status['processed_topics'],
                 'total_topics': completion_status['total_topics'],
-                'unique_topics': len(self._unique_concepts['topics']),
-                'unique_subtopics': len(self._unique_concepts['subtopics']),
-                'unique_details': len(self._unique_concepts['details']),
-                'llm_calls': self._llm_calls,
+                'unique_topics': len(self.run.unique_concepts['topics']),
+                'unique_subtopics': len(self.run.unique_concepts['subtopics']),
+                'unique_details': len(self.run.unique_concepts['details']),
+                'llm_calls': self.run.llm_calls,
                 'early_stopping': has_sufficient_content()
             }
             
@@ -2974,29 +4545,43 @@ class MindMapGenerator:
                 
             logger.info("Starting duplicate content filtering...")
             try:
-                # Explicitly await the filtering
-                filtered_concepts = await self.final_pass_filter_for_duplicative_content(
-                    concepts,
-                    batch_size=25
-                )
-                
-                if not filtered_concepts:
-                    logger.warning("Filtering removed all content, using original mindmap")
-                    filtered_concepts = concepts
+                if 'filtered' in checkpoint:
+                    filtered_concepts = checkpoint['filtered']
+                else:
+                    # Explicitly await the filtering
+                    filtered_concepts = await self.final_pass_filter_for_duplicative_content(
+                        concepts,
+                        batch_size=25
+                    )
                     
-                # NEW: Perform reality check against original document
-                logger.info("Starting reality check to filter confabulations...")
-                verified_concepts = await self.verify_mindmap_against_source(
-                    filtered_concepts, 
-                    document_content
-                )
-                
-                if not verified_concepts or not verified_concepts.get('central_theme', {}).get('subtopics'):
-                    logger.warning("Reality check removed all content, using filtered mindmap with warning")
+                    if not filtered_concepts:
+                        logger.warning("Filtering removed all content, using original mindmap")
+                        filtered_concepts = concepts
+                    await save_checkpoint('filtered', filtered_concepts)
+                await emit('filtered', mermaid=self._generate_mermaid_mindmap(filtered_concepts))
+                    
+                verified = True
+                if 'verified' in checkpoint:
+                    verified_concepts = checkpoint['verified']
+                elif self.run.budget.degraded(Degradation.NO_VERIFICATION):
+                    logger.info("Skipping reality check to stay within the request budget")
                     verified_concepts = filtered_concepts
+                    verified = False
+                else:
+                    # NEW: Perform reality check against original document
+                    logger.info("Starting reality check to filter confabulations...")
+                    verified_concepts = await self.verify_mindmap_against_source(
+                        filtered_concepts, 
+                        doc_context
+                    )
+                    
+                    if not verified_concepts or not verified_concepts.get('central_theme', {}).get('subtopics'):
+                        logger.warning("Reality check removed all content, using filtered mindmap with warning")
+                        verified_concepts = filtered_concepts
+                    await save_checkpoint('verified', verified_concepts)
                 
                 # Print enhanced usage report with detailed breakdowns
-                self.optimizer.token_tracker.print_usage_report()
+                self.run.usage.print_usage_report()
 
                 try:
                     self._save_emoji_cache()  # Save cache at the end of processing
@@ -3004,26 +4589,238 @@ class MindMapGenerator:
                     logger.warning(f"Failed to save emoji cache: {str(e)}")
                                     
                 logger.info("Successfully verified against source document, generating final mindmap...")
-                return self._generate_mermaid_mindmap(verified_concepts)
+                mermaid_syntax = self._generate_mermaid_mindmap(verified_concepts)
+                self.run.last_verified_concepts = verified_concepts
+                # The run completed, so its checkpoint is no longer needed
+                self.checkpoints.clear(request_id)
+                await emit('complete', mermaid=mermaid_syntax, verified=verified)
+                return mermaid_syntax
                 
             except Exception as e:
                 logger.error(f"Error during content filtering or verification: {str(e)}")
                 logger.warning("Using unfiltered mindmap due to filtering/verification error")
                 
                 # Print usage report even if verification fails
-                self.optimizer.token_tracker.print_usage_report()
+                self.run.usage.print_usage_report()
                 
-                return self._generate_mermaid_mindmap(concepts)
+                mermaid_syntax = self._generate_mermaid_mindmap(concepts)
+                await emit('complete', mermaid=mermaid_syntax, verified=False)
+                return mermaid_syntax
 
         except Exception as e:
             logger.error(f"Error in mindmap generation: {str(e)}", extra={"request_id": request_id})
             raise MindMapGenerationError(f"Failed to generate mindmap: {str(e)}")
 
-    async def _extract_main_topics(self, content: str, topics_prompt: str, request_id: str) -> List[Dict[str, Any]]:
+    async def generate_mindmap_stream(self, document_content: str, request_id: str,
+                                      run: Optional[GenerationRun] = None,
+                                      strategy: str = 'full') -> AsyncIterator[Dict[str, Any]]:
+        """Run generate_mindmap and yield its progress events as they happen.
+        
+        `strategy` selects the entry point: 'full' (generate_mindmap), 'hybrid'
+        (generate_mindmap_hybrid) or 'auto' (generate_mindmap_auto).
+        
+        Events are dicts with a 'type' and the request_id:
+            plan           - mode, reasons: strategy chosen by the planner ('auto' only)
+            document_type  - doc_type
+            topics         - topics: main topic names
+            subtopics      - topic, subtopics, mermaid: partial mindmap so far
+            details        - topic, subtopic, details, mermaid: partial mindmap so far
+            filtered       - mermaid: mindmap after duplicate filtering
+            complete       - mermaid: final mindmap, verified: whether the reality check ran
+            error          - message (generation failed; nothing follows)
+        
+        Closing the generator early cancels the underlying generation. Pass `run` to read its
+        state (e.g. the timing tree in run.trace) once the stream ends.
+        """
+        entry_points = {
+            'full': self.generate_mindmap,
+            'hybrid': self.generate_mindmap_hybrid,
+            'auto': self.generate_mindmap_auto
+        }
+        if strategy not in entry_points:
+            raise ValueError(f"Unknown generation strategy: {strategy}")
+        generate = entry_points[strategy]
+        queue: asyncio.Queue = asyncio.Queue()
+        
+        async def produce():
+            try:
+                await generate(document_content, request_id, on_progress=queue.put, run=run)
+            except Exception as e:
+                await queue.put({'type': 'error', 'request_id': request_id, 'message': str(e)})
+            finally:
+                await queue.put(None)
+                
+        task = asyncio.create_task(produce())
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                yield event
+        finally:
+            if not task.done():
+                task.cancel()
+    
+    @_binds_run
+    async def generate_mindmap_incremental(self, document_content: str, document_key: str,
+                                           request_id: Optional[str] = None) -> str:
+        """Regenerate a document's mindmap after an edit, re-extracting only what the edit touched.
+        
+        The last verified mindmap for `document_key` is kept as a snapshot together with the
+        DocumentParser sections that support each topic and subtopic (the sections covered by the
+        chunks retrieval selects for it). On the next call, topics whose supporting sections changed
+        get their subtopics and details re-extracted, subtopics whose sections changed get new
+        details, and only those rebuilt nodes are verified again; the rest of the tree is reused.
+        Without a snapshot, or when more than INCREMENTAL_MAX_CHANGED_RATIO of the sections changed,
+        this falls back to generate_mindmap. Main topics are never re-extracted incrementally.
+        
+        Args:
+            document_content (str): The current document content
+            document_key (str): Stable identifier of the document across edits
+            request_id (str, optional): Identifier for request tracking, defaults to document_key
+            
+        Returns:
+            str: Complete Mermaid mindmap syntax
+        """
+        request_id = request_id or document_key
+        doc_context = DocumentContext.from_content(document_content, self.chunker)
+        snapshot = await self.snapshots.read(document_key) or {}
+        stages = snapshot.get('stages', {})
+        
+        if stages.get('mindmap') and snapshot.get('content_hash') == doc_context.content_hash:
+            logger.info("Document unchanged since the last generation, reusing snapshot", extra={"request_id": request_id})
+            return self._generate_mermaid_mindmap(stages['mindmap'])
+        
+        old_sections = set(stages.get('sections', []))
+        new_sections = set(doc_context.section_hashes)
+        changed_ratio = len(old_sections ^ new_sections) / max(len(old_sections | new_sections), 1)
+        
+        if not stages.get('mindmap') or changed_ratio > Config.INCREMENTAL_MAX_CHANGED_RATIO:
+            logger.info(f"Running full generation (snapshot: {bool(stages.get('mindmap'))}, "
+                        f"changed sections: {changed_ratio:.0%})", extra={"request_id": request_id})
+            mermaid_syntax = await self.generate_mindmap(document_content, request_id, run=self.run)
+            if self.run.last_verified_concepts:
+                await self._save_snapshot(document_key, doc_context,
+                                          self.run.content_cache[doc_context.doc_type_key],
+                                          self.run.last_verified_concepts)
+            return mermaid_syntax
+        
+        logger.info(f"Incremental regeneration: {changed_ratio:.0%} of sections changed", extra={"request_id": request_id})
+        doc_type = DocumentType[stages['doc_type']]
+        type_prompts = self.type_specific_prompts[doc_type]
+        support = stages.get('support', {})
+        mindmap_data = copy.deepcopy(stages['mindmap'])
+        central_theme = mindmap_data['central_theme']
+        
+        rebuilt = {}  # topic name -> names of rebuilt subtopics, or None when the whole topic was rebuilt
+        to_verify = []
+        for topic in central_theme.get('subtopics', []):
+            topic_name = topic['name']
+            topic_support = support.get(topic_name, {})
+            
+            if doc_context.supporting_sections(topic_name, Config.RETRIEVAL_TOP_K_SUBTOPICS) != topic_support.get('sections'):
+                logger.info(f"Re-extracting topic '{topic_name}'", extra={"request_id": request_id})
+                self.run.processed_chunks_by_topic.pop(topic_name, None)
+                subtopics = await self._extract_subtopics(topic, doc_context, type_prompts['subtopics'], request_id)
+                subtopics = await self._batch_redundancy_check(subtopics, 'subtopic', context_prefix=topic_name)
+                for subtopic in subtopics:
+                    subtopic['details'] = await self._extract_unique_details(
+                        subtopic, topic_name, doc_context, type_prompts['details'], request_id
+                    )
+                topic['subtopics'] = subtopics
+                rebuilt[topic_name] = None
+                to_verify.append(topic)
+                continue
+                
+            changed_subtopics = []
+            for subtopic in topic.get('subtopics', []):
+                query = f"{subtopic['name']} {topic_name}"
+                if doc_context.supporting_sections(query, Config.RETRIEVAL_TOP_K_DETAILS) != \
+                        topic_support.get('subtopics', {}).get(subtopic['name']):
+                    logger.info(f"Re-extracting details for subtopic '{subtopic['name']}'", extra={"request_id": request_id})
+                    subtopic['details'] = await self._extract_unique_details(
+                        subtopic, topic_name, doc_context, type_prompts['details'], request_id
+                    )
+                    changed_subtopics.append(subtopic)
+            if changed_subtopics:
+                rebuilt[topic_name] = {subtopic['name'] for subtopic in changed_subtopics}
+                to_verify.append({**topic, 'subtopics': changed_subtopics})
+        
+        # Verify only the rebuilt nodes, then merge them back into the reused tree
+        verified_topics = {}
+        if to_verify:
+            verified = await self.verify_mindmap_against_source(
+                {'central_theme': {**central_theme, 'subtopics': to_verify}}, doc_context
+            )
+            verified_topics = {t['name']: t for t in verified.get('central_theme', {}).get('subtopics', [])}
+            
+        merged_topics = []
+        for topic in central_theme.get('subtopics', []):
+            topic_name = topic['name']
+            if topic_name not in rebuilt:
+                merged_topics.append(topic)
+            elif rebuilt[topic_name] is None:
+                if topic_name in verified_topics:
+                    merged_topics.append(verified_topics[topic_name])
+            else:
+                verified_subtopics = {s['name']: s for s in verified_topics.get(topic_name, {}).get('subtopics', [])}
+                topic['subtopics'] = [
+                    verified_subtopics.get(subtopic['name']) if subtopic['name'] in rebuilt[topic_name] else subtopic
+                    for subtopic in topic['subtopics']
+                ]
+                topic['subtopics'] = [subtopic for subtopic in topic['subtopics'] if subtopic]
+                merged_topics.append(topic)
+        central_theme['subtopics'] = merged_topics
+        
+        logger.info(f"Rebuilt {sum(1 for v in rebuilt.values() if v is None)} topics and "
+                    f"{sum(len(v) for v in rebuilt.values() if v)} subtopics, reused the rest",
+                    extra={"request_id": request_id})
+        self.run.usage.print_usage_report()
+        
+        await self._save_snapshot(document_key, doc_context, doc_type, mindmap_data)
+        return self._generate_mermaid_mindmap(mindmap_data)
+    
+    async def _extract_unique_details(self, subtopic: Dict[str, Any], topic_name: str, doc_context: DocumentContext,
+                                      details_prompt_template: str, request_id: str) -> List[Dict[str, Any]]:
+        """Re-extract a subtopic's details from the current document and drop near-duplicates."""
+        self.run.processed_chunks_by_subtopic.pop((topic_name, subtopic['name']), None)
+        details = await self._extract_details(subtopic, doc_context, details_prompt_template, request_id,
+                                              topic_name=topic_name)
+        seen_details = {}
+        unique_details = []
+        for detail in details:
+            if not await self.is_similar_to_existing(detail['text'], seen_details, 'detail'):
+                seen_details[detail['text']] = True
+                unique_details.append(detail)
+        return unique_details
+    
+    async def _save_snapshot(self, document_key: str, doc_context: DocumentContext, doc_type: DocumentType,
+                             mindmap_data: Dict[str, Any]):
+        """Store a verified mindmap with the sections supporting each topic and subtopic."""
+        support = {}
+        for topic in mindmap_data.get('central_theme', {}).get('subtopics', []):
+            support[topic['name']] = {
+                'sections': doc_context.supporting_sections(topic['name'], Config.RETRIEVAL_TOP_K_SUBTOPICS),
+                'subtopics': {
+                    subtopic['name']: doc_context.supporting_sections(
+                        f"{subtopic['name']} {topic['name']}", Config.RETRIEVAL_TOP_K_DETAILS
+                    )
+                    for subtopic in topic.get('subtopics', [])
+                }
+            }
+        await self.snapshots.save(document_key, doc_context.content_hash, {
+            'doc_type': doc_type.name,
+            'sections': doc_context.section_hashes,
+            'mindmap': mindmap_data,
+            'support': support
+        })
+
+    @traced('extract_main_topics')
+    async def _extract_main_topics(self, doc_context: DocumentContext, topics_prompt: str, request_id: str) -> List[Dict[str, Any]]:
         """Extract main topics using LLM with more aggressive deduplication and content preservation.
         
         Args:
-            content (str): The document content to analyze
+            doc_context (DocumentContext): The pre-chunked document to analyze
             topics_prompt (str): The prompt template for topic extraction
             request_id (str): Unique identifier for the request
             
@@ -3108,23 +4905,8 @@ class MindMapGenerator:
                 return []
 
         try:
-            # Create content chunks with overlap to ensure context preservation
-            chunk_size = min(8000, len(content) // 3) if len(content) > 6000 else 4000
-            overlap = 250  # Characters of overlap between chunks
-            
-            # Create overlapping chunks
-            content_chunks = []
-            start = 0
-            while start < len(content):
-                end = min(start + chunk_size, len(content))
-                # Extend to nearest sentence end if possible
-                if end < len(content):
-                    next_period = content.find('.', end)
-                    if next_period != -1 and next_period - end < 200:  # Don't extend too far
-                        end = next_period + 1
-                chunk = content[start:end]
-                content_chunks.append(chunk)
-                start = end - overlap if end < len(content) else end
+            # Token-bounded chunks aligned to section and paragraph boundaries
+            content_chunks = doc_context.chunk_texts
 
             # Initialize concurrent processing controls
             semaphore = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
@@ -3307,7 +5089,8 @@ class MindMapGenerator:
                                 final_topics[i]['name'], 
                                 final_topics[j]['name'],
                                 "main topic", 
-                                "main topic"
+                                "main topic",
+                                'topic'
                             )
                             
                             if is_duplicate and len(final_topics) > MIN_TOPICS:
@@ -3331,37 +5114,31 @@ class MindMapGenerator:
             logger.error(error_msg, extra={"request_id": request_id})
             raise MindMapGenerationError(error_msg)
 
-    async def _extract_subtopics(self, topic: Dict[str, Any], content: str, subtopics_prompt_template: str, request_id: str) -> List[Dict[str, Any]]:
+    @traced('extract_subtopics')
+    async def _extract_subtopics(self, topic: Dict[str, Any], doc_context: DocumentContext, subtopics_prompt_template: str, request_id: str) -> List[Dict[str, Any]]:
         """Extract subtopics using LLM with more aggressive deduplication and content preservation."""
         MAX_SUBTOPICS = self.config['max_subtopics']
         MAX_CONCURRENT_TASKS = 50  # Limit concurrent LLM calls
         
-        content_hash = hashlib.md5(content.encode()).hexdigest()
-        cache_key = f"subtopics_{topic['name']}_{content_hash}_{request_id}"
+        cache_key = f"subtopics_{topic['name']}_{doc_context.content_hash}_{request_id}"
         
-        if not hasattr(self, '_subtopics_cache'):
-            self._subtopics_cache = {}
+        if topic['name'] not in self.run.processed_chunks_by_topic:
+            self.run.processed_chunks_by_topic[topic['name']] = set()
             
-        if not hasattr(self, '_processed_chunks_by_topic'):
-            self._processed_chunks_by_topic = {}
-        
-        if topic['name'] not in self._processed_chunks_by_topic:
-            self._processed_chunks_by_topic[topic['name']] = set()
+        # The template is formatted with a placeholder, so it stays in the cacheable prefix
+        type_instructions = subtopics_prompt_template.format(topic='TOPIC')
 
-        async def extract_from_chunk(chunk: str) -> List[Dict[str, Any]]:
-            chunk_hash = hashlib.md5(chunk.encode()).hexdigest()
-            if chunk_hash in self._processed_chunks_by_topic[topic['name']]:
+        async def extract_from_chunk(chunk: str, chunk_hash: str) -> List[Dict[str, Any]]:
+            if chunk_hash in self.run.processed_chunks_by_topic[topic['name']]:
                 return []
                 
-            self._processed_chunks_by_topic[topic['name']].add(chunk_hash)
+            self.run.processed_chunks_by_topic[topic['name']].add(chunk_hash)
                 
-            enhanced_prompt = f"""You are an expert at identifying distinct, relevant subtopics that support a main topic.
-
-            Topic: {topic['name']}
-
-            {subtopics_prompt_template.format(topic=topic['name'])}
+            # Instructions + type-specific template + chunk form a prefix shared by every topic
+            # extracted from this chunk; only the topic name follows it
+            chunk_prefix = f"""You are an expert at identifying distinct, relevant subtopics that support a main topic.
 
-            Additional requirements:
+            Requirements for the subtopics you identify:
             1. Each subtopic must provide unique value and perspective with NO conceptual overlap
             2. Include both high-level and specific subtopics that are clearly distinct
             3. Ensure strong connection to main topic without repeating the topic itself
@@ -3378,8 +5155,15 @@ class MindMapGenerator:
             4. Keep your content strictly based on what's in the document, not general knowledge about the topic
             5. Use general descriptions rather than specific numbers if the document doesn't provide exact figures
 
+            {type_instructions}
+
+            TOPIC is given after the content chunk.
+
             Content chunk:
             {chunk}
+            """
+            enhanced_prompt = f"""
+            TOPIC: {topic['name']}
 
             IMPORTANT: Return ONLY a JSON array of strings representing distinct subtopics.
             Example: ["First Distinct Subtopic", "Second Distinct Subtopic"]"""
@@ -3389,7 +5173,8 @@ class MindMapGenerator:
                     enhanced_prompt,
                     max_tokens=1000,
                     request_id=request_id,
-                    task=f"extracting_subtopics_{topic['name']}"
+                    task=f"extracting_subtopics_{topic['name']}",
+                    cache_prefix=chunk_prefix
                 )
                 
                 logger.debug(f"Raw subtopics response for {topic['name']}: {response}", 
@@ -3422,28 +5207,30 @@ class MindMapGenerator:
                 return []
 
         try:
-            if cache_key in self._subtopics_cache:
-                return self._subtopics_cache[cache_key]
+            if cache_key in self.run.subtopics_cache:
+                return self.run.subtopics_cache[cache_key]
                 
-            chunk_size = min(8000, len(content) // 3) if len(content) > 6000 else 4000
-            content_chunks = [content[i:i + chunk_size] 
-                            for i in range(0, len(content), chunk_size)]
-            
             # Initialize concurrent processing controls
             semaphore = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
             seen_names = {}
             all_subtopics = []
             
-            async def process_chunk(chunk: str) -> List[Dict[str, Any]]:
+            async def process_chunk(chunk: str, chunk_hash: str) -> List[Dict[str, Any]]:
                 """Process a single chunk with semaphore control."""
                 async with semaphore:
                     return await self._retry_with_exponential_backoff(
-                        lambda: extract_from_chunk(chunk)
+                        lambda: extract_from_chunk(chunk, chunk_hash)
                     )
 
+            # Only send the chunks relevant to this topic
+            chunk_indices = doc_context.relevant_chunk_indices(topic['name'], Config.RETRIEVAL_TOP_K_SUBTOPICS)
+            logger.info(f"Selected {len(chunk_indices)}/{len(doc_context.chunks)} chunks for topic '{topic['name']}'",
+                        extra={"request_id": request_id})
+
             # Process chunks concurrently
             chunk_results = await asyncio.gather(
-                *(process_chunk(chunk) for chunk in content_chunks)
+                *(process_chunk(doc_context.chunk_texts[idx], doc_context.chunk_hashes[idx])
+                  for idx in chunk_indices)
             )
 
             # Process results with more aggressive deduplication
@@ -3535,7 +5322,8 @@ class MindMapGenerator:
                                 all_subtopics[i]['name'], 
                                 all_subtopics[j]['name'],
                                 f"subtopic of {topic['name']}", 
-                                f"subtopic of {topic['name']}"
+                                f"subtopic of {topic['name']}",
+                                'subtopic'
                             )
                             
                             if is_duplicate:
@@ -3547,7 +5335,7 @@ class MindMapGenerator:
                             continue
             
             final_subtopics = all_subtopics[:MAX_SUBTOPICS]
-            self._subtopics_cache[cache_key] = final_subtopics
+            self.run.subtopics_cache[cache_key] = final_subtopics
             
             logger.info(f"Successfully extracted {len(final_subtopics)} subtopics for {topic['name']}", 
                         extra={"request_id": request_id})
@@ -3593,42 +5381,42 @@ class MindMapGenerator:
             logger.debug(f"Validation error: {str(e)}")
             return False
 
-    async def _extract_details(self, subtopic: Dict[str, Any], content: str, details_prompt_template: str, request_id: str) -> List[Dict[str, Any]]:
-        """Extract details for a subtopic with more aggressive deduplication and content preservation."""
+    @traced('extract_details')
+    async def _extract_details(self, subtopic: Dict[str, Any], doc_context: DocumentContext, details_prompt_template: str, request_id: str, topic_name: str = '') -> List[Dict[str, Any]]:
+        """Extract details for a subtopic with more aggressive deduplication and content preservation.
+        
+        Only the chunks most relevant to the subtopic (and its parent topic name, if given) are sent.
+        """
         MINIMUM_VALID_DETAILS = 5  # Early stopping threshold
         MAX_DETAILS = self.config['max_details']
         MAX_CONCURRENT_TASKS = 50  # Limit concurrent LLM calls
         
         # Create cache key
-        content_hash = hashlib.md5(content.encode()).hexdigest()
-        cache_key = f"details_{subtopic['name']}_{content_hash}_{request_id}"
+        cache_key = f"details_{subtopic['name']}_{doc_context.content_hash}_{request_id}"
+        # Chunks are tracked per topic, so same-named subtopics of topics extracted concurrently
+        # (hybrid mode) do not skip each other's chunks
+        chunks_key = (topic_name, subtopic['name'])
         
-        if not hasattr(self, '_details_cache'):
-            self._details_cache = {}
+        # Valid details collected from this subtopic's chunks so far (drives early stopping)
+        current_details = []
         
-        if not hasattr(self, '_processed_chunks_by_subtopic'):
-            self._processed_chunks_by_subtopic = {}
-        
-        if subtopic['name'] not in self._processed_chunks_by_subtopic:
-            self._processed_chunks_by_subtopic[subtopic['name']] = set()
-
-        if not hasattr(self, '_current_details'):
-            self._current_details = []
+        if chunks_key not in self.run.processed_chunks_by_subtopic:
+            self.run.processed_chunks_by_subtopic[chunks_key] = set()
+            
+        # The template is formatted with a placeholder, so it stays in the cacheable prefix
+        type_instructions = details_prompt_template.format(subtopic='SUBTOPIC')
 
-        async def extract_from_chunk(chunk: str) -> List[Dict[str, Any]]:
-            chunk_hash = hashlib.md5(chunk.encode()).hexdigest()
-            if chunk_hash in self._processed_chunks_by_subtopic[subtopic['name']]:
+        async def extract_from_chunk(chunk: str, chunk_hash: str) -> List[Dict[str, Any]]:
+            if chunk_hash in self.run.processed_chunks_by_subtopic[chunks_key]:
                 return []
                 
-            self._processed_chunks_by_subtopic[subtopic['name']].add(chunk_hash)
+            self.run.processed_chunks_by_subtopic[chunks_key].add(chunk_hash)
                 
-            enhanced_prompt = f"""You are an expert at identifying distinct, important details that support a specific subtopic.
-
-            Subtopic: {subtopic['name']}
-
-            {details_prompt_template.format(subtopic=subtopic['name'])}
+            # Instructions + type-specific template + chunk form a prefix shared by every subtopic
+            # extracted from this chunk; only the subtopic name follows it
+            chunk_prefix = f"""You are an expert at identifying distinct, important details that support a specific subtopic.
 
-            Additional requirements:
+            Requirements for the details you identify:
             1. Each detail MUST provide 3-5 sentences of specific, substantive information
             2. Include CONCRETE EXAMPLES, numbers, dates, or direct references from the text
             3. EXTRACT actual quotes or paraphrase specific passages from the source document
@@ -3638,8 +5426,15 @@ class MindMapGenerator:
             7. Balance factual information with analytical insights
             8. Avoid generic statements that could apply to many documents
 
+            {type_instructions}
+
+            SUBTOPIC is given after the content chunk.
+
             Content chunk:
             {chunk}
+            """
+            enhanced_prompt = f"""
+            SUBTOPIC: {subtopic['name']}
 
             IMPORTANT: Return ONLY a JSON array where each object has:
             - "text": The detail text (3-5 sentences with specific examples and evidence)
@@ -3651,7 +5446,8 @@ class MindMapGenerator:
                     enhanced_prompt,
                     max_tokens=1000,
                     request_id=request_id,
-                    task=f"extracting_details_{subtopic['name']}"
+                    task=f"extracting_details_{subtopic['name']}",
+                    cache_prefix=chunk_prefix
                 )
                 
                 raw_details = self._clean_detail_response(response)
@@ -3672,9 +5468,9 @@ class MindMapGenerator:
                             'text': detail['text'],
                             'importance': detail['importance']
                         })
-                        self._current_details.append(detail)
+                        current_details.append(detail)
                         
-                        if len(self._current_details) >= MINIMUM_VALID_DETAILS:
+                        if len(current_details) >= MINIMUM_VALID_DETAILS:
                             logger.info(f"Reached minimum required details ({MINIMUM_VALID_DETAILS}) during chunk processing")
                             return chunk_details
                 
@@ -3686,38 +5482,42 @@ class MindMapGenerator:
                 return chunk_details if 'chunk_details' in locals() else []
 
         try:
-            if cache_key in self._details_cache:
-                return self._details_cache[cache_key]
+            if cache_key in self.run.details_cache:
+                return self.run.details_cache[cache_key]
 
-            self._current_details = []
-            chunk_size = min(8000, len(content) // 3) if len(content) > 6000 else 4000
-            content_chunks = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
-            
             # Initialize concurrent processing controls
             semaphore = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
             seen_texts = {}
             all_details = []
             early_stop = asyncio.Event()
 
-            async def process_chunk(chunk: str) -> List[Dict[str, Any]]:
+            async def process_chunk(chunk: str, chunk_hash: str) -> List[Dict[str, Any]]:
                 """Process a single chunk with semaphore control."""
                 if early_stop.is_set():
                     return []
                     
                 async with semaphore:
                     chunk_details = await self._retry_with_exponential_backoff(
-                        lambda: extract_from_chunk(chunk)
+                        lambda: extract_from_chunk(chunk, chunk_hash)
                     )
                     
                     # Check if we've reached minimum details
-                    if len(self._current_details) >= MINIMUM_VALID_DETAILS:
+                    if len(current_details) >= MINIMUM_VALID_DETAILS:
                         early_stop.set()
                     
                     return chunk_details
 
+            # Only send the chunks relevant to this subtopic
+            chunk_indices = doc_context.relevant_chunk_indices(
+                f"{subtopic['name']} {topic_name}", Config.RETRIEVAL_TOP_K_DETAILS
+            )
+            logger.info(f"Selected {len(chunk_indices)}/{len(doc_context.chunks)} chunks for subtopic '{subtopic['name']}'",
+                        extra={"request_id": request_id})
+
             # Process chunks concurrently
             chunk_results = await asyncio.gather(
-                *(process_chunk(chunk) for chunk in content_chunks)
+                *(process_chunk(doc_context.chunk_texts[idx], doc_context.chunk_hashes[idx])
+                  for idx in chunk_indices)
             )
 
             # Process results with more aggressive deduplication
@@ -3794,9 +5594,9 @@ class MindMapGenerator:
                         seen.add(detail['text'])
                         deduplicated_details.append(detail)
                 all_details = deduplicated_details
-                if len(self._current_details) >= MINIMUM_VALID_DETAILS:
-                    logger.info(f"Using {len(self._current_details)} previously collected valid details")
-                    all_details = self._current_details
+                if len(current_details) >= MINIMUM_VALID_DETAILS:
+                    logger.info(f"Using {len(current_details)} previously collected valid details")
+                    all_details = current_details
                 else:
                     importance_order = {"high": 0, "medium": 1, "low": 2}
                     all_details = sorted(
@@ -3823,7 +5623,8 @@ class MindMapGenerator:
                                 all_details[i]['text'], 
                                 all_details[j]['text'],
                                 f"detail of {subtopic['name']}", 
-                                f"detail of {subtopic['name']}"
+                                f"detail of {subtopic['name']}",
+                                'detail'
                             )
                             
                             if is_duplicate:
@@ -3851,7 +5652,7 @@ class MindMapGenerator:
                 all_details, 
                 key=lambda x: (importance_order.get(x["importance"].lower(), 3), -len(x["text"]))
             )[:MAX_DETAILS]            
-            self._details_cache[cache_key] = final_details
+            self.run.details_cache[cache_key] = final_details
             
             logger.info(f"Successfully extracted {len(final_details)} details for {subtopic['name']}", 
                             extra={"request_id": request_id})
@@ -3860,13 +5661,19 @@ class MindMapGenerator:
         except Exception as e:
             logger.error(f"Failed to extract details for subtopic {subtopic['name']}: {str(e)}", 
                         extra={"request_id": request_id})
-            if hasattr(self, '_current_details') and len(self._current_details) > 0:
-                logger.info(f"Returning {len(self._current_details)} collected details despite error")
-                return self._current_details[:MAX_DETAILS]
+            if len(current_details) > 0:
+                logger.info(f"Returning {len(current_details)} collected details despite error")
+                return current_details[:MAX_DETAILS]
             return []
             
-    async def _retry_generate_completion(self, prompt: str, max_tokens: int, request_id: str, task: str) -> str:
-        """Retry the LLM completion in case of failures with exponential backoff."""
+    async def _retry_generate_completion(self, prompt: str, max_tokens: int, request_id: str, task: str,
+                                         cache_prefix: Optional[str] = None) -> Optional[str]:
+        """Retry the LLM completion in case of failures with exponential backoff.
+        
+        generate_completion reports failure as None. A None is retried, unless every provider's
+        circuit is open, in which case this fails fast. Returns None once retries are exhausted
+        or the request's budget is used up.
+        """
         retries = 0
         base_delay = 1  # Start with 1 second delay
         
@@ -3876,43 +5683,49 @@ class MindMapGenerator:
                     prompt,
                     max_tokens=max_tokens,
                     request_id=request_id,
-                    task=task
+                    task=task,
+                    cache_prefix=cache_prefix
                 )
-                return response
+                if response is not None:
+                    return response
+                error = "no response from any provider"
+            except BudgetExceededError as e:
+                # Retrying cannot help once the request's budget is gone
+                logger.warning(f"Skipping {task}: {str(e)}", extra={"request_id": request_id})
+                return None
             except Exception as e:
-                retries += 1
-                if retries >= self.config['max_retries']:
-                    logger.error(f"Exceeded maximum retries for {task}", extra={"request_id": request_id})
-                    raise
+                error = str(e)
                 
-                delay = min(base_delay * (2 ** (retries - 1)), 10)  # Cap at 10 seconds
-                logger.warning(f"Retrying {task} ({retries}/{self.config['max_retries']}) after {delay}s: {str(e)}", extra={"request_id": request_id})
+            retries += 1
+            if not self.optimizer.available_providers():
+                logger.error(f"All provider circuits open, failing fast for {task}", extra={"request_id": request_id})
+                return None
+            if retries >= self.config['max_retries']:
+                logger.error(f"Exceeded maximum retries for {task}", extra={"request_id": request_id})
+                return None
+            
+            delay = min(base_delay * (2 ** (retries - 1)), 10)  # Cap at 10 seconds
+            logger.warning(f"Retrying {task} ({retries}/{self.config['max_retries']}) after {delay}s: {error}", extra={"request_id": request_id})
+            with trace_span('retry_backoff', task=task):
                 await asyncio.sleep(delay)
+        return None
 
-    async def verify_mindmap_against_source(self, mindmap_data: Dict[str, Any], original_document: str) -> Dict[str, Any]:
-        """Verify all mindmap nodes against the original document with lenient criteria and improved error handling."""
+    @traced('verify_against_source')
+    async def verify_mindmap_against_source(self, mindmap_data: Dict[str, Any], original_document: Union[str, DocumentContext]) -> Dict[str, Any]:
+        """Verify all mindmap nodes against the original document with lenient criteria and improved error handling.
+        
+        `original_document` may be the raw text or the DocumentContext already built by generate_mindmap,
+        in which case its chunks are reused instead of re-chunking the document.
+        """
         try:
             logger.info("\n" + "="*80)
             logger.info(colored("🔍 STARTING REALITY CHECK TO IDENTIFY POTENTIAL CONFABULATIONS", "cyan", attrs=["bold"]))
             logger.info("="*80 + "\n")
             
-            # Split document into chunks to handle context window limitations
-            chunk_size = 8000  # Adjust based on model context window
-            overlap = 250  # Characters of overlap between chunks
-            
-            # Create overlapping chunks
-            doc_chunks = []
-            start = 0
-            while start < len(original_document):
-                end = min(start + chunk_size, len(original_document))
-                # Extend to nearest sentence end if possible
-                if end < len(original_document):
-                    next_period = original_document.find('.', end)
-                    if next_period != -1 and next_period - end < 200:  # Don't extend too far
-                        end = next_period + 1
-                chunk = original_document[start:end]
-                doc_chunks.append(chunk)
-                start = end - overlap if end < len(original_document) else end
+            # Reuse the shared token-bounded chunks to handle context window limitations
+            if not isinstance(original_document, DocumentContext):
+                original_document = DocumentContext.from_content(original_document, self.chunker)
+            doc_chunks = original_document.chunk_texts
             
             logger.info(f"Split document into {len(doc_chunks)} chunks for verification")
             
@@ -4004,42 +5817,19 @@ class MindMapGenerator:
                 node_type = node['type']
                 path_str = ' → '.join(node['path']) if node['path'] else 'root'
                 
-                prompt = f"""You are an expert fact-checker verifying if information in a mindmap can be reasonably derived from the original document.
-
-            Task: Determine if this {node_type} is supported by the document text or could be reasonably inferred from it.
-
-            {node_type.title()}: "{node_text}"
+                # Guidelines + chunk form a prefix shared by every node checked against this chunk
+                prompt = f"""
+            {node_type.title()} to verify: "{node_text}"
             Path: {path_str}
-
-            Document chunk:
-            ```
-            {chunk}
-            ```
-
-            VERIFICATION GUIDELINES:
-            1. The {node_type} can be EXPLICITLY mentioned OR reasonably inferred from the document, even through logical deduction
-            2. Logical synthesis, interpretation, and summarization of concepts in the document are STRONGLY encouraged
-            3. Content that represents a reasonable conclusion or implication from the document should be VERIFIED
-            4. Content that groups, categorizes, or abstracts ideas from the document should be VERIFIED
-            5. High-level insights that connect multiple concepts from the document should be VERIFIED
-            6. Only mark as unsupported if it contains specific claims that DIRECTLY CONTRADICT the document
-            7. GIVE THE BENEFIT OF THE DOUBT - if the content could plausibly be derived from the document, verify it
-            8. When uncertain, LEAN TOWARDS VERIFICATION rather than rejection - mindmaps are meant to be interpretive, not literal
-            9. For details specifically, allow for more interpretive latitude - they represent insights derived from the document
-            10. Consider historical and domain context that would be natural to include in an analysis
-
-            Answer ONLY with one of these formats:
-            - "YES: [brief explanation of how it's supported or can be derived]" 
-            - "NO: [brief explanation of why it contains information that directly contradicts the document]"
-
-            IMPORTANT: Remember to be GENEROUS in your interpretation. If there's any reasonable way the content could be derived from the document, even through multiple logical steps, mark it as verified. Only reject content that introduces completely new facts not derivable from the document or directly contradicts it."""
+            """
 
                 try:
                     response = await self._retry_generate_completion(
                         prompt,
                         max_tokens=150,
                         request_id='verify_node',
-                        task="verifying_against_source"
+                        task="verifying_against_source",
+                        cache_prefix=self.verification_prompt_prefix.format(chunk=chunk)
                     )
                     
                     # Parse the response to get verification result
@@ -4257,6 +6047,7 @@ class MindMapGenerator:
             # Return the original mindmap in case of any errors
             return mindmap_data
 
+    @traced('render_mermaid')
     def _generate_mermaid_mindmap(self, concepts: Dict[str, Any]) -> str:
         """Generate complete Mermaid mindmap syntax from concepts.
         
@@ -4347,35 +6138,155 @@ class MindMapGenerator:
         
         return markdown_text.strip()
     
-    async def generate_mindmap_simple(self, document_content: str, request_id: str) -> str:
-        """Generate a mindmap using a single prompt approach for faster generation.
+    @staticmethod
+    async def _emit_progress(on_progress: Optional[Callable[[Dict[str, Any]], Any]], request_id: str,
+                             event_type: str, **data):
+        """Send a progress event to an on_progress callback, awaiting it if it returns an awaitable."""
+        if on_progress is None:
+            return
+        result = on_progress({'type': event_type, 'request_id': request_id, **data})
+        if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+            await result
+    
+    def _provider_latency(self) -> Optional[float]:
+        """Median latency of recent successful calls to the primary provider, if any were made."""
+        return self.optimizer.median_latency(self.optimizer.provider_order()[0])
+    
+    def plan_generation(self, document_content: str) -> GenerationPlan:
+        """Pick the generation strategy for a document.
         
-        This is a simplified version that uses one LLM call to generate the entire mindmap structure,
-        trading some quality for speed.
+        'simple' (one call) for short documents, however many headings they use,
+        'full' (generate_mindmap) for large or heavily sectioned documents, and 'hybrid'
+        (generate_mindmap_hybrid) in between. Under load (many provider calls in flight or a slow
+        primary provider) the choice moves one step towards 'simple'.
+        """
+        tokens = self.chunker.token_counter.count(document_content)
+        sections = len(self.chunker.parser._extract_headings(document_content))
+        inflight = len(_inflight_completions)
+        latency = self._provider_latency()
+        reasons = []
+        
+        if tokens <= Config.PLANNER_SIMPLE_MAX_TOKENS:
+            mode = 'simple'
+            reasons.append(f"{tokens} tokens fit a single prompt")
+        elif tokens >= Config.PLANNER_FULL_MIN_TOKENS or sections >= Config.PLANNER_FULL_MIN_SECTIONS:
+            mode = 'full'
+            reasons.append(f"{tokens} tokens in {sections} sections need the full pipeline")
+        else:
+            mode = 'hybrid'
+            reasons.append(f"{tokens} tokens in {sections} sections: simple structure with detail enrichment")
+            
+        if mode != 'simple':
+            if inflight >= Config.PLANNER_BUSY_INFLIGHT_CALLS:
+                reasons.append(f"provider busy ({inflight} calls in flight)")
+            elif latency is not None and latency >= Config.PLANNER_SLOW_LATENCY_SECONDS:
+                reasons.append(f"provider slow (median latency {latency:.1f}s)")
+            else:
+                return GenerationPlan(mode, tokens, sections, inflight, latency, reasons)
+            mode = 'hybrid' if mode == 'full' else 'simple'
+        return GenerationPlan(mode, tokens, sections, inflight, latency, reasons)
+    
+    @_binds_run
+    async def generate_mindmap_auto(self, document_content: str, request_id: str,
+                                    on_progress: Optional[Callable[[Dict[str, Any]], Any]] = None) -> str:
+        """Generate a mindmap with the strategy chosen by plan_generation.
+        
+        The plan is kept on run.plan and sent as a 'plan' progress event before generation starts.
+        Every strategy ends with a 'complete' progress event carrying the Mermaid syntax.
+        """
+        plan = self.plan_generation(document_content)
+        self.run.plan = plan
+        logger.info(f"Planned {plan.mode} mindmap generation: {'; '.join(plan.reasons)}",
+                    extra={"request_id": request_id})
+        await self._emit_progress(on_progress, request_id, 'plan', mode=plan.mode, reasons=plan.reasons)
+        
+        if plan.mode == 'full':
+            return await self.generate_mindmap(document_content, request_id, on_progress=on_progress, run=self.run)
+        if plan.mode == 'hybrid':
+            return await self.generate_mindmap_hybrid(document_content, request_id, on_progress=on_progress, run=self.run)
+        mermaid_syntax = await self.generate_mindmap_simple(document_content, request_id, run=self.run)
+        await self._emit_progress(on_progress, request_id, 'complete', mermaid=mermaid_syntax, verified=False)
+        return mermaid_syntax
+    
+    @_binds_run
+    async def generate_mindmap_hybrid(self, document_content: str, request_id: str,
+                                      on_progress: Optional[Callable[[Dict[str, Any]], Any]] = None) -> str:
+        """Generate a mindmap from a simple structure enriched in parallel.
+        
+        The main topics come from the single simple-mode prompt (sent together with document type
+        detection); then the subtopics of every topic and the details of every subtopic are
+        extracted concurrently from the chunks most relevant to them. Unlike generate_mindmap,
+        topics are not processed one after another and there is no final redundancy pass or
+        verification against the source.
         
-        Args:
-            document_content (str): The document content to analyze
-            request_id (str): Unique identifier for request tracking
-            
-        Returns:
-            str: Complete Mermaid mindmap syntax
-            
         Raises:
-            MindMapGenerationError: If mindmap generation fails
+            MindMapGenerationError: If no main topics could be extracted
         """
+        logger.info("Starting hybrid mindmap generation process...", extra={"request_id": request_id})
+        doc_context = DocumentContext.from_content(document_content, self.chunker)
+        doc_type, response = await asyncio.gather(
+            self.detect_document_type(document_content, request_id),
+            self._retry_generate_completion(
+                self._simple_mindmap_prompt(document_content),
+                max_tokens=3000,
+                request_id=request_id,
+                task="simple_mindmap_generation"
+            )
+        )
+        if not response:
+            raise MindMapGenerationError("No response from LLM for the hybrid mindmap structure")
         try:
-            logger.info("Starting simple mindmap generation process...", extra={"request_id": request_id})
-            
-            # Initialize tracking
-            self._llm_calls = {
-                'topics': 0,
-                'subtopics': 0,
-                'details': 0,
-                'simple': 0
-            }
-            
-            # Create simple prompt for direct mindmap generation
-            simple_prompt = f"""You are an expert at identifying unique, distinct main topics within content.
+            parsed_response = self._parse_llm_response(response, "array")
+        except Exception as e:
+            raise MindMapGenerationError(f"Failed to parse the hybrid mindmap structure: {str(e)}")
+        topic_names = list(dict.fromkeys(
+            ' '.join(re.sub(r'[`*_#]', '', name).split())
+            for name in parsed_response if isinstance(name, str) and name.strip()
+        ))[:self.config['max_topics']]
+        if not topic_names:
+            raise MindMapGenerationError("No main topics could be extracted from the document")
+        await self._emit_progress(on_progress, request_id, 'topics', topics=topic_names)
+        
+        type_prompts = self.type_specific_prompts[doc_type]
+        enriched_topics = []
+        
+        async def enrich_topic(name: str) -> Dict[str, Any]:
+            topic = self._create_node(name, 'high', await self._select_emoji(name, 'topic'))
+            try:
+                subtopics = await self._extract_subtopics(topic, doc_context, type_prompts['subtopics'], request_id)
+                subtopics = subtopics[:self.config['max_subtopics']]
+                details = await asyncio.gather(*(
+                    self._extract_details(subtopic, doc_context, type_prompts['details'], request_id, topic_name=name)
+                    for subtopic in subtopics
+                ))
+                for subtopic, subtopic_details in zip(subtopics, details):
+                    subtopic['details'] = subtopic_details[:self.config['max_details']]
+                topic['subtopics'] = subtopics
+            except Exception as e:
+                logger.error(f"Error enriching topic '{name}': {str(e)}", extra={"request_id": request_id})
+            enriched_topics.append(topic)
+            await self._emit_progress(
+                on_progress, request_id, 'subtopics', topic=name,
+                subtopics=[subtopic['name'] for subtopic in topic['subtopics']],
+                mermaid=self._generate_mermaid_mindmap({'central_theme': {'subtopics': list(enriched_topics)}})
+            )
+            return topic
+        
+        with trace_span('enrich_topics', topics=len(topic_names)):
+            topics = await asyncio.gather(*(enrich_topic(name) for name in topic_names))
+        
+        concepts = {'central_theme': self._create_node('Document Mindmap', 'high')}
+        concepts['central_theme']['subtopics'] = list(topics)
+        self.run.usage.print_usage_report()
+        await self._save_emoji_cache_async()
+        
+        mermaid_syntax = self._generate_mermaid_mindmap(concepts)
+        await self._emit_progress(on_progress, request_id, 'complete', mermaid=mermaid_syntax, verified=False)
+        return mermaid_syntax
+    
+    def _simple_mindmap_prompt(self, document_content: str) -> str:
+        """Single prompt for the main topics of a document (simple mode and the hybrid structure pass)."""
+        return f"""You are an expert at identifying unique, distinct main topics within content.
 
             Analyze this document focusing on main conceptual themes and relationships.
 
@@ -4422,6 +6333,37 @@ class MindMapGenerator:
 
             Format: Return a JSON array of primary themes or concept areas."""
 
+    @_binds_run
+    async def generate_mindmap_simple(self, document_content: str, request_id: str) -> str:
+        """Generate a mindmap using a single prompt approach for faster generation.
+        
+        This is a simplified version that uses one LLM call to generate the entire mindmap structure,
+        trading some quality for speed.
+        
+        Args:
+            document_content (str): The document content to analyze
+            request_id (str): Unique identifier for request tracking
+            
+        Returns:
+            str: Complete Mermaid mindmap syntax
+            
+        Raises:
+            MindMapGenerationError: If mindmap generation fails
+        """
+        try:
+            logger.info("Starting simple mindmap generation process...", extra={"request_id": request_id})
+            
+            # Initialize tracking
+            self.run.llm_calls = {
+                'topics': 0,
+                'subtopics': 0,
+                'details': 0,
+                'simple': 0
+            }
+            
+            # Create simple prompt for direct mindmap generation
+            simple_prompt = self._simple_mindmap_prompt(document_content)
+
             # Make single LLM call
             logger.info("Making single LLM call for simplified mindmap generation...", extra={"request_id": request_id})
             
@@ -4432,7 +6374,7 @@ class MindMapGenerator:
                 task="simple_mindmap_generation"
             )
             
-            self._llm_calls['simple'] = 1
+            self.run.llm_calls['simple'] = 1
             
             if not response:
                 raise MindMapGenerationError("No response from LLM for simple mindmap generation")
@@ -4458,6 +6400,15 @@ class MindMapGenerator:
                     }
                 }
                 
+                # Select the topic emojis concurrently, so a small document costs two round trips
+                cleaned_names = [
+                    ' '.join(re.sub(r'[`*_#]', '', topic_name).split())
+                    for topic_name in parsed_response if isinstance(topic_name, str) and topic_name.strip()
+                ]
+                emojis = dict(zip(cleaned_names, await asyncio.gather(
+                    *(self._select_emoji(name, 'topic') for name in cleaned_names)
+                )))
+                
                 # Process each topic string
                 for topic_name in parsed_response:
                     if isinstance(topic_name, str) and topic_name.strip():
@@ -4465,7 +6416,7 @@ class MindMapGenerator:
                         cleaned_name = ' '.join(cleaned_name.split())
                         
                         # Select appropriate emoji for topic
-                        emoji = await self._select_emoji(cleaned_name, 'topic')
+                        emoji = emojis[cleaned_name]
                         
                         # Create simplified topic structure
                         topic = {
@@ -4515,7 +6466,7 @@ class MindMapGenerator:
                 logger.info(
                     f"Simple mindmap generation completed successfully. "
                     f"Topics: {len(concepts['central_theme']['subtopics'])}, "
-                    f"LLM calls: {self._llm_calls['simple']}, "
+                    f"LLM calls: {self.run.llm_calls['simple']}, "
                     f"Output length: {len(mermaid_syntax)} characters",
                     extra={"request_id": request_id}
                 )
@@ -4766,15 +6717,14 @@ async def process_text_file(filepath: str):
             content = f.read()
         # Store content in our stub database
         MinimalDatabaseStub.store_text(content)
-        # Generate a unique document ID based on content hash
+        # Generate a stable document ID based on content hash, so a rerun resumes from its checkpoint
         content_hash = hashlib.md5(content.encode()).hexdigest()[:8]
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         base_filename = os.path.splitext(os.path.basename(filepath))[0]
-        document_id = f"{base_filename}_{content_hash}_{timestamp}"
+        document_id = f"{base_filename}_{content_hash}"
         # Initialize the mindmap generator
         generator = MindMapGenerator()
-        # Generate the mindmap
-        mindmap = await generator.generate_mindmap(content, request_id=document_id)
+        # Generate the mindmap with the strategy that suits the document's size and structure
+        mindmap = await generator.generate_mindmap_auto(content, request_id=document_id)
         # Generate HTML
         html = generate_mermaid_html(mindmap)
         # Generate markdown outline
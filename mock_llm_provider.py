@@ -0,0 +1,233 @@
+"""Deterministic stand-in for an LLM API, used by the MOCK provider of DocumentOptimizer.
+
+Responses, latencies and injected failures are derived from a hash of (seed, prompt, n-th call with
+that prompt), so a benchmark produces the same mindmap and the same call pattern on every run,
+no matter how the pipeline's concurrent calls interleave. No network access or API key is needed.
+"""
+import re
+import json
+import math
+import random
+import asyncio
+import hashlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class MockProviderError(RuntimeError):
+    """Injected transient provider failure (a 5xx from a real API)."""
+    status_code = 500
+
+
+class MockRateLimitError(MockProviderError):
+    """Injected 429 Too Many Requests."""
+    status_code = 429
+
+
+# Canned answer per task type: (rng, prompt) -> response text
+ResponseGenerator = Callable[[random.Random, str], str]
+
+_WORD_REGEX = re.compile(r"[A-Za-z][A-Za-z'-]{3,}|[一-鿿]{2,4}")
+_STOPWORDS = frozenset("""
+about above after again against also among analyze another array based because been before being
+below between both cannot concept concepts content could details different distinct document each
+element elements example examples extract focus format from further have here identify important
+information into json main more most must only other ours over provide rather related return same
+should similar some specific string strings such text than that their them then there these they
+this those through topic topics under very what when where which while will with within would your
+""".split())
+_DOCUMENT_TYPES = ('TECHNICAL', 'SCIENTIFIC', 'NARRATIVE', 'BUSINESS', 'ACADEMIC', 'LEGAL',
+                   'MEDICAL', 'INSTRUCTIONAL', 'ANALYTICAL', 'PROCEDURAL', 'GENERAL')
+_EMOJIS = ('📄', '📌', '🔹', '📈', '👥', '💰', '⚙️', '🌐', '🔬', '💻', '🔄', '🏥', '🔒')
+
+
+def _vocabulary(prompt: str) -> List[str]:
+    """Distinct content words of the prompt, in order of first appearance."""
+    seen = {}
+    for word in _WORD_REGEX.findall(prompt):
+        if word.lower() not in _STOPWORDS:
+            seen.setdefault(word.lower(), word)
+    return list(seen.values()) or ['Mock', 'Content', 'Overview', 'Summary']
+
+
+def _phrases(rng: random.Random, prompt: str, count: int, words: int) -> List[str]:
+    vocabulary = _vocabulary(prompt)
+    return [
+        ' '.join(rng.choice(vocabulary) for _ in range(words)).title()
+        for _ in range(count)
+    ]
+
+
+def topics_response(rng: random.Random, prompt: str) -> str:
+    return json.dumps(_phrases(rng, prompt, rng.randint(4, 7), 2), ensure_ascii=False)
+
+
+def subtopics_response(rng: random.Random, prompt: str) -> str:
+    return json.dumps(_phrases(rng, prompt, rng.randint(3, 5), 3), ensure_ascii=False)
+
+
+def details_response(rng: random.Random, prompt: str) -> str:
+    vocabulary = _vocabulary(prompt)
+    details = [
+        {
+            'text': ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(6, 12))).capitalize(),
+            'importance': rng.choice(('high', 'medium', 'low'))
+        }
+        for _ in range(rng.randint(3, 6))
+    ]
+    return json.dumps(details, ensure_ascii=False)
+
+
+def argument_structure_response(rng: random.Random, prompt: str) -> str:
+    """Argument map for the backend's paragraph-tagged text: an introduction node with one child
+    per group of paragraphs and a closing node, in the JSON layout the backend expects."""
+    paragraphs = list(dict.fromkeys(re.findall(r'\[(para-\d+)\]', prompt))) or ['para-1']
+    groups = []
+    index = 0
+    while index < len(paragraphs):
+        size = rng.randint(1, 3)
+        groups.append(paragraphs[index:index + size])
+        index += size
+    node_ids = ['1'] + [f"1.{i}" for i in range(1, len(groups) - 1)] + (['2'] if len(groups) > 1 else [])
+    roles = {'1': '引言'}
+    roles.update({node_id: rng.choice(('核心论点', '支撑证据', '反驳')) for node_id in node_ids[1:-1]})
+    if len(groups) > 1:
+        roles['2'] = '结论'
+    edges = [{'source': '1', 'target': node_id} for node_id in node_ids[1:-1]]
+    edges += [{'source': node_id, 'target': '2'} for node_id in node_ids[1:-1]]
+    if len(groups) == 2:
+        edges.append({'source': '1', 'target': '2'})
+    node_mappings = {
+        node_id: {'text_snippet': f"{roles[node_id]}{node_id}", 'paragraph_ids': group, 'semantic_role': roles[node_id]}
+        for node_id, group in zip(node_ids, groups)
+    }
+    mermaid_lines = ['graph TD'] + [f"    {node_id}[{roles[node_id]}{node_id}]" for node_id in node_ids]
+    mermaid_lines += [f"    {edge['source']} --> {edge['target']}" for edge in edges]
+    return json.dumps({'mermaid_string': '\n'.join(mermaid_lines), 'node_mappings': node_mappings, 'edges': edges},
+                      ensure_ascii=False)
+
+
+def document_type_response(rng: random.Random, prompt: str) -> str:
+    return rng.choice(_DOCUMENT_TYPES)
+
+
+def emoji_response(rng: random.Random, prompt: str) -> str:
+    return rng.choice(_EMOJIS)
+
+
+class MockLLMProvider:
+    """Simulated LLM endpoint with configurable latency, usage and failure injection.
+
+    Args:
+        seed: Seed mixed into every hash; change it to get a different but reproducible run
+        latency_distribution: 'constant', 'uniform', 'exponential' or 'lognormal'
+        latency_mean: Mean latency in seconds of a call (before the per-token part)
+        latency_spread: Spread of the distribution (uniform half-width ratio, lognormal sigma)
+        latency_per_output_token: Extra seconds per generated token, as with real decoding
+        error_rate: Probability that a call fails with MockProviderError
+        rate_limit_rate: Probability that a call fails with MockRateLimitError (429)
+        redundant_rate: Probability that a similarity check answers REDUNDANT
+        verify_rate: Probability that a fact check answers YES
+        chars_per_token: Characters per token used for the reported usage
+    """
+    def __init__(self, seed: int = 0, latency_distribution: str = 'lognormal', latency_mean: float = 1.0,
+                 latency_spread: float = 0.5, latency_per_output_token: float = 0.0,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0, redundant_rate: float = 0.2,
+                 verify_rate: float = 0.9, chars_per_token: float = 4.0):
+        if latency_distribution not in ('constant', 'uniform', 'exponential', 'lognormal'):
+            raise ValueError(f"Unknown latency distribution: {latency_distribution}")
+        self.seed = seed
+        self.latency_distribution = latency_distribution
+        self.latency_mean = latency_mean
+        self.latency_spread = latency_spread
+        self.latency_per_output_token = latency_per_output_token
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.redundant_rate = redundant_rate
+        self.verify_rate = verify_rate
+        self.chars_per_token = chars_per_token
+        self._attempts: Dict[str, int] = {}
+        self.calls = 0
+        self.failures = 0
+        # Matched against the task name by prefix, longest prefix first
+        self.response_generators: Dict[str, ResponseGenerator] = {
+            'detecting_document_type': document_type_response,
+            'extracting_main_topics': topics_response,
+            'consolidating_topics': topics_response,
+            'simple_mindmap_generation': topics_response,
+            'extracting_subtopics': subtopics_response,
+            'consolidate_subtopics': subtopics_response,
+            'extracting_details': details_response,
+            'consolidate_details': details_response,
+            'checking_content_similarity': self._similarity_response,
+            'verifying_against_source': self._verification_response,
+            'selecting_emoji': emoji_response,
+            '分析论证结构': argument_structure_response,
+        }
+
+    def register(self, task_prefix: str, generator: ResponseGenerator):
+        """Use `generator` for every task whose name starts with `task_prefix`."""
+        self.response_generators[task_prefix] = generator
+
+    def _similarity_response(self, rng: random.Random, prompt: str) -> str:
+        if rng.random() < self.redundant_rate:
+            return 'REDUNDANT (mock: overlapping information)'
+        return 'DISTINCT (mock: different information)'
+
+    def _verification_response(self, rng: random.Random, prompt: str) -> str:
+        if rng.random() < self.verify_rate:
+            return 'YES: mock verification found supporting content'
+        return 'NO: mock verification found no supporting content'
+
+    def _generator_for(self, task: str) -> Optional[ResponseGenerator]:
+        for prefix in sorted(self.response_generators, key=len, reverse=True):
+            if task.startswith(prefix):
+                return self.response_generators[prefix]
+        return None
+
+    def _latency(self, rng: random.Random, output_tokens: int) -> float:
+        mean = self.latency_mean
+        if self.latency_distribution == 'uniform':
+            base = rng.uniform(mean * (1 - self.latency_spread), mean * (1 + self.latency_spread))
+        elif self.latency_distribution == 'exponential':
+            base = rng.expovariate(1 / mean) if mean > 0 else 0.0
+        elif self.latency_distribution == 'lognormal':
+            # mu chosen so the distribution's mean equals latency_mean
+            sigma = self.latency_spread
+            base = rng.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma) if mean > 0 else 0.0
+        else:
+            base = mean
+        return max(0.0, base) + output_tokens * self.latency_per_output_token
+
+    def count_tokens(self, text: str) -> int:
+        return math.ceil(len(text) / self.chars_per_token) if text else 0
+
+    async def complete(self, prompt: str, max_tokens: int, task: str) -> Tuple[str, int, int]:
+        """Answer a prompt after a simulated delay; returns (text, input tokens, output tokens).
+
+        Raises MockRateLimitError or MockProviderError at the configured rates.
+        """
+        task = task or 'unknown'
+        prompt_hash = hashlib.md5(prompt.encode()).hexdigest()
+        attempt = self._attempts.get(prompt_hash, 0)
+        self._attempts[prompt_hash] = attempt + 1
+        self.calls += 1
+
+        # Failures depend on the attempt number, so a retried prompt can succeed
+        rng = random.Random(f"{self.seed}:{prompt_hash}:{attempt}")
+        failure_roll = rng.random()
+        # Content depends only on the prompt, so retries and hedges return the same answer
+        content_rng = random.Random(f"{self.seed}:{prompt_hash}")
+
+        generator = self._generator_for(task)
+        text = generator(content_rng, prompt) if generator else '[]'
+        output_tokens = min(self.count_tokens(text), max_tokens)
+
+        if failure_roll < self.rate_limit_rate:
+            # Rate limits are rejected up front, before any generation time is spent
+            self.failures += 1
+            raise MockRateLimitError(f"Mock rate limit exceeded (429) for {task}")
+        await asyncio.sleep(self._latency(rng, output_tokens))
+        if failure_roll < self.rate_limit_rate + self.error_rate:
+            self.failures += 1
+            raise MockProviderError(f"Mock provider error (500) for {task}")
+        return text, self.count_tokens(prompt), output_tokens
@@ -0,0 +1,167 @@
+"""RequestBudget levels and limits, and the pipeline's degradation ladder under a tight budget on MOCK."""
+import asyncio
+import os
+import re
+
+import pytest
+
+import mindmap_generator as mg
+from mindmap_generator import BudgetExceededError, Degradation, RequestBudget, TokenUsageTracker
+from mock_llm_provider import MockLLMProvider
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'sample_input_document_as_markdown__small.md')
+NODE = re.compile(r'^(?P<indent>(?: {4})+)(?:\(\(.*\)\)|\(.*\)|\[.*\])$')
+
+
+def assert_valid_mermaid(code: str):
+    lines = code.strip('\n').split('\n')
+    assert lines[0] == 'mindmap'
+    assert len(lines) > 2
+    depth = 0
+    for line in lines[1:]:
+        match = NODE.match(line)
+        assert match, f"invalid mindmap node: {line!r}"
+        level = len(match['indent']) // 4
+        assert level <= depth + 1, f"node indented past its parent: {line!r}"
+        depth = level
+    assert lines[1].startswith('    ((') and all(not line.startswith('    ((') for line in lines[2:])
+
+
+@pytest.fixture
+def thresholds(monkeypatch):
+    monkeypatch.setattr(mg.Config, 'BUDGET_SKIP_EMOJI_AT', 0.5)
+    monkeypatch.setattr(mg.Config, 'BUDGET_LEXICAL_DEDUP_AT', 0.6)
+    monkeypatch.setattr(mg.Config, 'BUDGET_SKIP_VERIFICATION_AT', 0.75)
+    monkeypatch.setattr(mg.Config, 'BUDGET_SIMPLE_FALLBACK_AT', 0.9)
+
+
+def budget_with_tokens(used: int, max_tokens: int = 1000) -> RequestBudget:
+    usage = TokenUsageTracker()
+    if used:
+        usage.update(used, 0, 'extracting_main_topics', provider='MOCK')
+    budget = RequestBudget(max_tokens=max_tokens)
+    budget.start(usage)
+    return budget
+
+
+@pytest.mark.parametrize("used, level", [
+    (0, Degradation.FULL), (499, Degradation.FULL), (500, Degradation.NO_EMOJI),
+    (600, Degradation.LEXICAL_DEDUP), (749, Degradation.LEXICAL_DEDUP), (750, Degradation.NO_VERIFICATION),
+    (900, Degradation.SIMPLE), (1500, Degradation.SIMPLE),
+])
+def test_level_follows_thresholds(thresholds, used, level):
+    assert budget_with_tokens(used).level() == level
+
+
+def test_cost_budget_uses_ledger_cost(thresholds):
+    usage = TokenUsageTracker()
+    usage.update(1000, 1000, 'extracting_main_topics', provider='OPENAI')
+    budget = RequestBudget(max_cost_usd=usage.total_cost / 0.8)
+    budget.start(usage)
+
+    assert budget.used_fraction() == pytest.approx(0.8)
+    assert budget.level() == Degradation.NO_VERIFICATION
+
+
+def test_unlimited_budget_never_degrades_or_raises(thresholds):
+    budget = budget_with_tokens(10 ** 6, max_tokens=0)
+
+    assert not budget.limited
+    assert budget.level() == Degradation.FULL
+    assert budget.remaining_seconds() is None
+    budget.check('extracting_main_topics')
+
+
+def test_check_raises_once_used_up(thresholds):
+    budget_with_tokens(999).check('extracting_main_topics')
+
+    with pytest.raises(BudgetExceededError, match='extracting_details'):
+        budget_with_tokens(1000).check('extracting_details')
+
+
+def test_degraded_records_each_step_once(thresholds):
+    budget = budget_with_tokens(800)
+
+    assert budget.degraded(Degradation.LEXICAL_DEDUP)
+    assert budget.degraded(Degradation.NO_EMOJI)
+    assert budget.degraded(Degradation.LEXICAL_DEDUP)
+    assert not budget.degraded(Degradation.SIMPLE)
+
+    assert budget.degradations == ['LEXICAL_DEDUP', 'NO_EMOJI']
+    assert budget.snapshot()['degradations'] == ['LEXICAL_DEDUP', 'NO_EMOJI']
+
+
+def test_lexical_dedup_uses_the_callers_content_type(thresholds, monkeypatch):
+    generator = mg.MindMapGenerator()
+    generator.run.budget = budget_with_tokens(600)
+    seen = []
+
+    async def is_similar_to_existing(name, existing_names, content_type='topic'):
+        seen.append(content_type)
+        return False
+
+    monkeypatch.setattr(generator, 'is_similar_to_existing', is_similar_to_existing)
+
+    redundant = asyncio.run(generator.check_similarity_llm(
+        'Grain exports', 'Grain shipments', 'subtopic of Trade', 'subtopic of Trade', 'detail'))
+
+    assert not redundant
+    assert seen == ['detail']
+
+
+@pytest.fixture
+def generate(monkeypatch, tmp_path, thresholds):
+    """Run generate_mindmap on the small sample with MOCK (no latency) under a given budget."""
+    monkeypatch.setattr(mg.Config, 'API_PROVIDER', 'MOCK')
+    monkeypatch.setattr(mg.Config, 'API_FALLBACK_PROVIDERS', [])
+    monkeypatch.setattr(mg.Config, 'ENABLE_SNAPSHOTS', False)
+    monkeypatch.setattr(mg.Config, 'ENABLE_CHECKPOINTS', False)
+    monkeypatch.setattr(mg, '_EMOJI_CACHE_FILE', str(tmp_path / 'emoji_cache.json'))
+    monkeypatch.setattr(mg, '_emoji_cache', None)
+    monkeypatch.setattr(mg, '_circuit_breakers', {})
+    monkeypatch.setattr(mg, '_inflight_completions', {})
+    monkeypatch.setattr(mg, '_mock_provider', MockLLMProvider(latency_distribution='constant', latency_mean=0.0))
+    with open(SAMPLE, encoding='utf-8') as f:
+        document = f.read()
+
+    def generate(budget: RequestBudget):
+        run = mg.GenerationRun()
+        run.budget = budget
+        mermaid = asyncio.run(mg.MindMapGenerator().generate_mindmap(document, 'budget-test', run=run))
+        calls = {category: count for category, count in run.usage.call_counts_by_category.items() if count}
+        return mermaid, calls, run
+
+    return generate
+
+
+def test_tight_budget_degrades_dedup_and_skips_verification(generate):
+    full_mermaid, full_calls, _ = generate(RequestBudget())
+    assert full_calls['verification'] > 0
+
+    mermaid, calls, run = generate(RequestBudget(max_tokens=20000))
+
+    assert_valid_mermaid(full_mermaid)
+    assert_valid_mermaid(mermaid)
+    assert {'LEXICAL_DEDUP', 'NO_VERIFICATION'} <= set(run.budget.degradations)
+    assert 'SIMPLE' not in run.budget.degradations
+    assert 'verification' not in calls
+    assert calls['similarity'] < full_calls['similarity']
+    # A budget can only be overrun by the calls already in flight when it ran out
+    assert run.budget.snapshot()['tokens'] < 20000 * 1.1
+
+
+def test_nearly_spent_budget_falls_back_to_simple_generation(generate, monkeypatch):
+    # Detecting the document type alone crosses the fallback threshold
+    monkeypatch.setattr(mg.Config, 'BUDGET_SKIP_EMOJI_AT', 0.01)
+    monkeypatch.setattr(mg.Config, 'BUDGET_LEXICAL_DEDUP_AT', 0.02)
+    monkeypatch.setattr(mg.Config, 'BUDGET_SKIP_VERIFICATION_AT', 0.03)
+    monkeypatch.setattr(mg.Config, 'BUDGET_SIMPLE_FALLBACK_AT', 0.05)
+
+    mermaid, _, run = generate(RequestBudget(max_tokens=20000))
+
+    assert_valid_mermaid(mermaid)
+    assert run.usage.call_counts == {'detecting_document_type': 1, 'simple_mindmap_generation': 1}
+    assert run.budget.degradations[0] == 'SIMPLE'
+    # The simple mindmap gets default emojis instead of an LLM pick
+    assert 'NO_EMOJI' in run.budget.degradations
@@ -0,0 +1,114 @@
+"""CheckpointStore: stage log replay, torn-line repair, content-hash reset and pruning."""
+import asyncio
+import os
+import time
+
+import pytest
+
+from mindmap_generator import CheckpointStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return CheckpointStore(str(tmp_path), enabled=True, max_age_hours=1)
+
+
+async def write_stages(store, request_id='req-1', content_hash='hash-a'):
+    await store.append(request_id, content_hash, 'doc_type', 'TECHNICAL')
+    await store.append(request_id, content_hash, 'main_topics', [{'name': 'Fleet'}])
+    await store.append(request_id, content_hash, 'details', [{'text': 'one'}], key='k1')
+    await store.append(request_id, content_hash, 'details', [{'text': 'two'}], key='k2')
+
+
+def test_load_replays_stages_and_keyed_items(store):
+    async def scenario():
+        await write_stages(store)
+        return await store.load('req-1', 'hash-a')
+
+    stages = asyncio.run(scenario())
+
+    assert stages == {
+        'doc_type': 'TECHNICAL',
+        'main_topics': [{'name': 'Fleet'}],
+        'details': {'k1': [{'text': 'one'}], 'k2': [{'text': 'two'}]},
+    }
+
+
+def test_append_serializes_value_at_call_time(store):
+    async def scenario():
+        topics = [{'name': 'Fleet'}]
+        pending = store.append('req-1', 'hash-a', 'main_topics', topics)
+        task = asyncio.ensure_future(pending)
+        await asyncio.sleep(0)  # the append is now waiting on file I/O
+        topics.append({'name': 'mutated later'})
+        await task
+        return await store.load('req-1', 'hash-a')
+
+    assert asyncio.run(scenario())['main_topics'] == [{'name': 'Fleet'}]
+
+
+def test_truncated_last_line_is_dropped_and_file_rewritten(store):
+    path = store.log_path_for('req-1')
+
+    async def scenario():
+        await write_stages(store)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write('{"stage": "filtered", "key": null, "va')
+        stages = await store.load('req-1', 'hash-a')
+        await store.append('req-1', 'hash-a', 'filtered', {'central_theme': {}})
+        return stages, await store.load('req-1', 'hash-a')
+
+    stages, resumed = asyncio.run(scenario())
+
+    assert 'filtered' not in stages
+    assert stages['details'] == {'k1': [{'text': 'one'}], 'k2': [{'text': 'two'}]}
+    assert resumed['filtered'] == {'central_theme': {}}
+    with open(path, encoding='utf-8') as f:
+        assert all(line.endswith('}\n') for line in f)
+
+
+def test_different_content_hash_clears_the_log(store):
+    async def scenario():
+        await write_stages(store)
+        return await store.load('req-1', 'hash-b')
+
+    assert asyncio.run(scenario()) == {}
+    assert not os.path.exists(store.log_path_for('req-1'))
+
+
+def test_clear_removes_log(store):
+    asyncio.run(write_stages(store))
+
+    store.clear('req-1')
+
+    assert not os.path.exists(store.log_path_for('req-1'))
+
+
+def test_stale_logs_are_pruned(store, tmp_path):
+    async def scenario():
+        await write_stages(store, 'stale')
+        await write_stages(store, 'fresh')
+        stale_time = time.time() - 2 * 3600
+        os.utime(store.log_path_for('stale'), (stale_time, stale_time))
+        snapshot = tmp_path / 'snapshot.json'
+        snapshot.write_text('{}')
+        os.utime(snapshot, (stale_time, stale_time))
+        await store.load('other', 'hash-a')
+        return snapshot
+
+    snapshot = asyncio.run(scenario())
+
+    assert not os.path.exists(store.log_path_for('stale'))
+    assert os.path.exists(store.log_path_for('fresh'))
+    assert snapshot.exists()  # whole-payload files written by save() are not pruned
+
+
+def test_disabled_store_writes_nothing(tmp_path):
+    store = CheckpointStore(str(tmp_path / 'off'), enabled=False)
+
+    async def scenario():
+        await write_stages(store)
+        return await store.load('req-1', 'hash-a')
+
+    assert asyncio.run(scenario()) == {}
+    assert not os.path.exists(tmp_path / 'off')
@@ -0,0 +1,47 @@
+"""DocumentChunker: every chunk stays within the effective token limit."""
+import pytest
+
+from mindmap_generator import Config, DocumentChunker
+
+
+def long_paragraph(sentences: int) -> str:
+    return " ".join(f"Sentence {i} describes the naval blockade and its effect on trade." for i in range(sentences))
+
+
+@pytest.fixture
+def chunker():
+    return DocumentChunker()
+
+
+def test_oversized_paragraph_is_split_against_effective_limit(chunker):
+    # Short paragraphs plus one paragraph larger than total // 3 but below CHUNK_MAX_TOKENS
+    content = "# Intro\n\n" + "\n\n".join(long_paragraph(6) for _ in range(30)) + "\n\n# Big\n\n" + long_paragraph(110)
+    total = chunker.token_counter.count(content)
+    limit = chunker.target_chunk_tokens(total)
+    big = chunker.token_counter.count(long_paragraph(110))
+    assert limit < big <= Config.CHUNK_MAX_TOKENS
+
+    chunks = chunker.chunk_document(content)
+
+    assert len(chunks) >= 3
+    assert all(chunk.token_count <= limit for chunk in chunks)
+
+
+def test_explicit_limit_applies_to_sentences_without_punctuation(chunker):
+    content = "# Title\n\n" + " ".join(["blockade"] * 3000)
+
+    chunks = chunker.chunk_document(content, max_tokens=200)
+
+    assert all(chunk.token_count <= 200 for chunk in chunks)
+    assert chunks[0].text.startswith("# Title")
+    assert chunks[-1].end_char == len(content)
+
+
+def test_chunks_cover_document_in_order(chunker):
+    content = "Preface.\n\n# A\n\n" + long_paragraph(40) + "\n\n## B\n\n" + long_paragraph(40)
+
+    chunks = chunker.chunk_document(content, max_tokens=150)
+
+    assert [chunk.index for chunk in chunks] == list(range(len(chunks)))
+    for previous, following in zip(chunks, chunks[1:]):
+        assert previous.end_char == following.start_char
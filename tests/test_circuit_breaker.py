@@ -0,0 +1,144 @@
+"""CircuitBreaker state machine, the retry fail-fast path and the backend health status."""
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import mindmap_generator as mg
+from mindmap_generator import CircuitBreaker, CircuitState
+from mock_llm_provider import MockLLMProvider
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(mg.time, 'monotonic', clock)
+    monkeypatch.setattr(mg.Config, 'CIRCUIT_WINDOW_SECONDS', 60)
+    monkeypatch.setattr(mg.Config, 'CIRCUIT_MIN_REQUESTS', 4)
+    monkeypatch.setattr(mg.Config, 'CIRCUIT_ERROR_RATE_THRESHOLD', 0.5)
+    monkeypatch.setattr(mg.Config, 'CIRCUIT_OPEN_SECONDS', 30)
+    return clock
+
+
+def open_breaker(breaker: CircuitBreaker):
+    for _ in range(4):
+        breaker.record_failure(RuntimeError('boom'))
+
+
+def test_stays_closed_below_min_requests(clock):
+    breaker = CircuitBreaker('MOCK')
+
+    for _ in range(3):
+        breaker.record_failure(RuntimeError('boom'))
+
+    assert breaker.state == CircuitState.CLOSED
+    assert breaker.error_rate() == 1.0
+    assert breaker.acquire()
+
+
+def test_opens_once_error_rate_reached_over_min_requests(clock):
+    breaker = CircuitBreaker('MOCK')
+    breaker.record_success()
+    breaker.record_success()
+    breaker.record_failure(RuntimeError('boom'))
+    assert breaker.state == CircuitState.CLOSED
+
+    breaker.record_failure(RuntimeError('boom'))
+
+    assert breaker.state == CircuitState.OPEN
+    assert breaker.times_opened == 1
+    assert not breaker.available() and not breaker.acquire()
+
+
+def test_outcomes_outside_window_are_pruned(clock):
+    breaker = CircuitBreaker('MOCK')
+    for _ in range(3):
+        breaker.record_failure(RuntimeError('boom'))
+
+    clock.now += 61
+    breaker.record_failure(RuntimeError('boom'))
+
+    assert len(breaker.outcomes) == 1
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_half_open_probe_success_closes(clock):
+    breaker = CircuitBreaker('MOCK')
+    open_breaker(breaker)
+
+    clock.now += 30
+    assert breaker.available()
+    assert breaker.acquire()
+    assert breaker.state == CircuitState.HALF_OPEN
+    # Only one probe at a time
+    assert not breaker.available() and not breaker.acquire()
+
+    breaker.record_success()
+
+    assert breaker.state == CircuitState.CLOSED
+    assert not breaker.outcomes
+    assert breaker.acquire()
+
+
+def test_half_open_probe_failure_reopens(clock):
+    breaker = CircuitBreaker('MOCK')
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.acquire()
+
+    breaker.record_failure(RuntimeError('still down'))
+
+    assert breaker.state == CircuitState.OPEN
+    assert breaker.times_opened == 2
+    assert breaker.snapshot()['retry_in_seconds'] == 30
+    assert breaker.snapshot()['last_error'] == 'still down'
+
+
+@pytest.fixture
+def failing_mock(monkeypatch):
+    monkeypatch.setattr(mg.Config, 'API_PROVIDER', 'MOCK')
+    monkeypatch.setattr(mg.Config, 'API_FALLBACK_PROVIDERS', [])
+    monkeypatch.setattr(mg.Config, 'CIRCUIT_MIN_REQUESTS', 1)
+    monkeypatch.setattr(mg.Config, 'CIRCUIT_ERROR_RATE_THRESHOLD', 0.5)
+    monkeypatch.setattr(mg.Config, 'CIRCUIT_OPEN_SECONDS', 30)
+    monkeypatch.setattr(mg, '_circuit_breakers', {})
+    provider = MockLLMProvider(latency_distribution='constant', latency_mean=0.0, error_rate=1.0)
+    monkeypatch.setattr(mg, '_mock_provider', provider)
+    return provider
+
+
+def test_retry_fails_fast_once_every_circuit_is_open(failing_mock):
+    generator = mg.MindMapGenerator()
+    assert generator.config['max_retries'] > 1
+
+    start = time.perf_counter()
+    result = asyncio.run(generator._retry_generate_completion(
+        'Identify the main topics.', 100, 'req-1', 'extracting_main_topics'))
+
+    assert result is None
+    assert failing_mock.calls == 1
+    # No backoff sleep: the first retry delay is a full second
+    assert time.perf_counter() - start < 0.5
+    assert mg.get_circuit_breaker('MOCK').state == CircuitState.OPEN
+
+
+def test_health_is_degraded_when_every_circuit_is_open(failing_mock):
+    import web_backend
+
+    client = TestClient(web_backend.app)
+    assert client.get('/api/health').json()['status'] == 'healthy'
+
+    open_breaker(mg.get_circuit_breaker('MOCK'))
+    body = client.get('/api/health').json()
+
+    assert body['status'] == 'degraded'
+    assert body['providers']['MOCK']['state'] == 'open'
@@ -0,0 +1,97 @@
+"""Singleflight coalescing of identical in-flight prompts in DocumentOptimizer.generate_completion."""
+import asyncio
+
+import pytest
+
+import mindmap_generator as mg
+from mock_llm_provider import MockLLMProvider
+
+TASK = 'extracting_main_topics'
+PROMPT = 'Identify the main topics: naval blockade, grain exports, credit markets and port congestion.'
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    monkeypatch.setattr(mg.Config, 'API_PROVIDER', 'MOCK')
+    monkeypatch.setattr(mg.Config, 'API_FALLBACK_PROVIDERS', [])
+    monkeypatch.setattr(mg, '_circuit_breakers', {})
+    monkeypatch.setattr(mg, '_inflight_completions', {})
+    provider = MockLLMProvider(latency_distribution='constant', latency_mean=0.1)
+    monkeypatch.setattr(mg, '_mock_provider', provider)
+    return provider
+
+
+def test_identical_prompts_share_one_provider_call(provider):
+    optimizer = mg.DocumentOptimizer()
+    coalesced_before = mg.LLM_COALESCED.value(category='topics')
+
+    async def scenario():
+        return await asyncio.gather(*(optimizer.generate_completion(PROMPT, 500, task=TASK) for _ in range(4)))
+
+    answers = asyncio.run(scenario())
+
+    assert provider.calls == 1
+    assert answers[0] and len(set(answers)) == 1
+    assert mg.LLM_COALESCED.value(category='topics') == coalesced_before + 3
+    assert not mg._inflight_completions
+
+
+def test_different_prefix_or_max_tokens_are_not_merged(provider):
+    optimizer = mg.DocumentOptimizer()
+
+    async def scenario():
+        return await asyncio.gather(
+            optimizer.generate_completion(PROMPT, 500, task=TASK),
+            optimizer.generate_completion(PROMPT, 400, task=TASK),
+            optimizer.generate_completion(PROMPT, 500, task=TASK, cache_prefix='Document chunk one.\n'),
+            optimizer.generate_completion(PROMPT, 500, task=TASK, cache_prefix='Document chunk two.\n'),
+        )
+
+    asyncio.run(scenario())
+
+    assert provider.calls == 4
+
+
+def test_timed_out_leader_does_not_cancel_shared_call(provider):
+    optimizer = mg.DocumentOptimizer()
+
+    async def with_tight_budget():
+        budget = mg.RequestBudget(max_seconds=0.02)
+        budget.start(mg.TokenUsageTracker())
+        mg._active_budget.set(budget)
+        return await optimizer.generate_completion(PROMPT, 500, task=TASK)
+
+    async def scenario():
+        leader = asyncio.ensure_future(with_tight_budget())
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(optimizer.generate_completion(PROMPT, 500, task=TASK))
+        with pytest.raises(mg.BudgetExceededError):
+            await leader
+        return await waiter
+
+    answer = asyncio.run(scenario())
+
+    assert answer is not None
+    assert provider.calls == 1
+    assert mg.get_circuit_breaker('MOCK').total_successes == 1
+
+
+def test_call_is_cancelled_once_every_waiter_is_gone(provider):
+    optimizer = mg.DocumentOptimizer()
+
+    async def scenario():
+        callers = [asyncio.ensure_future(optimizer.generate_completion(PROMPT, 500, task=TASK)) for _ in range(2)]
+        await asyncio.sleep(0.02)
+        callers[0].cancel()
+        await asyncio.sleep(0)
+        assert mg._inflight_completions
+        callers[1].cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        assert not mg._inflight_completions
+        # Give a call that was not cancelled time to finish
+        await asyncio.sleep(0.15)
+
+    asyncio.run(scenario())
+
+    assert provider.calls == 1
+    assert mg.get_circuit_breaker('MOCK').total_successes == 0
@@ -0,0 +1,100 @@
+"""DocumentParser.iter_sections_from_file：字节/字符偏移与按需读取章节"""
+import pytest
+
+from document_parser import DocumentParser
+
+SAMPLE = (
+    "前言：第一个标题之前的内容 🚀\n"
+    "\n"
+    "# 第一章 总论\n"
+    "正文包含多字节字符：é、中文、😀。\n"
+    "\n"
+    "## 1.1 细节 ✨\n"
+    "More text.\n"
+    "   ### 缩进标题\n"
+    "最后一段。\n"
+)
+
+
+def write(tmp_path, text, newline=None):
+    path = tmp_path / "doc.md"
+    with open(path, "w", encoding="utf-8", newline=newline) as f:
+        f.write(text)
+    return str(path)
+
+
+def read_raw(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    # newline='' 保留原始换行，字符偏移按文件中的实际字符计算
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        text = f.read()
+    return data, text
+
+
+def check_offsets(parser, path):
+    data, text = read_raw(path)
+    sections = list(parser.iter_sections_from_file(path))
+    for section in sections:
+        heading_bytes = data[section.heading_start_byte:section.heading_end_byte]
+        assert heading_bytes.decode("utf-8") == text[section.heading_start_char:section.heading_end_char]
+        content_bytes = data[section.content_start_byte:section.content_end_byte]
+        assert content_bytes.decode("utf-8") == text[section.content_start_char:section.content_end_char]
+        assert parser.read_section_content(path, section) == text[section.content_start_char:section.content_end_char].strip()
+    # 章节首尾相接并覆盖整个文件
+    for previous, following in zip(sections, sections[1:]):
+        assert previous.content_end_byte == following.heading_start_byte
+        assert previous.content_end_char == following.heading_start_char
+    assert sections[-1].content_end_byte == len(data)
+    assert sections[-1].content_end_char == len(text)
+    return sections
+
+
+def test_sections_in_document_order_with_preface(tmp_path):
+    parser = DocumentParser()
+    sections = check_offsets(parser, write(tmp_path, SAMPLE))
+
+    assert [(s.level, s.title) for s in sections] == [
+        (1, "引言"), (1, "第一章 总论"), (2, "1.1 细节 ✨"), (3, "缩进标题")
+    ]
+    assert sections[0].heading_start_char == sections[0].heading_end_char == 0
+    assert parser.read_section_content(str(tmp_path / "doc.md"), sections[1]) == "正文包含多字节字符：é、中文、😀。"
+
+
+def test_heading_char_offsets_match_in_memory_parser(tmp_path):
+    parser = DocumentParser()
+    sections = list(parser.iter_sections_from_file(write(tmp_path, SAMPLE)))
+    headings = parser._extract_headings(SAMPLE)
+
+    assert [(s.heading_start_char, s.title) for s in sections[1:]] == [(h.start_char, h.title) for h in headings]
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 3, 7, 64])
+def test_offsets_do_not_depend_on_block_size(tmp_path, block_size):
+    path = write(tmp_path, SAMPLE * 3)
+    expected = list(DocumentParser().iter_sections_from_file(path))
+
+    parser = DocumentParser()
+    parser.STREAM_BLOCK_SIZE = block_size
+    assert check_offsets(parser, path) == expected
+
+
+def test_crlf_line_endings(tmp_path):
+    parser = DocumentParser()
+    sections = check_offsets(parser, write(tmp_path, SAMPLE, newline="\r\n"))
+
+    assert [s.title for s in sections] == ["引言", "第一章 总论", "1.1 细节 ✨", "缩进标题"]
+    assert all("\r" not in s.raw_heading for s in sections)
+
+
+def test_file_without_headings_is_one_preface_section(tmp_path):
+    parser = DocumentParser()
+    sections = check_offsets(parser, write(tmp_path, "只有正文，没有标题。\n第二行。"))
+
+    assert len(sections) == 1
+    assert sections[0].title == "引言"
+    assert sections[0].content_start_byte == 0
+
+
+def test_empty_file_yields_nothing(tmp_path):
+    assert list(DocumentParser().iter_sections_from_file(write(tmp_path, ""))) == []
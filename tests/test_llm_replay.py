@@ -0,0 +1,120 @@
+"""Recording LLM sessions and replaying them offline (llm_replay + the REPLAY provider)."""
+import asyncio
+import gzip
+import os
+
+import pytest
+
+import mindmap_generator as mg
+from llm_replay import ReplayLLMProvider, ReplayMissError, SessionRecorder, load_session
+from mock_llm_provider import MockLLMProvider
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'sample_input_document_as_markdown__small.md')
+
+
+@pytest.fixture
+def pipeline(monkeypatch, tmp_path):
+    """MOCK without latency, no snapshots, checkpoints or emoji cache file shared with other runs."""
+    monkeypatch.setattr(mg.Config, 'API_PROVIDER', 'MOCK')
+    monkeypatch.setattr(mg.Config, 'API_FALLBACK_PROVIDERS', [])
+    monkeypatch.setattr(mg.Config, 'ENABLE_SNAPSHOTS', False)
+    monkeypatch.setattr(mg.Config, 'ENABLE_CHECKPOINTS', False)
+    monkeypatch.setattr(mg.Config, 'LLM_REPLAY_LATENCY_SCALE', 0.0)
+    monkeypatch.setattr(mg.Config, 'LLM_REPLAY_MOCK_ON_MISS', False)
+    monkeypatch.setattr(mg, '_EMOJI_CACHE_FILE', str(tmp_path / 'emoji_cache.json'))
+    monkeypatch.setattr(mg, '_emoji_cache', None)
+    monkeypatch.setattr(mg, '_circuit_breakers', {})
+    monkeypatch.setattr(mg, '_inflight_completions', {})
+    monkeypatch.setattr(mg, '_mock_provider', MockLLMProvider(latency_distribution='constant', latency_mean=0.0))
+    monkeypatch.setattr(mg, '_session_recorder', None)
+    monkeypatch.setattr(mg, '_replay_provider', None)
+    with open(SAMPLE, encoding='utf-8') as f:
+        document = f.read()
+
+    def run(request_id: str):
+        mg._emoji_cache = {}
+
+        async def scenario():
+            with mg.usage_ledger() as ledger:
+                mermaid = await mg.MindMapGenerator().generate_mindmap(document, request_id)
+            return mermaid, ledger
+
+        return asyncio.run(scenario())
+
+    return run
+
+
+def test_replay_reproduces_recorded_mock_run(pipeline, monkeypatch, tmp_path):
+    session = str(tmp_path / 'session.jsonl.gz')
+    monkeypatch.setattr(mg.Config, 'LLM_RECORD_FILE', session)
+    recorded_mermaid, recorded = pipeline('record')
+    mg.get_session_recorder().close()
+
+    monkeypatch.setattr(mg.Config, 'LLM_RECORD_FILE', None)
+    monkeypatch.setattr(mg.Config, 'API_PROVIDER', 'REPLAY')
+    monkeypatch.setattr(mg.Config, 'LLM_REPLAY_FILE', session)
+    replayed_mermaid, replayed = pipeline('replay')
+
+    assert recorded_mermaid.count('\n') > 10
+    assert replayed_mermaid == recorded_mermaid
+    assert replayed.call_counts == recorded.call_counts
+    assert len(load_session(session)) == sum(recorded.call_counts.values())
+    assert mg.get_replay_provider().stats()['misses'] == 0
+    # Replayed calls are billed like the provider that served the recording
+    assert replayed.call_counts_by_provider == {'MOCK': sum(recorded.call_counts.values())}
+
+
+def record_calls(path: str, responses):
+    recorder = SessionRecorder(path)
+    for prompt, response in responses:
+        recorder.record(prompt, 100, 'extracting_main_topics', 'OPENAI', response, 10, 5, latency=0.5)
+    recorder.close()
+
+
+def test_unrecorded_prompt_raises_replay_miss(tmp_path):
+    path = str(tmp_path / 'session.jsonl.gz')
+    record_calls(path, [('known prompt', '["Known"]')])
+    replay = ReplayLLMProvider(path, latency_scale=0)
+
+    async def scenario():
+        entry = await replay.complete('known prompt', 100, 'extracting_main_topics')
+        assert entry['response'] == '["Known"]' and entry['provider'] == 'OPENAI'
+        with pytest.raises(ReplayMissError):
+            await replay.complete('known prompt', 200, 'extracting_main_topics')
+        with pytest.raises(ReplayMissError):
+            await replay.complete('new prompt', 100, 'extracting_main_topics')
+
+    asyncio.run(scenario())
+
+    assert replay.stats() == {'hits': 1, 'misses': 2, 'recorded_prompts': 1}
+
+
+def test_repeated_prompt_replays_in_recorded_order(tmp_path):
+    path = str(tmp_path / 'session.jsonl.gz')
+    record_calls(path, [('same prompt', 'first'), ('same prompt', 'second')])
+    replay = ReplayLLMProvider(path, latency_scale=0)
+
+    async def scenario():
+        return [(await replay.complete('same prompt', 100, 'task'))['response'] for _ in range(3)]
+
+    assert asyncio.run(scenario()) == ['first', 'second', 'second']
+
+
+def test_truncated_gzip_tail_keeps_complete_records(tmp_path):
+    path = str(tmp_path / 'session.jsonl.gz')
+    record_calls(path, [(f'prompt {i}', f'answer {i}') for i in range(50)])
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) * 2 // 3])
+    with pytest.raises(EOFError):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            f.read()
+
+    records = load_session(path)
+
+    assert 0 < len(records) < 50
+    assert [r['response'] for r in records] == [f'answer {i}' for i in range(len(records))]
+    replay = ReplayLLMProvider(path, latency_scale=0)
+    assert asyncio.run(replay.complete('prompt 0', 100, 'task'))['response'] == 'answer 0'
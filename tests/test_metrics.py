@@ -0,0 +1,123 @@
+"""metrics: Prometheus text exposition, locked counter reads and the Gemini executor queue gauge."""
+import asyncio
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import metrics
+import mindmap_generator as mg
+
+SAMPLE_LINE = re.compile(
+    r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)'
+    r'(?:\{(?P<labels>[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\.)*"(?:,[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\.)*")*)\})?'
+    r' (?P<value>[-+]?(?:[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?|Inf|NaN))$'
+)
+
+
+def parse_exposition(text: str):
+    """Check the text exposition format line by line; returns {metric: type} and the samples."""
+    assert text.endswith('\n')
+    types, samples = {}, []
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            assert len(line.split(' ', 3)) == 4
+        elif line.startswith('# TYPE '):
+            _, _, name, type_name = line.split(' ')
+            assert type_name in ('counter', 'gauge', 'histogram')
+            assert name not in types, f"duplicate TYPE for {name}"
+            types[name] = type_name
+        else:
+            match = SAMPLE_LINE.match(line)
+            assert match, f"invalid sample line: {line!r}"
+            family = re.sub(r'_(bucket|sum|count)$', '', match['name'])
+            assert match['name'] in types or family in types, f"sample before its TYPE: {line!r}"
+            samples.append((match['name'], match['labels'] or '', match['value']))
+    return types, samples
+
+
+def test_render_counter_gauge_and_histogram():
+    registry = metrics.MetricsRegistry()
+    calls = registry.register(metrics.Counter('demo_calls_total', 'Calls', ('provider',)))
+    depth = registry.register(metrics.Gauge('demo_queue_depth', 'Queue depth'))
+    registry.register(metrics.Gauge('demo_ratio', 'Ratio', ('cache',), callback=lambda: {('emoji',): 0.25}))
+    seconds = registry.register(metrics.Histogram('demo_seconds', 'Latency', ('provider',), buckets=(0.1, 1)))
+    calls.inc(provider='MOCK')
+    calls.inc(2, provider='say "hi"\n')
+    depth.inc(3)
+    depth.dec()
+    for value in (0.05, 0.5, 5):
+        seconds.observe(value, provider='MOCK')
+
+    types, samples = parse_exposition(registry.render())
+
+    assert types == {'demo_calls_total': 'counter', 'demo_queue_depth': 'gauge',
+                     'demo_ratio': 'gauge', 'demo_seconds': 'histogram'}
+    assert ('demo_calls_total', 'provider="MOCK"', '1') in samples
+    assert ('demo_calls_total', 'provider="say \\"hi\\"\\n"', '2') in samples
+    assert ('demo_queue_depth', '', '2') in samples
+    assert ('demo_ratio', 'cache="emoji"', '0.25') in samples
+    buckets = [(labels, value) for name, labels, value in samples if name == 'demo_seconds_bucket']
+    assert buckets == [('provider="MOCK",le="0.1"', '1'), ('provider="MOCK",le="1"', '2'),
+                       ('provider="MOCK",le="+Inf"', '3')]
+    assert ('demo_seconds_count', 'provider="MOCK"', '3') in samples
+    assert ('demo_seconds_sum', 'provider="MOCK"', '5.55') in samples
+
+
+def test_unlabelled_metrics_render_zero_before_first_use():
+    registry = metrics.MetricsRegistry()
+    registry.register(metrics.Counter('demo_total', 'Nothing yet'))
+    registry.register(metrics.Gauge('demo_gauge', 'Nothing yet'))
+
+    _, samples = parse_exposition(registry.render())
+
+    assert samples == [('demo_total', '', '0'), ('demo_gauge', '', '0')]
+
+
+def test_process_registry_renders_valid_exposition():
+    mg.CACHE_LOOKUPS.inc(cache='emoji', result='hit')
+    mg.CACHE_LOOKUPS.inc(cache='emoji', result='miss')
+
+    types, samples = parse_exposition(metrics.REGISTRY.render())
+
+    assert types['mindmap_llm_calls_total'] == 'counter'
+    assert types['mindmap_llm_call_duration_seconds'] == 'histogram'
+    assert any(name == 'mindmap_cache_hit_ratio' and labels == 'cache="emoji"' for name, labels, _ in samples)
+
+
+def test_counter_items_is_a_snapshot():
+    counter = metrics.Counter('demo_total', 'Calls', ('cache', 'result'))
+    counter.inc(cache='emoji', result='hit')
+
+    items = counter.items()
+    counter.inc(cache='emoji', result='miss')
+
+    assert items == [(('emoji', 'hit'), 1)]
+    assert dict(counter.items()) == {('emoji', 'hit'): 1, ('emoji', 'miss'): 1}
+    with pytest.raises(ValueError):
+        counter.inc(-1, cache='emoji', result='hit')
+
+
+def test_gemini_queue_depth_counts_calls_waiting_for_a_worker(monkeypatch):
+    monkeypatch.setattr(mg, '_gemini_executor', ThreadPoolExecutor(max_workers=1))
+    release = threading.Event()
+    baseline = next(mg.GEMINI_QUEUE_DEPTH.samples())[2]
+    depth = lambda: next(mg.GEMINI_QUEUE_DEPTH.samples())[2] - baseline
+
+    async def scenario():
+        running = mg._run_in_gemini_executor(release.wait)
+        queued = mg._run_in_gemini_executor(lambda: 'done')
+        cancelled = mg._run_in_gemini_executor(lambda: 'never')
+        await asyncio.sleep(0.05)
+        assert depth() == 2
+        cancelled.cancel()
+        await asyncio.sleep(0.05)
+        assert depth() == 1
+        release.set()
+        assert await queued == 'done'
+        await running
+        assert depth() == 0
+
+    asyncio.run(scenario())
+    mg._gemini_executor.shutdown()
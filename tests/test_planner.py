@@ -0,0 +1,74 @@
+"""MindMapGenerator.plan_generation: strategy per document size, structure and provider load."""
+import os
+
+import pytest
+
+import mindmap_generator as mg
+
+SAMPLE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def document(sections: int, words_per_section: int) -> str:
+    body = " ".join(["blockade", "ports", "trade", "credit"] * (words_per_section // 4))
+    return "\n\n".join(f"## Section {i}\n\n{body}" for i in range(sections))
+
+
+@pytest.fixture
+def generator(monkeypatch):
+    monkeypatch.setattr(mg.Config, 'PLANNER_SIMPLE_MAX_TOKENS', 1000)
+    monkeypatch.setattr(mg.Config, 'PLANNER_FULL_MIN_TOKENS', 4000)
+    monkeypatch.setattr(mg.Config, 'PLANNER_FULL_MIN_SECTIONS', 12)
+    monkeypatch.setattr(mg.Config, 'PLANNER_BUSY_INFLIGHT_CALLS', 40)
+    monkeypatch.setattr(mg.Config, 'PLANNER_SLOW_LATENCY_SECONDS', 20)
+    generator = mg.MindMapGenerator()
+    monkeypatch.setattr(generator, '_provider_latency', lambda: None)
+    return generator
+
+
+def test_bundled_small_sample_uses_simple_mode(generator):
+    with open(os.path.join(SAMPLE_DIR, 'sample_input_document_as_markdown__small.md'), encoding='utf-8') as f:
+        content = f.read()
+
+    plan = generator.plan_generation(content)
+
+    assert plan.section_count > 3
+    assert plan.mode == 'simple'
+
+
+def test_short_document_is_simple_regardless_of_headings(generator):
+    plan = generator.plan_generation(document(sections=20, words_per_section=8))
+
+    assert plan.document_tokens <= 1000
+    assert plan.mode == 'simple'
+
+
+def test_medium_document_uses_hybrid_mode(generator):
+    plan = generator.plan_generation(document(sections=3, words_per_section=600))
+
+    assert 1000 < plan.document_tokens < 4000
+    assert plan.mode == 'hybrid'
+
+
+@pytest.mark.parametrize("sections, words", [(4, 1500), (12, 120)])
+def test_large_or_heavily_sectioned_document_uses_full_mode(generator, sections, words):
+    plan = generator.plan_generation(document(sections, words))
+
+    assert plan.document_tokens > 1000
+    assert plan.mode == 'full'
+
+
+def test_busy_provider_moves_one_step_towards_simple(generator, monkeypatch):
+    monkeypatch.setattr(mg, '_inflight_completions', {i: None for i in range(40)})
+
+    assert generator.plan_generation(document(4, 1500)).mode == 'hybrid'
+    assert generator.plan_generation(document(3, 600)).mode == 'simple'
+    plan = generator.plan_generation(document(4, 1500))
+    assert plan.inflight_calls == 40
+    assert any('busy' in reason for reason in plan.reasons)
+
+
+def test_slow_provider_moves_one_step_towards_simple(generator, monkeypatch):
+    monkeypatch.setattr(generator, '_provider_latency', lambda: 25.0)
+
+    assert generator.plan_generation(document(4, 1500)).mode == 'hybrid'
+    assert generator.plan_generation(document(3, 600)).mode == 'simple'
@@ -0,0 +1,133 @@
+"""DocumentOptimizer._route_completion: hedging, failover and per-provider billing on MOCK providers."""
+import asyncio
+import time
+from collections import deque
+
+import pytest
+
+import mindmap_generator as mg
+from mock_llm_provider import MockLLMProvider
+
+TASK = 'extracting_main_topics'
+PROMPT = 'Identify the main topics: naval blockade, grain exports, credit markets and port congestion.'
+
+
+def mock(seed: int, latency: float, error_rate: float = 0.0) -> MockLLMProvider:
+    return MockLLMProvider(seed=seed, latency_distribution='constant', latency_mean=latency, error_rate=error_rate)
+
+
+def expected_answer(provider: MockLLMProvider) -> str:
+    answer = mock(provider.seed, 0.0)
+    return asyncio.run(answer.complete(PROMPT, 500, TASK))[0]
+
+
+@pytest.fixture
+def providers(monkeypatch):
+    """MOCK as primary and OPENAI as fallback, each served by its own MockLLMProvider."""
+    providers = {'MOCK': mock(seed=1, latency=0.01), 'OPENAI': mock(seed=2, latency=0.01)}
+    monkeypatch.setattr(mg.Config, 'API_PROVIDER', 'MOCK')
+    monkeypatch.setattr(mg.Config, 'API_FALLBACK_PROVIDERS', ['OPENAI'])
+    monkeypatch.setattr(mg.Config, 'OPENAI_API_KEY', 'test-key')
+    monkeypatch.setattr(mg.Config, 'ENABLE_HEDGED_REQUESTS', True)
+    monkeypatch.setattr(mg.Config, 'HEDGE_DEFAULT_DELAY_SECONDS', 0.05)
+    monkeypatch.setattr(mg, '_circuit_breakers', {})
+
+    async def call_provider(self, provider, prompt, max_tokens, task, cache_prefix=None):
+        text, input_tokens, output_tokens = await providers[provider].complete(
+            (cache_prefix or '') + prompt, max_tokens, task)
+        mg.record_usage(input_tokens, output_tokens, task, provider)
+        return text
+
+    monkeypatch.setattr(mg.DocumentOptimizer, '_call_provider', call_provider)
+    return providers
+
+
+def route(optimizer: mg.DocumentOptimizer, settle: float = 0.0):
+    """Route PROMPT inside a fresh usage ledger; `settle` waits for a losing hedge to finish."""
+    async def scenario():
+        with mg.usage_ledger() as ledger:
+            start = time.perf_counter()
+            result = await optimizer._route_completion(PROMPT, 500, TASK)
+            elapsed = time.perf_counter() - start
+            await asyncio.sleep(settle)
+        return result, elapsed, ledger
+
+    return asyncio.run(scenario())
+
+
+def test_healthy_primary_answers_without_hedging(providers):
+    result, _, ledger = route(mg.DocumentOptimizer())
+
+    assert result == expected_answer(providers['MOCK'])
+    assert providers['OPENAI'].calls == 0
+    assert ledger.call_counts_by_provider == {'MOCK': 1}
+
+
+def test_slow_primary_hedges_and_first_answer_wins(providers):
+    providers['MOCK'].latency_mean = 0.5
+
+    result, elapsed, ledger = route(mg.DocumentOptimizer(), settle=0.6)
+
+    assert result == expected_answer(providers['OPENAI'])
+    assert elapsed < 0.4
+    assert providers['MOCK'].calls == 1 and providers['OPENAI'].calls == 1
+    # The losing call still finished and is billed to the provider that ran it
+    assert ledger.call_counts_by_provider == {'MOCK': 1, 'OPENAI': 1}
+    loser = providers['MOCK']
+    input_tokens = loser.count_tokens(PROMPT)
+    output_tokens = loser.count_tokens(expected_answer(loser))
+    assert ledger.token_counts_by_task[TASK]['input'] == 2 * input_tokens
+    assert ledger.cost_by_provider['MOCK'] == pytest.approx(
+        mg.TokenUsageTracker.calculate_cost('MOCK', input_tokens, output_tokens))
+
+
+def test_failing_primary_fails_over(providers):
+    providers['MOCK'].error_rate = 1.0
+    optimizer = mg.DocumentOptimizer()
+
+    result, _, ledger = route(optimizer)
+
+    assert result == expected_answer(providers['OPENAI'])
+    assert providers['MOCK'].failures == 1
+    assert mg.get_circuit_breaker('MOCK').total_failures == 1
+    assert ledger.call_counts_by_provider == {'OPENAI': 1}
+
+
+def test_every_provider_failing_returns_none(providers):
+    for provider in providers.values():
+        provider.error_rate = 1.0
+
+    result, _, ledger = route(mg.DocumentOptimizer())
+
+    assert result is None
+    assert providers['MOCK'].calls == 1 and providers['OPENAI'].calls == 1
+    assert ledger.call_counts_by_provider == {}
+
+
+def test_hedge_delay_uses_latency_percentile_once_enough_samples(providers, monkeypatch):
+    monkeypatch.setattr(mg.Config, 'HEDGE_MIN_SAMPLES', 20)
+    optimizer = mg.DocumentOptimizer()
+    assert optimizer.hedge_delay('MOCK', TASK) == 0.05
+
+    optimizer._latencies[('MOCK', TASK)] = deque([i / 100 for i in range(1, 21)])
+
+    assert optimizer.hedge_delay('MOCK', TASK) == pytest.approx(0.19)
+
+
+def test_median_latency_spans_tasks_of_one_provider(providers):
+    optimizer = mg.DocumentOptimizer()
+    assert optimizer.median_latency('MOCK') is None
+
+    optimizer._latencies[('MOCK', TASK)] = deque([0.1, 0.2, 0.9])
+    optimizer._latencies[('MOCK', 'extracting_details')] = deque([0.3, 0.4])
+    optimizer._latencies[('OPENAI', TASK)] = deque([5.0, 6.0])
+
+    assert optimizer.median_latency('MOCK') == 0.3
+    assert optimizer.median_latency('OPENAI') == 6.0
+
+
+def test_planner_reads_primary_provider_median_latency(providers):
+    generator = mg.MindMapGenerator()
+    route(generator.optimizer)
+
+    assert generator._provider_latency() == generator.optimizer.median_latency('MOCK') > 0
@@ -1,6 +1,11 @@
+import time
+
+# 启动计时起点：启动耗时按本模块开始导入到应用开始接受请求计算
+_STARTUP_STARTED = time.perf_counter()
+
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
 from pydantic import BaseModel
 from typing import List, Dict, Any, Optional
 import asyncio
@@ -13,18 +18,19 @@ from pathlib import Path
 import logging
 import base64
 import json
+import sys
+from dataclasses import asdict
 
 # 导入现有的思维导图生成器
-from mindmap_generator import MindMapGenerator, MinimalDatabaseStub, get_logger, generate_mermaid_html, DocumentOptimizer
+from mindmap_generator import MindMapGenerator, MinimalDatabaseStub, get_logger, generate_mermaid_html, get_provider_health, close_llm_clients, GenerationRun, RequestBudget, trace_span, usage_ledger, get_process_usage
 
 # 导入文档解析器
 from document_parser import DocumentParser
 
-# 导入MinerU相关模块
-from magic_pdf.data.data_reader_writer import FileBasedDataWriter, FileBasedDataReader
-from magic_pdf.data.dataset import PymuDocDataset
-from magic_pdf.model.doc_analyze_by_custom_model import doc_analyze
-from magic_pdf.config.enums import SupportedPdfParseMethod
+# 进程内指标（Prometheus文本格式，由 /metrics 暴露）
+import metrics
+
+# MinerU（magic_pdf）在首次处理PDF时才导入，见 load_mineru()
 
 # ======== Phase 1: 完整的内存树数据结构 ========
 
@@ -246,6 +252,69 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("shutdown")
+async def shutdown_llm_clients():
+    """关闭进程共享的LLM HTTP连接池"""
+    await close_llm_clients()
+
+# ======== 运行指标 ========
+
+PDF_CONVERSION_SECONDS = metrics.histogram(
+    'backend_pdf_conversion_duration_seconds', 'PDF转Markdown耗时', ('outcome',),
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1200)
+)
+ACTIVE_STREAMS = metrics.gauge('backend_mindmap_streams_active', '进行中的思维导图SSE流')
+LOOP_LAG_SECONDS = metrics.histogram(
+    'backend_event_loop_lag_seconds', '事件循环调度延迟', buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+LOOP_LAG_CURRENT = metrics.gauge('backend_event_loop_lag_current_seconds', '最近一次测得的事件循环延迟')
+metrics.gauge('backend_jobs_in_progress', '正在生成论证结构的文档数',
+              callback=lambda: sum(1 for info in list(document_status.values()) if info.get("status_demo") == "generating"))
+metrics.gauge('backend_documents', '内存中的文档数', callback=lambda: len(document_status))
+
+LOOP_LAG_INTERVAL_SECONDS = 0.5
+
+async def monitor_event_loop_lag():
+    """定期休眠并测量实际唤醒比预期晚了多少，即事件循环被阻塞的时间"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL_SECONDS)
+        lag = max(0.0, time.perf_counter() - start - LOOP_LAG_INTERVAL_SECONDS)
+        LOOP_LAG_SECONDS.observe(lag)
+        LOOP_LAG_CURRENT.set(lag)
+
+@app.on_event("startup")
+async def start_loop_lag_monitor():
+    """启动事件循环延迟监控任务"""
+    app.state.loop_lag_task = asyncio.create_task(monitor_event_loop_lag())
+
+@app.on_event("shutdown")
+async def stop_loop_lag_monitor():
+    """停止事件循环延迟监控任务"""
+    task = getattr(app.state, "loop_lag_task", None)
+    if task is not None:
+        task.cancel()
+
+# ======== 冷启动耗时 ========
+
+# 启动耗时预算（秒），超出时在日志中告警
+STARTUP_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", 1.0))
+# 应延迟到首次使用才导入的重型模块，启动时若已加载说明有地方提前导入了它们
+HEAVY_MODULES = ("magic_pdf", "torch", "anthropic", "openai", "google.generativeai", "tiktoken")
+STARTUP_SECONDS = metrics.gauge('backend_startup_seconds', '从导入后端模块到开始接受请求的耗时')
+
+@app.on_event("startup")
+async def record_startup_time():
+    """记录冷启动耗时并与预算比较"""
+    elapsed = time.perf_counter() - _STARTUP_STARTED
+    app.state.startup_seconds = elapsed
+    STARTUP_SECONDS.set(elapsed)
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    if elapsed > STARTUP_BUDGET_SECONDS:
+        logger.warning(f"启动耗时 {elapsed:.2f}s 超出预算 {STARTUP_BUDGET_SECONDS:.2f}s，启动时已加载的重型模块: {loaded or '无'}")
+    else:
+        logger.info(f"启动耗时 {elapsed:.2f}s（预算 {STARTUP_BUDGET_SECONDS:.2f}s），启动时已加载的重型模块: {loaded or '无'}")
+
 # 配置日志
 logger = get_logger()
 
@@ -277,8 +346,8 @@ class ArgumentStructureAnalyzer:
     def __init__(self):
         self.generator = MindMapGenerator()
         self.document_parser = DocumentParser()
-        # 添加DocumentOptimizer实例用于AI调用
-        self.optimizer = DocumentOptimizer()
+        # 复用生成器的DocumentOptimizer进行AI调用（底层HTTP连接池为进程共享）
+        self.optimizer = self.generator.optimizer
     
     def add_paragraph_ids(self, text: str) -> str:
         """为文本的每个段落添加ID号"""
@@ -682,9 +751,21 @@ edges:
             "node_mappings": node_mappings
         }
 
-# 创建全局分析器实例
+# 创建全局分析器实例（构造很轻：模型客户端和emoji缓存都在首次使用时才加载）
 argument_analyzer = ArgumentStructureAnalyzer()
 
+def load_mineru():
+    """导入MinerU相关模块
+
+    magic_pdf 会连带导入模型推理相关的依赖，耗时数秒，因此不在模块导入时加载，
+    只有第一次处理PDF时才导入；之后由Python的模块缓存直接返回
+    """
+    from magic_pdf.data.data_reader_writer import FileBasedDataWriter, FileBasedDataReader
+    from magic_pdf.data.dataset import PymuDocDataset
+    from magic_pdf.model.doc_analyze_by_custom_model import doc_analyze
+    from magic_pdf.config.enums import SupportedPdfParseMethod
+    return FileBasedDataWriter, FileBasedDataReader, PymuDocDataset, doc_analyze, SupportedPdfParseMethod
+
 async def process_pdf_to_markdown(pdf_file_path: str, document_id: str) -> str:
     """
     使用MinerU处理PDF文件，转换为Markdown格式
@@ -710,6 +791,10 @@ async def process_pdf_to_markdown(pdf_file_path: str, document_id: str) -> str:
         print(f"📁 [MinerU-目录] 创建输出目录: {output_dir}")
         print(f"🖼️  [MinerU-图片] 图片目录: {image_dir}")
         
+        # 首次调用时在线程中导入MinerU，避免导入期间阻塞事件循环
+        FileBasedDataWriter, FileBasedDataReader, PymuDocDataset, doc_analyze, SupportedPdfParseMethod = \
+            await asyncio.to_thread(load_mineru)
+
         # 创建数据读写器
         print("🔧 [MinerU-初始化] 创建数据读写器...")
         reader = FileBasedDataReader("")
@@ -819,7 +904,13 @@ async def upload_document(file: UploadFile = File(...)):
         if file_extension == '.pdf':
             # 处理PDF文件
             print(f"🔄 [PDF处理] 开始转换PDF为Markdown...")
-            markdown_content = await process_pdf_to_markdown(str(original_file_path), document_id)
+            conversion_start = time.perf_counter()
+            try:
+                markdown_content = await process_pdf_to_markdown(str(original_file_path), document_id)
+            except Exception:
+                PDF_CONVERSION_SECONDS.observe(time.perf_counter() - conversion_start, outcome="error")
+                raise
+            PDF_CONVERSION_SECONDS.observe(time.perf_counter() - conversion_start, outcome="ok")
             text_content = markdown_content
             
             # 将原始PDF文件编码为base64用于前端显示
@@ -960,13 +1051,20 @@ async def generate_argument_structure_async(document_id: str, content: str):
     """异步生成论证结构"""
     try:
         print(f"🔄 [异步任务] 开始为文档 {document_id} 生成论证结构")
-        argument_analyzer = ArgumentStructureAnalyzer()
-        
-        # 为文本添加段落ID
-        text_with_ids = argument_analyzer.add_paragraph_ids(content)
+        # 复用进程级的 argument_analyzer：分析器本身不保存请求状态，无需每个任务重新构建
         
-        # 生成论证结构
-        result = await argument_analyzer.generate_argument_structure(text_with_ids)
+        # 本次分析的模型调用计入独立的用量账本，同时累加到进程总用量
+        with usage_ledger() as usage, trace_span('generate_argument_structure') as timing:
+            # 为文本添加段落ID
+            with trace_span('add_paragraph_ids'):
+                text_with_ids = argument_analyzer.add_paragraph_ids(content)
+            
+            # 生成论证结构
+            result = await argument_analyzer.generate_argument_structure(text_with_ids)
+        # 保存本次分析的耗时树（各阶段及每次模型调用的排队/网络时间）和token/费用
+        document_status[document_id]["timing_demo"] = timing.to_dict()
+        document_status[document_id]["usage_demo"] = usage.get_enhanced_summary()
+        logger.info(f"论证结构分析耗时:\n{timing.render()}")
         
         if result["success"]:
             # 🆕 检查并转换节点ID格式：如果AI返回字母ID，转换为缩进式数字ID
@@ -1182,8 +1280,20 @@ async def get_document(document_id: str):
 
 @app.get("/api/health")
 async def health_check():
-    """健康检查接口"""
-    return {"status": "healthy", "message": "Argument Structure Analyzer API is running"}
+    """健康检查接口，附带各AI提供商的熔断器状态"""
+    providers = get_provider_health()
+    all_open = bool(providers) and all(p["state"] == "open" for p in providers.values())
+    return {
+        "status": "degraded" if all_open else "healthy",
+        "message": "Argument Structure Analyzer API is running",
+        "startup_seconds": getattr(app.state, "startup_seconds", None),
+        "providers": providers
+    }
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus文本格式的运行指标：LLM调用次数与延迟、token与费用、缓存命中率、队列深度、进行中的任务、PDF转换耗时、事件循环延迟"""
+    return Response(content=metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
 
 @app.get("/")
 async def root():
@@ -1330,6 +1440,105 @@ async def generate_document_structure(document_id: str):
         logger.error(f"Generate document structure error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"生成文档结构失败: {str(e)}")
 
+@app.get("/api/generate-mindmap-stream/{document_id}")
+async def generate_mindmap_stream(document_id: str, max_cost_usd: Optional[float] = None,
+                                  max_seconds: Optional[float] = None, max_tokens: Optional[int] = None,
+                                  strategy: str = "auto"):
+    """以SSE流式生成思维导图，边提取边推送部分结果，最后推送核查后的完整版本
+    
+    max_cost_usd / max_seconds / max_tokens 覆盖本次请求的预算（默认取 BUDGET_* 配置），
+    预算将尽时依次跳过emoji、改用字面去重、跳过事实核查，最后退化为单次提示生成
+    
+    strategy: auto（按文档大小、章节数和提供商负载自动选择）、full（完整流程）或 hybrid（单次提示
+    生成结构后并行补充细节）
+    """
+    if document_id not in document_status:
+        raise HTTPException(status_code=404, detail="文档不存在")
+    if strategy not in ("auto", "full", "hybrid"):
+        raise HTTPException(status_code=400, detail=f"未知的生成策略: {strategy}")
+    
+    content = document_status[document_id].get('content')
+    if not content:
+        raise HTTPException(status_code=400, detail="文档内容为空")
+    
+    async def event_source():
+        # 每次生成都有独立的运行状态（GenerationRun），可以安全复用进程级的生成器
+        run = GenerationRun()
+        if max_cost_usd is not None or max_seconds is not None or max_tokens is not None:
+            run.budget = RequestBudget(
+                max_cost_usd if max_cost_usd is not None else run.budget.max_cost_usd,
+                max_seconds if max_seconds is not None else run.budget.max_seconds,
+                max_tokens if max_tokens is not None else run.budget.max_tokens
+            )
+        ACTIVE_STREAMS.inc()
+        try:
+            stream = argument_analyzer.generator.generate_mindmap_stream(content, document_id, run=run, strategy=strategy)
+            async for event in stream:
+                if event['type'] == 'complete':
+                    document_status[document_id]["mindmap_code"] = event["mermaid"]
+                yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        finally:
+            ACTIVE_STREAMS.dec()
+            # 客户端断开或生成出错时同样保存已产生的耗时、用量、预算和策略，便于排查
+            doc_info = document_status.get(document_id)
+            if doc_info is not None:
+                if run.trace is not None:
+                    doc_info["mindmap_timing"] = run.trace.to_dict()
+                doc_info["mindmap_usage"] = run.usage.get_enhanced_summary()
+                doc_info["mindmap_budget"] = run.budget.snapshot()
+                if run.plan is not None:
+                    doc_info["mindmap_plan"] = asdict(run.plan)
+    
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/document/{document_id}/timing")
+async def get_document_timing(document_id: str):
+    """获取文档最近一次论证结构分析和思维导图生成的耗时树"""
+    if document_id not in document_status:
+        raise HTTPException(status_code=404, detail="文档不存在")
+    
+    doc_info = document_status[document_id]
+    return JSONResponse({
+        "success": True,
+        "document_id": document_id,
+        "argument_structure": doc_info.get("timing_demo"),
+        "mindmap": doc_info.get("mindmap_timing")
+    })
+
+@app.get("/api/document/{document_id}/usage")
+async def get_document_usage(document_id: str):
+    """获取文档最近一次论证结构分析和思维导图生成的token用量与费用"""
+    if document_id not in document_status:
+        raise HTTPException(status_code=404, detail="文档不存在")
+    
+    doc_info = document_status[document_id]
+    operations = {
+        "argument_structure": doc_info.get("usage_demo"),
+        "mindmap": doc_info.get("mindmap_usage")
+    }
+    recorded = [summary for summary in operations.values() if summary]
+    return JSONResponse({
+        "success": True,
+        "document_id": document_id,
+        **operations,
+        "mindmap_budget": doc_info.get("mindmap_budget"),
+        "total": {
+            "calls": sum(summary["total_calls"] for summary in recorded),
+            "input_tokens": sum(summary["total_input_tokens"] for summary in recorded),
+            "output_tokens": sum(summary["total_output_tokens"] for summary in recorded),
+            "cost_usd": round(sum(summary["total_cost_usd"] for summary in recorded), 6)
+        }
+    })
+
+@app.get("/api/usage")
+async def get_usage():
+    """获取本进程启动以来所有请求的token用量与费用汇总"""
+    return JSONResponse({"success": True, "usage": get_process_usage().get_enhanced_summary()})
+
 @app.post("/api/document/{document_id}/remap")
 async def update_node_mappings(document_id: str, request_data: dict):
     """更新节点映射关系"""